@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib.matcher import nearest_repres, RepresIndex
+
+# ***********************************CODE USAGE GUIDE***************************************
+# Compares brute-force nearest-representative matching with the pruning RepresIndex as the
+# number of representatives K grows. Run with "python benchmarks/bench_repres_index.py".
+# Sequences are weighted binary vectors scattered around K latent patterns, both methods must
+# return identical labels.
+# ******************************************************************************************
+
+
+def make_data(num_inst, num_repres, num_events, density, noise, seed):
+    rng = np.random.RandomState(seed)
+    weights = rng.uniform(0.05, 0.5, num_events)
+    patterns = (rng.rand(num_repres, num_events) < density).astype(np.float64)
+    data = patterns[rng.randint(0, num_repres, num_inst)]
+    flip = rng.rand(num_inst, num_events) < noise
+    data[flip] = 1 - data[flip]
+    return data * weights, patterns * weights
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_inst", type=int, default=20000)
+    parser.add_argument("--num_events", type=int, default=1000)
+    parser.add_argument("--repres_list", default="100,400,1600,3200")
+    parser.add_argument("--threshold", type=float, default=0.3)
+    parser.add_argument("--block_size", type=int, default=4096)
+    args = parser.parse_args()
+
+    print('%8s %12s %12s %12s %10s' % ('K', 'brute (s)', 'index (s)', 'build (s)', 'speedup'))
+    for num_repres in [int(x) for x in args.repres_list.split(',')]:
+        data, repre_seqs = make_data(args.num_inst, num_repres, args.num_events, 0.02, 0.0005, num_repres)
+
+        ts = time.time()
+        brute_labels, _ = nearest_repres(data, repre_seqs, args.threshold, args.block_size)
+        brute_time = time.time() - ts
+
+        ts = time.time()
+        index = RepresIndex(repre_seqs)
+        build_time = time.time() - ts
+        ts = time.time()
+        index_labels, _ = index.query(data, args.threshold, args.block_size)
+        index_time = time.time() - ts
+
+        assert (brute_labels == index_labels).all(), 'index result differs from brute force'
+        print('%8d %12.3f %12.3f %12.3f %9.1fx' % (num_repres, brute_time, index_time, build_time,
+                                                  brute_time / index_time))
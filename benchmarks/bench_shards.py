@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import shlex
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib import cascading_clustering as cluster
+from lib.util import load_all_data, list_seq_files
+from run import get_parser, get_correlation_weight_list, run_sharded
+from generate_data import generate_dataset, add_generator_arguments
+
+# ***********************************CODE USAGE GUIDE***************************************
+# Compares the sharded cascade ("--shards" in run.py) with the single-process cascade on the
+# same synthetic data: run time, number of clusters and the agreement of the final labels,
+# measured with the adjusted Rand index (1 means the same partition of the sequences).
+#
+#   python benchmarks/bench_shards.py --shards 2,4,8 --seqs_per_interval 5000
+# ******************************************************************************************
+
+
+def adjusted_rand_index(labels_a, labels_b):
+    """ adjusted Rand index of two labelings of the same sequences """
+    _, labels_a = np.unique(labels_a, return_inverse=True)
+    _, labels_b = np.unique(labels_b, return_inverse=True)
+    num_inst = len(labels_a)
+    contingency = np.bincount(labels_a * (labels_b.max() + 1) + labels_b).astype(np.float64)
+    pairs = lambda x: np.sum(x * (x - 1)) / 2
+    index = pairs(contingency)
+    pairs_a, pairs_b = pairs(np.bincount(labels_a).astype(np.float64)), pairs(np.bincount(labels_b).astype(np.float64))
+    expected = pairs_a * pairs_b / (num_inst * (num_inst - 1) / 2)
+    maximum = (pairs_a + pairs_b) / 2
+    return 1.0 if maximum == expected else (index - expected) / (maximum - expected)
+
+
+def run_single(args):
+    """ the single-process cascade of run.py, returns the final labels """
+    file_list = list_seq_files(args.seq_folder)
+    raw_data, raw_index, event_occu_matrix = load_all_data(args)
+    correlation_weight_list = get_correlation_weight_list(args, file_list, event_occu_matrix)
+    weight_data, weight_list = cluster.weigh(raw_data, correlation_weight_list, None,
+                                             np.sum(event_occu_matrix, axis=0), args.compact)
+    return cluster.cascade(args, raw_data, raw_index, weight_data, final_weight_list=weight_list)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", default="2,4", help="comma separated numbers of shards")
+    parser.add_argument("--data_dir", default=None, help="folder of the generated data, a temporary one by default")
+    parser.add_argument("--run_args", default="", help="extra parameters of run.py, e.g. \"--sparse\"")
+    bench_args = add_generator_arguments(parser).parse_args()
+
+    data_dir = bench_args.data_dir or tempfile.mkdtemp(prefix='log3c_shards_')
+    seq_folder = os.path.join(data_dir, 'seq_folder') + os.sep
+    kpi_path = os.path.join(data_dir, 'kpis', 'kpis.csv')
+    if not os.path.exists(kpi_path):
+        generate_dataset(data_dir, bench_args.num_intervals, bench_args.seqs_per_interval, bench_args.num_events,
+                         bench_args.sparsity, bench_args.dup_ratio, bench_args.num_patterns,
+                         bench_args.num_problems, bench_args.noise, bench_args.seed)
+    work_dir = tempfile.mkdtemp(prefix='log3c_shards_out_')
+    run_args = ['--seq_folder', seq_folder, '--kpi_path', kpi_path, '--output_path', work_dir,
+                '--rep_path', work_dir + os.sep] + shlex.split(bench_args.run_args)
+
+    ts = time.time()
+    single_labels = run_single(get_parser().parse_args(run_args))
+    results = [('single', time.time() - ts, len(np.unique(single_labels)), 1.0)]
+    for num_shards in [int(x) for x in bench_args.shards.split(',')]:
+        ts = time.time()
+        shard_labels = run_sharded(get_parser().parse_args(run_args + ['--shards', str(num_shards)]),
+                                   list_seq_files(seq_folder))
+        results.append(('%d shards' % num_shards, time.time() - ts, len(np.unique(shard_labels)),
+                        adjusted_rand_index(single_labels, shard_labels)))
+
+    print('%-12s %10s %10s %10s' % ('mode', 'time (s)', 'clusters', 'ARI'))
+    for name, seconds, num_clusters, ari in results:
+        print('%-12s %10.2f %10d %10.3f' % (name, seconds, num_clusters, ari))
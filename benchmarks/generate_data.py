@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import numpy as np
+
+# ***********************************CODE USAGE GUIDE***************************************
+# Generates a synthetic sequence folder and KPI file in the input format of run.py:
+#   <out_dir>/seq_folder/timeInter_<n>.csv   one log sequence matrix per time interval
+#   <out_dir>/kpis/kpis.csv                  one KPI value per time interval
+#
+# Sequences are drawn from latent patterns, each pattern activates a few events of the
+# vocabulary. The first num_problems patterns are problems, they burst in some intervals and
+# raise the KPI of those intervals. A share of dup_ratio sequences are exact copies of their
+# pattern, the others get a few events flipped.
+#
+# Example: python benchmarks/generate_data.py --out_dir /tmp/log3c_data --num_intervals 48
+# ******************************************************************************************
+
+
+def generate_patterns(rng, num_patterns, num_events, sparsity):
+    """ latent patterns of (num_patterns, num_events), each row has about sparsity * num_events events """
+    patterns = (rng.rand(num_patterns, num_events) < sparsity).astype(np.int64)
+    # every pattern contains at least one event
+    empty = np.flatnonzero(patterns.sum(axis=1) == 0)
+    patterns[empty, rng.randint(0, num_events, len(empty))] = 1
+    return patterns
+
+
+def generate_interval(rng, patterns, pattern_prob, num_seqs, dup_ratio, noise):
+    """ one log sequence matrix, event counts of each sequence within one time interval.
+
+    Returns:
+    --------
+    inter_data: matrix of (num_seqs, num_events) with event counts
+    pattern_index: the latent pattern of each sequence
+    """
+
+    num_events = patterns.shape[1]
+    pattern_index = rng.choice(len(patterns), num_seqs, p=pattern_prob)
+    inter_data = patterns[pattern_index].copy()
+    noisy = rng.rand(num_seqs) >= dup_ratio
+    flip = (rng.rand(num_seqs, num_events) < noise) & noisy[:, None]
+    # a noisy sequence keeps at least one flipped event so it differs from its pattern
+    no_flip = noisy & ~flip.any(axis=1)
+    flip[np.flatnonzero(no_flip), rng.randint(0, num_events, no_flip.sum())] = True
+    inter_data[flip] = 1 - inter_data[flip]
+    # events may occur several times within a sequence
+    inter_data *= rng.randint(1, 4, inter_data.shape)
+    return inter_data, pattern_index
+
+
+def generate_dataset(out_dir, num_intervals=24, seqs_per_interval=2000, num_events=200, sparsity=0.03,
+                     dup_ratio=0.7, num_patterns=50, num_problems=3, noise=0.002, seed=0):
+    """ write a synthetic sequence folder and KPI file.
+
+    Args:
+    --------
+    out_dir: output folder, seq_folder/ and kpis/kpis.csv are created inside
+    num_intervals: number of time intervals, i.e. timeInter_*.csv files and KPI values
+    seqs_per_interval: number of log sequences per interval
+    num_events: size of the event vocabulary
+    sparsity: share of the vocabulary active in a latent pattern
+    dup_ratio: share of sequences that are exact copies of their pattern
+    num_patterns: number of latent patterns
+    num_problems: number of latent patterns that are problems and drive the KPI
+    noise: probability that an event of a noisy sequence is flipped
+    seed: random seed
+
+    Returns:
+    --------
+    seq_folder: the generated sequence folder, with a trailing separator as expected by run.py
+    kpi_path: the generated KPI file
+    """
+
+    rng = np.random.RandomState(seed)
+    seq_folder = os.path.join(out_dir, 'seq_folder') + os.sep
+    kpi_dir = os.path.join(out_dir, 'kpis')
+    for folder in (seq_folder, kpi_dir):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    patterns = generate_patterns(rng, num_patterns, num_events, sparsity)
+    # normal patterns follow a skewed popularity, problems are rare except in their burst intervals
+    base_prob = 1.0 / np.arange(1, num_patterns + 1)
+    base_prob[:num_problems] = base_prob[-1] * 0.1
+    kpi_list = []
+    for t in range(num_intervals):
+        prob = base_prob.copy()
+        burst = rng.rand(num_problems) < 0.2
+        prob[:num_problems][burst] = base_prob.max() * rng.uniform(0.05, 0.3, burst.sum())
+        prob /= prob.sum()
+        inter_data, pattern_index = generate_interval(rng, patterns, prob, seqs_per_interval, dup_ratio, noise)
+        np.savetxt(seq_folder + 'timeInter_%d.csv' % t, inter_data, fmt='%d', delimiter=',')
+        problem_share = np.mean(pattern_index < num_problems)
+        kpi_list.append(int(round(1000 * problem_share + rng.randint(0, 10))))
+
+    kpi_path = os.path.join(kpi_dir, 'kpis.csv')
+    np.savetxt(kpi_path, np.array(kpi_list), fmt='%d')
+    return seq_folder, kpi_path
+
+
+def add_generator_arguments(parser):
+    """ the generator parameters, shared with run_benchmarks.py """
+    parser.add_argument("--num_intervals", type=int, default=24, help="number of timeInter_*.csv files")
+    parser.add_argument("--seqs_per_interval", type=int, default=2000, help="log sequences per interval")
+    parser.add_argument("--num_events", type=int, default=200, help="size of the event vocabulary")
+    parser.add_argument("--sparsity", type=float, default=0.03, help="share of events active in a pattern")
+    parser.add_argument("--dup_ratio", type=float, default=0.7, help="share of exact duplicate sequences")
+    parser.add_argument("--num_patterns", type=int, default=50, help="number of latent patterns")
+    parser.add_argument("--num_problems", type=int, default=3, help="number of latent problem patterns")
+    parser.add_argument("--noise", type=float, default=0.002, help="event flip probability of noisy sequences")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    return parser
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out_dir", required=True, help="output folder")
+    args = add_generator_arguments(parser).parse_args()
+    seq_folder, kpi_path = generate_dataset(args.out_dir, args.num_intervals, args.seqs_per_interval,
+                                            args.num_events, args.sparsity, args.dup_ratio, args.num_patterns,
+                                            args.num_problems, args.noise, args.seed)
+    print('sequence files written to %s, KPIs written to %s' % (seq_folder, kpi_path))
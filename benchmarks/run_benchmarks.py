@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+import resource
+import shlex
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib import cascading_clustering as cluster
+from lib.util import load_all_data, load_kpi
+from run import get_parser
+from generate_data import generate_dataset
+
+# ***********************************CODE USAGE GUIDE***************************************
+# Times and memory-profiles every stage of Log3C on synthetic data at several scales.
+#
+#   python benchmarks/run_benchmarks.py --scenarios small,medium --run_args "--sparse --dedup"
+#
+# Data of each scenario is generated once into --data_dir and reused by later runs. Every stage
+# is appended as one JSON line to --output, with wall time, CPU time, the tracemalloc peak of the
+# stage and the process max RSS, so results of different commits can be compared.
+# Note that load_all_data parses files in worker processes into shared memory, neither is in the peak.
+# ******************************************************************************************
+
+SCENARIOS = {
+    'small': dict(num_intervals=12, seqs_per_interval=1000, num_events=100),
+    'medium': dict(num_intervals=24, seqs_per_interval=5000, num_events=300),
+    'large': dict(num_intervals=48, seqs_per_interval=20000, num_events=1000),
+}
+
+
+def measure(record, stage, method, *args):
+    """ run one stage, add its wall time, CPU time and memory peak to the record list """
+    tracemalloc.start()
+    ts, cs = time.time(), time.process_time()
+    result = method(*args)
+    wall, cpu = time.time() - ts, time.process_time() - cs
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    record.append({'stage': stage, 'wall_s': round(wall, 4), 'cpu_s': round(cpu, 4), 'peak_mem_bytes': peak,
+                   'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+    print('%-24s %10.3f s %10.3f cpu s %10.1f MB peak' % (stage, wall, cpu, peak / 1e6))
+    return result
+
+
+def run_scenario(name, params, data_dir, run_args):
+    """ generate (or reuse) the data of one scenario and measure all stages.
+
+    Returns:
+    --------
+    record: list of dictionaries, one per stage
+    """
+
+    out_dir = os.path.join(data_dir, name)
+    seq_folder = os.path.join(out_dir, 'seq_folder') + os.sep
+    kpi_path = os.path.join(out_dir, 'kpis', 'kpis.csv')
+    if not os.path.exists(kpi_path):
+        generate_dataset(out_dir, **params)
+    work_dir = tempfile.mkdtemp(prefix='log3c_bench_')
+    args = get_parser().parse_args(['--seq_folder', seq_folder, '--kpi_path', kpi_path,
+                                    '--output_path', work_dir, '--rep_path', work_dir + os.sep] + run_args)
+
+    print('==========scenario %s %s========' % (name, params))
+    record = []
+    raw_data, raw_index, event_occu_matrix, offsets = measure(record, 'load_all_data', load_all_data, args, True)
+    strata = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets)) if args.stratify else None
+    kpi_list = load_kpi(args.kpi_path)
+    correlation_weight_list = measure(record, 'get_correlation_weight', cluster.get_correlation_weight,
+                                      event_occu_matrix, kpi_list)
+    counts, inverse = None, None
+    if args.dedup:
+        raw_data, counts, inverse = measure(record, 'deduplicate', cluster.deduplicate, raw_data)
+        raw_index = range(0, raw_data.shape[0])
+        if strata is not None:
+            unique_strata = np.empty(raw_data.shape[0], dtype=np.int64)
+            unique_strata[inverse[::-1]] = strata[::-1]
+            strata = unique_strata
+    # the same weighting and sampling entry points as run.py, so "--compact" and the sampling policy apply
+    weight_data, _ = measure(record, 'weigh', cluster.weigh, raw_data, correlation_weight_list, counts,
+                             event_occu_matrix.sum(axis=0), args.compact)
+    sample_data, sample_index, _ = measure(record, 'sampling', cluster.sample_round, args, weight_data,
+                                           np.asarray(raw_index), np.random.RandomState(args.sample_seed), counts,
+                                           strata, inverse)
+    cluster_labels = measure(record, 'clustering', cluster.clustering, args, sample_data)
+    repre_seqs = cluster.repres_extracting(sample_data, cluster_labels,
+                                           counts[sample_index] if counts is not None else None)
+    measure(record, 'matching', cluster.matching, args, weight_data, repre_seqs, raw_index)
+    final_clustering_result = measure(record, 'cascade', cluster.cascade, args, raw_data, raw_index, weight_data,
+                                      counts, inverse, strata)
+
+    for stage in record:
+        stage.update({'scenario': name, 'params': params, 'run_args': run_args,
+                      'num_inst': int(raw_data.shape[0]), 'num_events': int(raw_data.shape[1]),
+                      'num_clusters': int(final_clustering_result.max()) + 1,
+                      'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')})
+    return record
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", default="small,medium", help="comma separated names of " + ','.join(SCENARIOS))
+    parser.add_argument("--data_dir", default=os.path.join(tempfile.gettempdir(), 'log3c_bench_data'),
+                        help="folder where the generated data of each scenario is kept")
+    parser.add_argument("--run_args", default="", help="extra parameters of run.py, e.g. \"--sparse --dedup\"")
+    parser.add_argument("--output", default="bench_results.jsonl", help="JSON lines file the results are appended to")
+    args = parser.parse_args()
+
+    with open(args.output, 'a') as f:
+        for name in args.scenarios.split(','):
+            for stage in run_scenario(name, SCENARIOS[name], args.data_dir, shlex.split(args.run_args)):
+                f.write(json.dumps(stage) + '\n')
+    print('results appended to %s' % args.output)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy import sparse
+from .pairwise import condensed_offset, split_tiles
+
+# ***********************************CODE USAGE GUIDE***************************************
+# Not directly used, should be invoked by cascading_clustering.dist_compute() when
+# "--distance_kernel bits" is set in run.py, and by matching() when "--match_bits" is set
+#
+# Sequence vectors are 0/1 before weighting, so a weighted vector is fully described by its
+# bits and the weight vector w. bitkernel.py packs the bits of the rows with np.packbits (8
+# events per byte) and computes distances from per-byte lookup tables of 256 partial sums:
+#   row vs row:            d^2 = sum of w_i^2 over the bits of x XOR y
+#   row vs representative: d^2 = sum_i (x_i * w_i - r_i)^2, (w_i - r_i)^2 for set bits, r_i^2 else
+# All terms are non-negative, so the bytes are summed chunk by chunk and a pair is dropped as
+# soon as its partial sum exceeds threshold^2. Dropped pairs keep their partial distance, which
+# is already above threshold, so fcluster(threshold) and the matching test give the same result.
+# The weights are read back from the data: every non-zero of column i equals w_i.
+# ******************************************************************************************
+
+# bit j (most significant first, as np.packbits) of every byte value
+BYTE_BITS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).astype(np.float64)
+
+
+def pack_rows(data):
+    """ the bits and weights of weighted binary rows.
+
+    Args:
+    --------
+    data: weighted sequence data of (n, M), dense array or CSR matrix
+
+    Returns:
+    --------
+    packed: uint8 array of (n, ceil(M / 8)), bit j of byte b is event 8 * b + j
+    weights: weight of each event, 0 for events that never occur in data
+    """
+
+    if sparse.issparse(data):
+        data = sparse.csr_matrix(data)
+        weights = np.asarray(abs(data).max(axis=0).todense()).ravel().astype(np.float64)
+        data = data.toarray()
+    else:
+        data = np.asarray(data)
+        weights = np.abs(data).max(axis=0).astype(np.float64) if data.shape[0] else np.zeros(data.shape[1])
+    return np.packbits(data != 0, axis=1), weights
+
+
+def _pad_bytes(values, num_bytes):
+    padded = np.zeros(values.shape[:-1] + (num_bytes * 8,))
+    padded[..., :values.shape[-1]] = values
+    return padded.reshape(values.shape[:-1] + (num_bytes, 8))
+
+
+def xor_tables(weights, num_bytes):
+    """ table[b, v]: sum of w_i^2 over the events of byte b whose bit is set in v """
+    return _pad_bytes(weights * weights, num_bytes) @ BYTE_BITS.T
+
+
+def repres_tables(weights, repre_seqs, num_bytes):
+    """ table[k, b, v]: squared distance of byte b with bits v to the events of representative k """
+    repre_seqs = np.asarray(repre_seqs, dtype=np.float64)
+    unset = _pad_bytes(repre_seqs * repre_seqs, num_bytes)
+    delta = _pad_bytes((weights[None, :] - repre_seqs) ** 2, num_bytes) - unset
+    return unset.sum(axis=2)[:, :, None] + delta @ BYTE_BITS.T
+
+
+def _bounded_sum(tables, left, right, bound_sq, byte_chunk, combine):
+    """ sum the table entries of pairs byte by byte, dropping pairs whose sum exceeds bound_sq.
+
+    Args:
+    --------
+    tables: function (byte index, left ids, right ids, byte values) -> table entries
+    left, right: ids of both sides of each pair
+    bound_sq: pairs above it are dropped, None keeps all pairs
+    byte_chunk: number of bytes summed between two bound tests
+    combine: function (left ids, right ids, byte index) -> byte values of the pairs
+
+    Returns:
+    --------
+    partial: squared distance of each pair, a partial sum above bound_sq for dropped pairs
+    """
+
+    partial = np.zeros(len(left))
+    active = np.arange(len(left))
+    num_bytes = tables.num_bytes
+    for start in range(0, num_bytes, byte_chunk):
+        if len(active) == 0:
+            break
+        sub_left, sub_right = left[active], right[active]
+        chunk_sum = np.zeros(len(active))
+        for b in range(start, min(start + byte_chunk, num_bytes)):
+            chunk_sum += tables(b, sub_left, sub_right, combine(sub_left, sub_right, b))
+        partial[active] += chunk_sum
+        if bound_sq is not None:
+            active = active[partial[active] <= bound_sq]
+    return partial
+
+
+class _XorTables(object):
+    def __init__(self, weights, num_bytes):
+        self.num_bytes = num_bytes
+        self.table = xor_tables(weights, num_bytes)
+
+    def __call__(self, b, left, right, values):
+        return self.table[b][values]
+
+
+class _RepresTables(object):
+    def __init__(self, weights, repre_seqs, num_bytes):
+        self.num_bytes = num_bytes
+        self.table = repres_tables(weights, repre_seqs, num_bytes)
+
+    def __call__(self, b, left, right, values):
+        return self.table[right, b, values]
+
+
+def bits_condensed(data, threshold=None, n_threads=1, tile_pairs=1 << 20, byte_chunk=4):
+    """ pairwise distances of weighted binary rows in the condensed form of pdist.
+
+    Args:
+    --------
+    data: weighted sequence data of (n, M), dense array or CSR matrix
+    threshold: pairs are only summed until they exceed threshold, None computes exact distances
+    n_threads: number of threads computing tiles
+    tile_pairs: about the number of pairs of one tile
+    byte_chunk: number of bytes summed between two bound tests
+
+    Returns:
+    --------
+    dist_list: condensed distance vector, exact below threshold, above threshold otherwise
+    """
+
+    packed, weights = pack_rows(data)
+    num_inst, num_bytes = packed.shape
+    tables = _XorTables(weights, num_bytes)
+    bound_sq = None if threshold is None else float(threshold) ** 2
+    out = np.empty(condensed_offset(num_inst, num_inst))
+
+    def fill_tile(tile):
+        i0, i1 = tile
+        # all pairs (i, j) with i0 <= i < i1 and j > i, in condensed order
+        left = np.repeat(np.arange(i0, i1), num_inst - 1 - np.arange(i0, i1))
+        right = np.concatenate([np.arange(i + 1, num_inst) for i in range(i0, i1)]) if i1 > i0 else left
+        partial = _bounded_sum(tables, left, right, bound_sq, byte_chunk,
+                               lambda l, r, b: packed[l, b] ^ packed[r, b])
+        out[condensed_offset(i0, num_inst):condensed_offset(i1, num_inst)] = np.sqrt(partial)
+
+    bounds = split_tiles(num_inst, tile_pairs)
+    tiles = list(zip(bounds[:-1], bounds[1:]))
+    if n_threads > 1 and len(tiles) > 1:
+        with ThreadPoolExecutor(n_threads) as executor:
+            list(executor.map(fill_tile, tiles))
+    else:
+        for tile in tiles:
+            fill_tile(tile)
+    return out
+
+
+def bits_nearest(data, repre_seqs, threshold=None, block_size=4096, n_threads=1, byte_chunk=4):
+    """ nearest representative of every weighted binary row, the bits variant of matcher.nearest_repres().
+
+    Args:
+    --------
+    data: weighted sequence data of (N, M), dense array, CSR matrix or compact.WeightedRows
+    repre_seqs: representatives of (K, M)
+    threshold: if given, rows whose nearest distance is not below threshold get index -1 and
+               pairs are only summed until they exceed threshold
+    block_size: number of rows per block
+    n_threads: number of threads that process blocks concurrently
+    byte_chunk: number of bytes summed between two bound tests
+
+    Returns:
+    --------
+    clu_array: index of the nearest representative per row, -1 for mismatched rows if threshold is given
+    min_dist: distance of each row to its nearest representative, only known to be above threshold
+              if every pair of the row was dropped
+    """
+
+    num_inst = data.shape[0]
+    repre_seqs = np.asarray(repre_seqs, dtype=np.float64)
+    num_repres = repre_seqs.shape[0]
+    clu_array = np.full(num_inst, -1, dtype=np.int64)
+    min_dist = np.full(num_inst, np.inf)
+    if num_inst == 0 or num_repres == 0:
+        return clu_array, min_dist
+    bound_sq = None if threshold is None else float(threshold) ** 2
+    # the (K, bytes, 256) tables are built for groups of representatives of about 32 MB
+    num_bytes = (data.shape[1] + 7) // 8
+    group_size = max(1, (32 << 20) // (num_bytes * 256 * 8))
+    # pairs of one block and one group of representatives, bounds the temporary memory
+    block_size = max(1, min(int(block_size), (1 << 20) // min(num_repres, group_size)))
+
+    def run_block(start):
+        end = min(start + block_size, num_inst)
+        packed, weights = pack_rows(data[start:end])
+        best_dist = np.full(end - start, np.inf)
+        best_index = np.full(end - start, -1, dtype=np.int64)
+        for k0 in range(0, num_repres, group_size):
+            k1 = min(k0 + group_size, num_repres)
+            tables = _RepresTables(weights, repre_seqs[k0:k1], num_bytes)
+            left = np.repeat(np.arange(end - start), k1 - k0)
+            right = np.tile(np.arange(k1 - k0), end - start)
+            partial = _bounded_sum(tables, left, right, bound_sq, byte_chunk, lambda l, r, b: packed[l, b])
+            partial = partial.reshape(end - start, k1 - k0)
+            # the first minimum per row, as argmin, the earlier group wins ties
+            index = np.argmin(partial, axis=1)
+            dist = partial[np.arange(end - start), index]
+            better = dist < best_dist
+            best_dist[better] = dist[better]
+            best_index[better] = index[better] + k0
+        best_dist = np.sqrt(np.maximum(best_dist, 0))  # the tables may round below 0 for equal vectors
+        if threshold is not None:
+            best_index[best_dist >= threshold] = -1
+        clu_array[start:end] = best_index
+        min_dist[start:end] = best_dist
+
+    starts = range(0, num_inst, block_size)
+    if n_threads > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(run_block, starts))
+    else:
+        for start in starts:
+            run_block(start)
+    return clu_array, min_dist
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+from scipy import sparse
+from scipy.cluster.hierarchy import linkage, fcluster
+from scipy.spatial.distance import pdist
+from .matcher import nearest_repres
+
+# ***********************************CODE USAGE GUIDE***************************************
+# Not directly used, should be invoked by cascading_clustering.clustering() when
+# "--cluster_backend canopy" is set in run.py
+#
+# canopy.py avoids the O(n^2) distance matrix of the whole sample. A leader pass splits the data
+# into canopies: a row becomes a leader if no leader is within the canopy radius, and every row
+# joins its nearest leader. Complete linkage then runs inside each canopy only, so each cluster
+# still has a diameter below threshold, as with the linkage backend. Canopies larger than
+# max_size are split again with half the radius; once the radius is at most threshold / 2 every
+# canopy is within threshold and becomes one cluster. Memory is bounded by max_size^2 distances.
+# ******************************************************************************************
+
+
+def leader_canopies(data, radius, block_size=4096):
+    """ split data into canopies around greedily chosen leaders.
+
+    Args:
+    --------
+    data: data matrix of (n, M), dense array or CSR matrix
+    radius: a row starts a new canopy if no leader is closer than radius
+    block_size: number of rows compared with the leaders at once
+
+    Returns:
+    --------
+    canopy_labels: canopy index of every row, canopy k is around the k-th leader
+    """
+
+    num_inst = data.shape[0]
+    leaders = np.zeros((0, data.shape[1]))
+    for start in range(0, num_inst, block_size):
+        block = data[start:start + block_size]
+        block = block.toarray() if sparse.issparse(block) else np.asarray(block, dtype=np.float64)
+        index, _ = nearest_repres(block, leaders, radius)
+        # rows far from every leader are scanned in order, each may become a new leader
+        new_leaders = []
+        for i in np.where(index == -1)[0]:
+            if new_leaders:
+                diff = np.asarray(new_leaders) - block[i]
+                if np.einsum('ij,ij->i', diff, diff).min() < radius * radius:
+                    continue
+            new_leaders.append(block[i])
+        if new_leaders:
+            leaders = np.vstack([leaders, new_leaders])
+
+    # every row joins its nearest leader
+    canopy_labels, _ = nearest_repres(data, leaders, block_size=block_size)
+    return canopy_labels
+
+
+def canopy_labels(data, threshold, max_size=5000, radius=None):
+    """ complete linkage clustering inside canopies, the same threshold semantics as fcluster.
+
+    Args:
+    --------
+    data: data matrix of (n, M), dense array or CSR matrix
+    threshold: distance threshold, every cluster has a diameter below threshold
+    max_size: largest canopy clustered with complete linkage, larger ones are split again
+    radius: canopy radius, threshold by default
+
+    Returns:
+    --------
+    cluster_labels: cluster index of every row, starting from 1 as returned by fcluster
+    """
+
+    num_inst = data.shape[0]
+    cluster_labels = np.zeros(num_inst, dtype=np.int64)
+    if radius is None:
+        radius = threshold
+    # every row is closer than radius to its leader, so with radius <= threshold / 2 a canopy has a
+    # diameter below threshold: complete linkage would merge it into one cluster anyway
+    single = False
+    if num_inst <= max_size:
+        groups = [np.arange(num_inst)]
+    else:
+        canopies = leader_canopies(data, radius)
+        order = np.argsort(canopies, kind='stable')
+        groups = np.split(order, np.searchsorted(canopies[order], np.arange(1, canopies.max() + 1)))
+        single = radius <= threshold / 2.0
+
+    next_label = 1
+    for rows in groups:
+        if len(rows) == 0:
+            continue
+        sub_data = data[rows]
+        if len(rows) == 1 or single:
+            sub_labels = np.ones(len(rows), dtype=np.int64)
+        elif len(rows) > max_size:
+            sub_labels = canopy_labels(sub_data, threshold, max_size, radius / 2)
+        else:
+            sub_data = sub_data.toarray() if sparse.issparse(sub_data) else np.asarray(sub_data, dtype=np.float64)
+            Z = linkage(pdist(sub_data, 'euclidean'), 'complete')
+            sub_labels = fcluster(Z, threshold, criterion='distance')
+        cluster_labels[rows] = sub_labels + next_label - 1
+        next_label += sub_labels.max()
+    return cluster_labels
@@ -7,11 +7,19 @@ import pickle
 import os
 import glob
 from scipy.cluster.hierarchy import linkage, fcluster
-from sklearn import linear_model
+from scipy import sparse
 import multiprocessing
-from scipy.spatial.distance import cdist, pdist
 import math
 from .util import *
+from .matcher import nearest_repres, RepresIndex
+from .canopy import canopy_labels
+from .pairwise import condensed_distances
+from .bitkernel import bits_condensed, bits_nearest
+from .writer import OutputWriter
+from .compact import WeightedRows, take_rows
+from .model import build_model, save_model
+from .weighting import RidgeStats, correlation_weights
+from . import metrics
 
 
 # ***********************************CODE USAGE GUIDE*********************************************
@@ -28,6 +36,7 @@ from .util import *
 # ************************************************************************************************
 
 
+@timeit
 def get_correlation_weight(event_occu_matrix, kpi_list):
     """ Calculate the correlation weight of each log event via linear regression
 
@@ -43,82 +52,354 @@ def get_correlation_weight(event_occu_matrix, kpi_list):
     print('KPI weighting calculation...')
 
     kpi_lists = np.array(kpi_list.flatten())
+    if sparse.issparse(event_occu_matrix):
+        event_occu_matrix = event_occu_matrix.toarray()
     num_inst, num_events = event_occu_matrix.shape
 
     print("event occurrance matrix is of size (%d, %d)" % (num_inst, num_events))
 
-    # use linear regression with L2 Norm to calculate the correlation weights.
-    reg = linear_model.Ridge(alpha=0.01, tol=0, max_iter=1000000)
-    kpi_lists = np.expand_dims(kpi_lists, axis=1)
-    reg.fit(event_occu_matrix, kpi_lists)
-    coefficient_list = reg.coef_[0]
+    # use linear regression with L2 Norm to calculate the correlation weights, solved in closed form
+    stats = RidgeStats(num_events, alpha=0.01)
+    for i in range(num_inst):
+        stats.add(i, event_occu_matrix[i], kpi_lists[i])
+    coefficient_list = stats.solve()
 
     # in case that coefficient is negative
-    correlation_weight_list = [x if x > 0 else 0.00001 for x in coefficient_list]
+    correlation_weight_list = correlation_weights(coefficient_list)
     return correlation_weight_list
 
 
 @timeit
-def weigh(raw_data, correlation_weight_list):
+def deduplicate(raw_data):
+    """ collapse bit-for-bit identical log sequence vectors into unique rows.
+
+    Args:
+    --------
+    raw_data: the big matrix of all log sequence vectors, dense array or CSR matrix.
+
+    Returns:
+    --------
+    unique_data: the unique rows, kept in the order of their first occurrence
+    counts: multiplicity of each unique row
+    inverse: for each original row, the index of its unique row, i.e. unique_data[inverse] == raw_data
+    """
+
+    num_inst = raw_data.shape[0]
+    if sparse.issparse(raw_data):
+        # a copy, eliminate_zeros() and sort_indices() work in place and must not touch the caller's matrix
+        raw_data = sparse.csr_matrix(raw_data, copy=True)
+        raw_data.eliminate_zeros()
+        raw_data.sort_indices()
+        # the rows are binary, so the column indexes of a row identify it: each row becomes its length
+        # followed by its sorted column indexes, padded with -1 to the longest row
+        lengths = np.diff(raw_data.indptr)
+        width = int(lengths.max()) if num_inst else 0
+        data = np.full((num_inst, width + 1), -1, dtype=np.int64)
+        data[:, 0] = lengths
+        rows = np.repeat(np.arange(num_inst), lengths)
+        data[rows, 1 + np.arange(len(rows)) - raw_data.indptr[rows]] = raw_data.indices
+    else:
+        data = np.ascontiguousarray(raw_data)
+    # hash each row as one opaque byte string
+    keys = data.view(np.dtype((np.void, data.dtype.itemsize * data.shape[1]))).ravel()
+    _, first_index, inverse, counts = np.unique(keys, return_index=True, return_inverse=True,
+                                                return_counts=True)
+    # renumber the unique rows by first occurrence
+    order = np.argsort(first_index)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    first_index, counts, inverse = first_index[order], counts[order], rank[inverse.ravel()]
+
+    unique_data = raw_data[first_index]
+    print('Deduplication: %d sequences collapsed into %d unique vectors' % (num_inst, unique_data.shape[0]))
+    return unique_data, counts, inverse
+
+
+@timeit
+def weigh(raw_data, correlation_weight_list, counts=None, doc_freq=None, compact=False):
     """ weighting the data with weights, important events are given more weights.
     Args:
     --------
-    allrawData: the big matrix of all log sequence vectors, obtained from loading_all_data()
+    allrawData: the big matrix of all log sequence vectors, obtained from loading_all_data(),
+                either a dense array or a scipy.sparse CSR matrix.
     corWeightList: correlation weights list, obtained from get_corr_weight()
+    counts: multiplicity of each row if allrawData was deduplicated, obtained from deduplicate()
+    doc_freq: number of sequences that contain each event, e.g. eveOccuMat.sum(axis=0) from loading,
+              counted from allrawData if not given
+    compact: see apply_weights()
 
     Returns:
     --------
     weightedData: weighting the log sequence matrix with IDF weights and correlation weights,
-                      as described in Section 3.2
+                      as described in Section 3.2. A CSR matrix is returned for sparse input.
     finalweightList: the final weights list, which combines IDF weights and correlation weights.
     """
 
     num_inst, num_events = raw_data.shape
 
-    # IDF weights calculation
-    weight_list = []
-    for j in range(num_events):
-        cnt = np.count_nonzero(raw_data[:, j])
-        weight_list.append(math.log((num_inst + 1) / (float(cnt) + 1)))
+    # IDF weights calculation, the count of non-zeros per event is read from the
+    # CSR structure directly in sparse mode
+    if counts is not None:
+        # every unique row stands for counts[i] original sequences
+        num_inst = int(np.sum(counts))
+    if doc_freq is not None:
+        cnt_list = np.asarray(doc_freq).ravel()
+    elif counts is not None:
+        cnt_list = (raw_data != 0).T.dot(counts)
+        cnt_list = np.asarray(cnt_list).ravel()
+    elif sparse.issparse(raw_data):
+        cnt_list = raw_data.getnnz(axis=0)
+    else:
+        cnt_list = np.count_nonzero(raw_data, axis=0)
+    final_weight_list = final_weights(num_inst, cnt_list, correlation_weight_list)
+
+    # weight the data with final weights.
+    weighted_data = apply_weights(raw_data, final_weight_list, compact)
+
+    return weighted_data, final_weight_list
+
+
+def final_weights(num_inst, cnt_list, correlation_weight_list):
+    """ combine the IDF weights and the correlation weights, the data itself is not needed.
+
+    Args:
+    --------
+    num_inst: number of log sequences
+    cnt_list: number of log sequences that contain each event
+    correlation_weight_list: correlation weights list, obtained from get_correlation_weight()
+
+    Returns:
+    --------
+    final_weight_list: the final weights list
+    """
+
+    weight_list = np.log((num_inst + 1) / (np.asarray(cnt_list, dtype=np.float64) + 1))
 
     weight_list -= np.mean(weight_list)
-    new_weight_list = np.array([1 / float(1 + np.exp(- x)) for x in weight_list])
+    new_weight_list = 1 / (1 + np.exp(- weight_list))
 
     # combine IDF weight and correlation weight,
     alpha = 0.8
     beta = 0.2
-    final_weight_list = beta * new_weight_list + alpha * np.array(correlation_weight_list)
+    return beta * new_weight_list + alpha * np.array(correlation_weight_list)
 
-    # weight the data with final weights.
-    weighted_data = np.multiply(raw_data, final_weight_list)
 
-    return weighted_data, final_weight_list
+def apply_weights(raw_data, final_weight_list, compact=False):
+    """ weight the log sequence matrix with the final weights obtained from weigh().
+
+    Args:
+    --------
+    raw_data: log sequence matrix, dense array or CSR matrix
+    final_weight_list: the final weights list
+    compact: return float32 weighted rows generated on demand instead of a weighted copy
+
+    Returns:
+    --------
+    weighted_data: the weighted log sequence matrix, a CSR matrix for sparse input, WeightedRows if compact
+    """
+
+    if compact:
+        return WeightedRows(raw_data, final_weight_list)
+    if sparse.issparse(raw_data):
+        return sparse.csr_matrix(raw_data.multiply(final_weight_list))
+    return np.multiply(raw_data, final_weight_list)
+
+
+def stride_index(raw_index, sample_rate, counts=None, inverse=None):
+    """ the rows of every sample_rate-th sequence of a round.
+
+    Without deduplication this is every sample_rate-th row. For rows obtained from deduplicate()
+    the stride runs over the sequences the rows stand for, so a frequent pattern is sampled as
+    often as its duplicates would be: with inverse over the original sequences of the round in
+    their order, which samples the same patterns as a run without "--dedup", else over the
+    multiplicities in counts.
+
+    Args:
+    --------
+    raw_index: rows of raw_data in the round
+    sample_rate: one sequence out of sample_rate is selected
+    counts: optional multiplicity of each row of raw_data
+    inverse: optional inverse index from deduplicate()
+
+    Returns:
+    --------
+    sample_index: the selected rows of the round, sorted and distinct
+    """
+
+    num_inst = len(raw_index)
+    if counts is None:
+        return np.arange(0, num_inst, sample_rate)
+    if inverse is None:
+        ends = np.cumsum(counts[raw_index])
+        positions = np.arange(0, ends[-1] if num_inst else 0, sample_rate)
+        return np.unique(np.searchsorted(ends, positions, side='right'))
+    rank = np.full(len(counts), -1, dtype=np.int64)
+    rank[raw_index] = np.arange(num_inst)
+    seq_rank = rank[inverse]
+    return np.unique(seq_rank[seq_rank >= 0][::sample_rate])
 
 
 @timeit
-def sampling(input_data, sample_rate):
+def sampling(input_data, sample_rate, sample_index=None):
     """ do randomly sampling from a large input_data with given sample_rate.
 
     Args:
     --------
-    input_data: input large data matrix to be sampled.
+    input_data: input large data matrix to be sampled, dense array or CSR matrix.
     sample_rate: sample percentage, integer number, e.g., 100 represents one is selected out of 100 data instances.
+    sample_index: optional rows to take instead of every sample_rate-th one, obtained from stride_index()
 
     Returns:
     --------
     sample_data: the sampled data
     """
 
-    sample_data = []
-    for i, line in enumerate(input_data):
-        if i % sample_rate == 0:
-            sample_data.append(line)
-    sample_data = np.array(sample_data)
+    if sample_index is None:
+        # every sample_rate-th row, slicing works for both dense arrays and CSR matrices
+        sample_data = input_data[::sample_rate]
+    else:
+        sample_data = input_data[sample_index]
     print('Step 3. Sampling with sample_rate %d, the original data size is %d, after sampling, the data size is %d' % (
         sample_rate, input_data.shape[0], sample_data.shape[0]))
     return sample_data
 
 
+def budget_sample_size(args, num_inst):
+    """ the largest sample the clustering step can handle within args.sample_budget_mb.
+
+    The linkage backend keeps the condensed distance matrix (8 bytes per pair, 4 with the float
+    kernel and "--dist_dtype float32") plus the float64 copy of it that linkage() works on, its (n - 1) x 4
+    result is negligible. The canopy backend only needs this for its largest canopy, so the sample
+    itself may be larger there.
+    """
+
+    dist_size = np.dtype(args.dist_dtype).itemsize if args.distance_kernel == 'float' else 8
+    budget_pairs = args.sample_budget_mb * 1024 * 1024 / float(dist_size + 8)
+    max_size = int((1 + math.sqrt(1 + 8 * budget_pairs)) / 2)
+    if args.cluster_backend == 'canopy':
+        max_size = max(max_size, 4 * args.canopy_size)
+    return min(num_inst, max(2, max_size))
+
+
+@timeit
+def budget_sampling(args, input_data, rng, counts=None, strata=None):
+    """ draw a random sample whose size is chosen from the memory budget of the clustering step.
+
+    Args:
+    --------
+    para: the dictionary of parameters, set in run.py
+    input_data: input large data matrix to be sampled, dense array or CSR matrix.
+    rng: numpy RandomState used for the draw
+    counts: optional multiplicity of each row, rows are then drawn with probability proportional to it
+    strata: optional stratum (e.g. KPI interval) of each row, each stratum gets a share of the sample
+            proportional to its size
+
+    Returns:
+    --------
+    sample_data: the sampled data
+    sample_index: rows of input_data in the sample, sorted
+    """
+
+    num_inst = input_data.shape[0]
+    sample_size = budget_sample_size(args, num_inst)
+    if sample_size >= num_inst:
+        sample_index = np.arange(num_inst)
+    else:
+        # weighted sampling without replacement: keep the rows with the smallest exponential keys
+        keys = rng.exponential(size=num_inst)
+        if counts is not None:
+            keys /= np.asarray(counts, dtype=np.float64)
+        quota = None
+        if strata is not None:
+            _, strata = np.unique(np.asarray(strata), return_inverse=True)
+            quota = stratum_quota(np.bincount(strata), sample_size, num_inst)
+        sample_index = smallest_keys(keys, sample_size, strata, quota)
+    sample_data = input_data[sample_index]
+    print('Step 3. Sampling within a budget of %g MB, the original data size is %d, after sampling, the data size '
+          'is %d (sample rate 1/%.1f)' % (args.sample_budget_mb, num_inst, len(sample_index),
+                                          num_inst / float(max(1, len(sample_index)))))
+    return sample_data, sample_index
+
+
+def stratum_quota(sizes, sample_size, num_inst):
+    """ the share of the sample of every stratum, proportional to its size and at least 1 """
+    return np.maximum(np.floor(np.asarray(sizes) * (sample_size / float(num_inst))), 1).astype(np.int64)
+
+
+def smallest_keys(keys, sample_size, strata=None, quota=None):
+    """ the rows with the sample_size smallest keys, or the quota[s] smallest of every stratum s.
+
+    The selection of a union of row sets equals the selection over the selections of its parts,
+    so it can also be applied to a stream chunk by chunk.
+
+    Args:
+    --------
+    keys: random key of each row
+    sample_size: number of rows kept without strata
+    strata: optional stratum of each row, from 0
+    quota: number of rows kept per stratum, used with strata
+
+    Returns:
+    --------
+    sample_index: the kept rows, sorted
+    """
+
+    num_inst = len(keys)
+    if strata is None:
+        if sample_size >= num_inst:
+            return np.arange(num_inst)
+        return np.sort(np.argpartition(keys, sample_size)[:sample_size])
+    sizes = np.bincount(strata, minlength=len(quota))
+    order = np.lexsort((keys, strata))
+    rank = np.arange(num_inst) - np.concatenate([[0], np.cumsum(sizes)[:-1]])[strata[order]]
+    return np.sort(order[rank < quota[strata[order]]])
+
+
+def sample_round(args, weight_data, raw_index, rng, counts=None, strata=None, inverse=None):
+    """ the sampling step of one cascading round, by the policy set in args.sample_policy.
+
+    Args:
+    --------
+    args: the parameters, set in run.py
+    weight_data: weighted data of the round
+    raw_index: rows of raw_data in weight_data
+    rng: numpy RandomState used by the budget policy
+    counts, strata: as passed to cascade_rounds(), indexed by raw_index
+    inverse: optional inverse index from deduplicate(), see stride_index()
+
+    Returns:
+    --------
+    sample_weight_data: the sampled data
+    sample_index: rows of weight_data in the sample
+    sample_rate: the effective sampling rate
+    """
+
+    if args.sample_policy == 'budget':
+        # the sample size follows the clustering budget, small data is clustered as a whole
+        sample_weight_data, sample_index = budget_sampling(
+            args, weight_data, rng, counts[raw_index] if counts is not None else None,
+            strata[raw_index] if strata is not None else None)
+        return sample_weight_data, sample_index, weight_data.shape[0] / float(len(sample_index))
+
+    # deduplicated rows are sampled by the number of sequences they stand for
+    num_seqs = int(np.sum(counts[raw_index])) if counts is not None else weight_data.shape[0]
+
+    # if mismatched data size is small(e.g., 1000), directly clustering without sampling.
+    sample_rate = 1
+    if num_seqs >= 1000:
+        sample_index = stride_index(raw_index, args.sample_rate, counts, inverse) if counts is not None else None
+        sample_weight_data = sampling(weight_data, args.sample_rate, sample_index)
+        sample_rate = args.sample_rate
+    else:
+        sample_weight_data = weight_data[:]
+
+    # if the sampled size is <= 1, directly clustering the original data, then the mismatched would be of size 0,
+    if sample_weight_data.shape[0] <= 1:
+        sample_weight_data = weight_data[:]
+        sample_rate = 1
+    return sample_weight_data, stride_index(raw_index, sample_rate, counts, inverse), sample_rate
+
+
 @timeit
 def clustering(args, data):
     """ cluster log sequence vectors into various clusters.
@@ -130,108 +411,158 @@ def clustering(args, data):
 
     Returns:
     --------
-    seq_clusters: list of lists, data of each cluster is stored in one list, various clusters composes a large list
+    cluster_labels: cluster index of each row of data, from 0 to the number of clusters - 1
     """
 
-    # calculate the distance between any two vectors
-    print('Step 4. Distance Calculation: start building distance matrix')
-    data_dist = dist_compute(data)
-
-    # check whether the number of distances is correct
     num_distances = data.shape[0]
-    if len(data_dist) != (num_distances - 1) * num_distances / 2:
-        print('Error distance matrix size, recomputing')
-        data_dist = dist_compute(data)
 
-    # special case handling: if only one vector in the data, no need to do clustering, directly return the data.
+    # special case handling: if only one vector in the data, no need to do clustering.
     if num_distances == 1:
-        return [[data[0]]]
+        return np.zeros(1, dtype=np.int64)
 
-    # use hierarchical clustering
-    print('Step 5. Clustering, start hierarchical clustering')
-    Z = linkage(data_dist, 'complete')
-    cluster_labels = fcluster(Z, args.threshold, criterion='distance')
-    num_clusters = len(set(cluster_labels))
+    if args.cluster_backend == 'canopy':
+        # complete linkage inside threshold-bounded canopies, no full distance matrix
+        print('Step 4-5. Clustering, start canopy pre-clustering and local hierarchical clustering')
+        cluster_labels = canopy_labels(data, args.threshold, args.canopy_size)
+    else:
+        # calculate the distance between any two vectors
+        print('Step 4. Distance Calculation: start building distance matrix')
+        data_dist = dist_compute(data, args.dist_threads, args.distance_kernel, args.threshold, args.dist_dtype)
+
+        # use hierarchical clustering
+        print('Step 5. Clustering, start hierarchical clustering')
+        Z = linkage(data_dist, 'complete')
+        cluster_labels = fcluster(Z, args.threshold, criterion='distance')
+    num_clusters = cluster_labels.max()
     print('------there are altogether ## %d ## clusters in current clustering' % (num_clusters))
+    return np.asarray(cluster_labels, dtype=np.int64) - 1
 
-    # get cluster list
-    seq_clusters = [[] for _ in range(num_clusters)]
-    for i, ci in enumerate(cluster_labels):
-        seq_clusters[ci - 1].append(data[i])
-    return seq_clusters
 
-
-def repres_extracting(seq_clusters):
-    """ extract the representative vector for each cluster of data.
+def repres_extracting(data, cluster_labels, counts=None):
+    """ extract the representative vector for each cluster of data, i.e. the mean of its rows.
 
     Args:
     --------
-    seq_clusters: list of clusters of sequence data
+    data: the data matrix used for clustering, dense array or CSR matrix
+    cluster_labels: cluster index of each row, obtained from clustering()
+    counts: optional multiplicity of each row, the representative is then the mean over all
+            original sequences rather than over the unique rows. Complete linkage is not affected
+            by duplicates, so only the representatives need the multiplicities.
 
     Returns:
     --------
-    repre_seqs: list of representatives
+    repre_seqs: array of representatives, one row per cluster
     """
-    repre_seqs = []
-    for clu in seq_clusters:
-        repre_seqs.append(np.mean(clu, axis=0))
-    repre_seqs = np.array(repre_seqs)
+
+    num_clusters = int(cluster_labels.max()) + 1
+    weights = np.ones(len(cluster_labels)) if counts is None else np.asarray(counts, dtype=np.float64)
+
+    # grouped sums as one product with the (clusters x rows) membership matrix
+    membership = sparse.csr_matrix((weights, (cluster_labels, np.arange(len(cluster_labels)))),
+                                   shape=(num_clusters, len(cluster_labels)))
+    sums = membership @ data
+    sums = sums.toarray() if sparse.issparse(sums) else np.asarray(sums, dtype=np.float64)
+    sizes = np.bincount(cluster_labels, weights=weights, minlength=num_clusters)
+    repre_seqs = sums / sizes[:, None]
     return repre_seqs
 
 
 @timeit
-def matching(args, weight_data, repre_seqs, curr_file_index, raw_index, raw_data):
+def matching(args, weight_data, repre_seqs, raw_index):
     """ match all weighted data (1st round) or mismatched data (other rounds) with cluster representatives.
 
     Args:
     --------
     para: the dictionary of parameters, set in run.py
     weight_data: weighted sequence data, can be all weighted data (1st round) or mismatched data (other rounds).
-    repre_seqs: list of extracted representative per cluster.
-    curfileIndex: index used for file naming when saving each cluster into a file
+    repre_seqs: list of extracted representative per cluster, or a RepresIndex built over them.
     raw_index: store the sequence index in the raw data, used when saving cluster into files,
                 obtained in loading_all_data()
-    raw_data: unweighted raw data. it is used for saving into files, raw data are saved without weighting.
 
     Returns:
     --------
-    mismatch_index: index for mismatched data
+    mismatch_index: index array for mismatched data
     mismatch_data: mismatched data
-    curfileIndex: updated curfileIndex
-    new_raw_index: updated raw_index where the matched index are removed.
-    clu_result: the obtained cluster for each sequence data
+    new_raw_index: updated raw_index array where the matched index are removed.
+    clu_result: the obtained cluster for each sequence data, pairs of (raw index, cluster index)
     """
 
     print("Step 6. Matching, start matching with original data", weight_data.shape)
 
-    # calculate the distances among weighted data and representative list,
-    # find the nearest cluster for each sequence data
+    clu_array = nearest_cluster(args, weight_data, repre_seqs)
 
-    distance_matrix = cdist(weight_data, repre_seqs)
-    min_index_list = np.argmin(distance_matrix, axis=1)
-    valid_min_list = distance_matrix[np.arange(len(min_index_list)), min_index_list] < args.threshold
+    raw_index = np.asarray(raw_index, dtype=np.int64)
+    clu_result = np.column_stack([raw_index, clu_array])
 
-    clu_array = np.array([min_index_list[i] if x else -1 for i, x in enumerate(valid_min_list)])
+    # get the mismatched data with its index
+    mismatch_index = np.flatnonzero(clu_array == -1)  # mismatched sequence indexes
+    new_raw_index = raw_index[mismatch_index]
+    mismatch_data = take_rows(weight_data, mismatch_index)
+    return mismatch_index, mismatch_data, new_raw_index, clu_result
 
-    clu_result = np.array(np.vstack([raw_index, clu_array]).T)
 
-    # get the mismatched data with its index
-    if -1 in clu_array:
-        mismatch_index = np.where(clu_array == -1)[0]  # mismatched sequence indexes
+def nearest_cluster(args, weight_data, repre_seqs):
+    """ the nearest representative of every row within args.threshold, -1 if there is none.
+
+    Args:
+    --------
+    args: the parameters, set in run.py
+    weight_data: weighted sequence data
+    repre_seqs: array of representatives, or a RepresIndex built over them
+
+    Returns:
+    --------
+    clu_array: index of the nearest representative per row, -1 for mismatched rows
+    """
+
+    # find the nearest cluster for each sequence data block by block, sequences whose nearest
+    # representative is not within the threshold are marked as -1
+    if args.match_index and not isinstance(repre_seqs, RepresIndex):
+        repre_seqs = RepresIndex(repre_seqs)
+    if isinstance(repre_seqs, RepresIndex):
+        clu_array, _ = repre_seqs.query(weight_data, args.threshold, args.match_block_size, args.match_threads)
+    elif args.match_bits:
+        clu_array, _ = bits_nearest(weight_data, repre_seqs, args.threshold, args.match_block_size,
+                                    args.match_threads)
     else:
-        mismatch_index = []
-    new_raw_index = [raw_index[i] for i in mismatch_index]
-    mismatch_data = np.array([weight_data[i] for i in mismatch_index])
+        clu_array, _ = nearest_repres(weight_data, repre_seqs, args.threshold, args.match_block_size,
+                                      args.match_threads)
+    return clu_array
+
 
-    # choose whether to save the matched clusters into files, set in run.py. Although multiprocessing is applied,
-    # This costs a lot, turn it off if not needed. False by default
-    if args.save_file:
-        curr_file_index = save_matching(args, raw_data, clu_array, curr_file_index, raw_index)
-    return mismatch_index, mismatch_data, curr_file_index, new_raw_index, clu_result
+def cascade(args, raw_data, raw_index, weight_data, counts=None, inverse=None, strata=None, final_weight_list=None,
+            known_repres=None, checkpoint=None):
+    """ the main function of cascading clustering, runs cascade_rounds() and saves all representatives.
 
+    Args:
+    --------
+    same as cascade_rounds()
+    final_weight_list: the final weights list obtained from weigh(), if given the model artefact is saved too
 
-def cascade(args, raw_data, raw_index, weight_data):
-    """ the main function of cascading clustering, the iterative process is defined here.
+    Returns:
+    --------
+    final_clustering_result: the final clustering results, in the original row order.
+                             label k is the k-th row of repre_seqs.csv
+    """
+
+    final_clustering_result, all_repres = cascade_rounds(args, raw_data, raw_index, weight_data, counts, inverse,
+                                                         strata, known_repres, checkpoint)
+    save_repres(args, all_repres, final_weight_list)
+    return final_clustering_result
+
+
+def save_repres(args, all_repres, final_weight_list=None):
+    """ save all representatives to repre_seqs.csv, and the model artefact if the weights are given """
+    np.savetxt(args.rep_path + 'repre_seqs.csv', np.array(all_repres), fmt='%f', delimiter=',')
+    if final_weight_list is not None:
+        save_model(args.rep_path, build_model(final_weight_list, all_repres, args.threshold))
+
+    print('====================there are ## %d ## clusters==================' % len(all_repres))
+
+
+def cascade_rounds(args, raw_data, raw_index, weight_data, counts=None, inverse=None, strata=None, known_repres=None,
+                   checkpoint=None):
+    """ the iterative process of cascading clustering: sampling, clustering, matching.
 
     Args:
     --------
@@ -239,105 +570,164 @@ def cascade(args, raw_data, raw_index, weight_data):
     raw_data: unweighted raw data. it is used for saving into files, raw data are saved without weighting.
     weight_data: weighted sequence data, can be all weighted data (1st round) or mismatched data (other rounds).
     rawIndex: store the sequence index in the raw data, used when saving cluster into files, obtained in loading_all_data()
+    counts: multiplicity of each row, if raw_data holds the unique rows obtained from deduplicate()
+    inverse: inverse index from deduplicate(), maps every original sequence to its unique row
+    strata: optional stratum (KPI interval) of each row of raw_data, used by the budget sampling policy
+    known_repres: optional representatives of a previous run (warm start), all data is matched against them
+                  first as round 0 and keeps their labels, only the residual is sampled and clustered
+    checkpoint: optional checkpoint.Checkpoint, the state is saved after every round and the cascade
+                continues after the last completed round saved in it
 
     Returns:
     --------
-    final_clustering_result: the final clustering results
+    final_clustering_result: the final clustering results, in the original row order
+    all_repres: array of all representatives, label k of final_clustering_result is all_repres[k]
     """
 
     # initialize some parameters and variables, get the saving folder ready if needed.
     max_cascading_num = 100  # maximum number of cascading rounds, user can early stop the process if setting a small value, process all data if it is a large value
 
-    current_file_index = 0  # current file index, used for saving
-    all_repres = []  # store all representatives
+    # the results of each round are written in the background while cascading continues, set in run.py
+    writer = OutputWriter(args.output_path, raw_data, inverse) if args.save_file else None
+    round_repres = []  # representatives found in each round
 
-    overclu_res = []  # temp used to save clustering results
+    # one global label array written in place each round, label k refers to the k-th representative
+    final_clustering_result = np.full(raw_data.shape[0], -1, dtype=np.int64)
+    raw_index = np.asarray(raw_index, dtype=np.int64)
+    label = 0
+    rng = np.random.RandomState(args.sample_seed)
+    # rows of the first round's weight_data that are still mismatched, kept for the checkpoints
+    all_weight_data = weight_data
+    residual_pos = np.arange(weight_data.shape[0])
+
+    def save_checkpoint(round):
+        if writer is not None:
+            writer.flush()  # the round files come before the checkpoint that skips the round
+        checkpoint.save_round(round, {'residual_pos': residual_pos, 'residual_index': raw_index,
+                                      'labels': final_clustering_result, 'repres': np.vstack(round_repres),
+                                      'round_sizes': [len(r) for r in round_repres], 'rng': rng})
+
+    first_round = 0
+    last_round, state = checkpoint.load_round() if checkpoint is not None else (None, None)
+    if state is not None:
+        # resume: restore the state after the last completed round
+        round_repres = np.split(state['repres'], np.cumsum(state['round_sizes'])[:-1])
+        final_clustering_result = state['labels']
+        label = int(np.sum(state['round_sizes']))
+        rng = state['rng']
+        residual_pos = state['residual_pos']
+        raw_index = state['residual_index']
+        weight_data = take_rows(all_weight_data, residual_pos)
+        first_round = last_round + 1
+        print('resuming after round %d, %d representatives, %d rows left' % (last_round, label, len(raw_index)))
+    elif known_repres is not None and len(known_repres) > 0:
+        # warm start: the known representatives are the clusters of round 0
+        print('==========round 0 (known representatives)========')
+        metrics.set_round(0)
+        with metrics.stage('cascade_round', event='round', input_size=weight_data.shape[0]) as round_record:
+            round_repres.append(np.asarray(known_repres))
+            mismatch_index, mismatch_data, new_raw_index, clu_result = matching(args, weight_data, known_repres,
+                                                                                raw_index)
+            matched = clu_result[:, 1] != -1
+            final_clustering_result[clu_result[matched, 0]] = clu_result[matched, 1]
+            if writer is not None:
+                writer.submit(0, clu_result[:, 0], clu_result[:, 1], 0)
+            label = len(known_repres)
+            round_record.update(clusters=label, matched=int(matched.sum()),
+                                matched_fraction=float(matched.mean()) if len(matched) else 0.0,
+                                residual_size=mismatch_data.shape[0])
+        weight_data = mismatch_data
+        raw_index = new_raw_index
+        residual_pos = residual_pos[mismatch_index]
+        first_round = 1
+        if checkpoint is not None:
+            save_checkpoint(0)
 
     # start cascading clustering, sampling, clustering, matching.
-    for round in range(max_cascading_num):
+    for round in range(first_round, max_cascading_num):
+        if weight_data.shape[0] == 0:
+            break
         print('==========round %d========' % round)
-        # Sampling Step
-        # if mismatched data size is small(e.g., 1000), directly clustering without sampling.
-        if weight_data.shape[0] >= 1000:
-            sample_weight_data = sampling(weight_data, args.sample_rate)
-        else:
-            sample_weight_data = weight_data
-
-        # if the sampled size is <= 1, directly clustering the original data, then the mismatched would be of size 0,
-        if sample_weight_data.shape[0] <= 1:
-            sample_weight_data = weight_data
-
-        # Clustering Step, and extract representatives and add into all_repres
-        seq_clusters = clustering(args, sample_weight_data)
-
-        repre_seqs = repres_extracting(seq_clusters)
-        all_repres.extend(repre_seqs)
-
-        # Matching Step, save the clustering results
-        _, mismatch_data, current_file_index, raw_index, clu_result = matching(args, weight_data,
-                                                                                            repre_seqs,
-                                                                                            current_file_index,
-                                                                                            raw_index, raw_data)
-        overclu_res.append(clu_result)
+        metrics.set_round(round)
+        with metrics.stage('cascade_round', event='round', input_size=weight_data.shape[0]) as round_record:
+            # Sampling Step
+            sample_weight_data, sample_index, sample_rate = sample_round(args, weight_data, raw_index, rng, counts,
+                                                                         strata, inverse)
+
+            # Clustering Step, and extract representatives
+            cluster_labels = clustering(args, sample_weight_data)
+            sample_counts = counts[raw_index[sample_index]] if counts is not None else None
+            repre_seqs = repres_extracting(sample_weight_data, cluster_labels, sample_counts)
+            round_repres.append(repre_seqs)
+
+            # Matching Step, write the labels of the matched rows in place
+            mismatch_index, mismatch_data, new_raw_index, clu_result = matching(args, weight_data, repre_seqs,
+                                                                                raw_index)
+            matched = clu_result[:, 1] != -1
+            final_clustering_result[clu_result[matched, 0]] = clu_result[matched, 1] + label
+            if writer is not None:
+                writer.submit(round, clu_result[:, 0], clu_result[:, 1], label)
+            label = label + len(repre_seqs)
+
+            round_record.update(sample_rate=sample_rate, sample_size=sample_weight_data.shape[0],
+                                clusters=len(repre_seqs), matched=int(matched.sum()),
+                                matched_fraction=float(matched.mean()) if len(matched) else 0.0,
+                                residual_size=mismatch_data.shape[0])
 
         # Mismatched data will be processed again.
         weight_data = mismatch_data
-        final_remain_index = raw_index
+        raw_index = new_raw_index
+        residual_pos = residual_pos[mismatch_index]
+        if checkpoint is not None:
+            save_checkpoint(round)
         if mismatch_data.shape[0] == 0:
             print('cascading stopped as no data left as mismatched.')
             break
+    metrics.set_round(None)
 
+    final_remain_index = raw_index
+    all_repres = np.vstack(round_repres)
     print('In the end, %d are remian as not matched' % len(final_remain_index))
 
     # save the mismatched data if any. usually, if no early stopping,
     # all data can be processed and clustered, no remaining data.
-    if args.save_file:
-        file = open(args.output_path + '/' + 'mismatch.csv', 'w')
-        for j in final_remain_index:
-            file.write(str(j) + '\t')
-            strvec = list(map(str, raw_data[j]))
-            file.writelines(' '.join(strvec))
-            file.write('\n')
-
-    # get the final cluster index for each sequence data.
-    final_clustering_result = -1 * np.ones((raw_data.shape[0]))
-    label = 0
-    for res in overclu_res:
-        label_list = res[:, 1]
-        cluster_size = len(set(label_list))
-        for i, va in res:
-            if final_clustering_result[i] == -1 and va != -1:
-                final_clustering_result[i] = va + label
-        if -1 in label_list:
-            label = label + cluster_size - 1
-        else:
-            print("no -1 in labelList, program will stop")
-    print("the final cluster number is %d" % len(set(final_clustering_result)))
-    if len(set(final_clustering_result)) != len(all_repres):
+    if writer is not None:
+        writer.submit_mismatch(final_remain_index)
+        writer.close()
+
+    num_labels = len(np.unique(final_clustering_result))
+    print("the final cluster number is %d" % num_labels)
+    # known representatives of a warm start may match nothing, every new one matches its cluster
+    if num_labels != len(all_repres) and (known_repres is None or
+                                          num_labels < len(all_repres) - len(known_repres)):
         print('error clustering results!!!')
-    if -1 in final_clustering_result:
+    if (final_clustering_result == -1).any():
         print('remaining -1 in finalcluresult')
 
-    # save all representatives
-    np.savetxt(args.rep_path + 'repre_seqs.csv', np.array(all_repres), fmt='%f', delimiter=',')
+    # expand the labels of the unique rows back to the original row order
+    if inverse is not None:
+        final_clustering_result = final_clustering_result[inverse]
 
-    print('====================there are ## %d ## clusters==================' % len(all_repres))
-    return final_clustering_result
+    return final_clustering_result, all_repres
 
 
-def dist_compute(data):
+def dist_compute(data, n_threads=1, kernel='float', threshold=None, dtype=np.float64):
     """ calculate the distance between any two vectors in a matrix.
 
     Args:
     --------
     data: the data matrix whose distances will be calculated.
+    n_threads: number of threads computing the distances
+    kernel: "float" for euclidean distances of any vectors, "bits" for weighted binary vectors
+    threshold: with the bits kernel, distances above threshold are not computed exactly
+    dtype: dtype of the float kernel's output, float32 halves the distance matrix
 
     Returns:
     --------
-    dist_list: flatten distance list
+    dist_list: flatten distance list, non-negative, of length n * (n - 1) / 2
     """
 
-    dis = pdist(data, 'euclidean')
-    zeroarray = np.zeros(len(dis))
-    dist_list = np.maximum(dis, zeroarray)  # to avoid negative distance
-    return dist_list
+    if kernel == 'bits':
+        return bits_condensed(data, threshold, n_threads)
+    return condensed_distances(data, n_threads, dtype=dtype)
+
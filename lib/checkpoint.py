@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import numpy as np
+from scipy import sparse
+
+# ***********************************CODE USAGE GUIDE***************************************
+# Not directly used, should be invoked by run.py and cascading_clustering.cascade_rounds()
+# when "--checkpoint_dir" is set
+#
+# checkpoint.py lets a long cascade be resumed after an interruption. The checkpoint folder holds
+#   data/         the loaded (and deduplicated) raw data, its row index, counts, inverse index,
+#                 strata, file offsets, the final event weights and the representatives of a warm
+#                 start, written once before the first round
+#   round_<n>/    the state after round n: the residual rows, the labels of all rows, all
+#                 representatives found so far, the number found per round and the RNG state
+#   LATEST        the number of the last completed round, replaced atomically after a round
+#                 folder is complete, so an interrupted write is never picked up
+#   .log3c_checkpoint marks the folder as a checkpoint; a new run only clears the entries above,
+#                 and refuses a non-empty folder that is not a checkpoint
+# Every array is a plain .npy file (a CSR matrix is kept as its three arrays), so the raw data
+# is memory-mapped on resume instead of being read again. "--resume" skips loading, weight
+# fitting and the finished rounds and continues with the next round.
+# ******************************************************************************************
+
+DATA_DIR = 'data'
+LATEST_NAME = 'LATEST'
+META_NAME = 'meta.json'
+MARKER_NAME = '.log3c_checkpoint'
+# the parameters that change the rounds, a checkpoint only resumes with the same values
+ROUND_PARAMS = ['threshold', 'sample_rate', 'sample_policy', 'sample_budget_mb', 'sample_seed', 'stratify',
+                'sparse', 'compact', 'dedup', 'cluster_backend', 'canopy_size', 'distance_kernel', 'dist_dtype',
+                'warm_start']
+
+
+def _save_array(folder, name, array):
+    if array is not None:
+        np.save(os.path.join(folder, name + '.npy'), np.asarray(array))
+
+
+def _load_array(folder, name, mmap_mode=None):
+    path = os.path.join(folder, name + '.npy')
+    return np.load(path, mmap_mode=mmap_mode) if os.path.exists(path) else None
+
+
+def _is_own_entry(name):
+    return name in (DATA_DIR, DATA_DIR + '.tmp', LATEST_NAME, LATEST_NAME + '.tmp', MARKER_NAME) or \
+        name.startswith('round_')
+
+
+def is_clearable(path):
+    """ whether a new checkpoint may be written to path: it is missing, empty or already a checkpoint """
+    if not os.path.isdir(path) or not os.listdir(path):
+        return True
+    # checkpoints written before the marker existed are recognized by their data or LATEST file
+    return any(os.path.exists(os.path.join(path, name))
+               for name in (MARKER_NAME, LATEST_NAME, os.path.join(DATA_DIR, META_NAME)))
+
+
+class Checkpoint(object):
+    """ the checkpoint folder of one cascade run. """
+
+    def __init__(self, path):
+        """ use path as checkpoint folder, it is created if needed.
+
+        Args:
+        --------
+        path: the checkpoint folder, "--checkpoint_dir" in run.py
+        """
+
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def latest_round(self):
+        """ the last completed round, None if no round was completed """
+        latest_path = os.path.join(self.path, LATEST_NAME)
+        if not os.path.exists(latest_path):
+            return None
+        with open(latest_path) as f:
+            return int(f.read().strip())
+
+    def save_data(self, args, file_list, raw_data, raw_index, final_weight_list, counts=None, inverse=None,
+                  strata=None, offsets=None, known_repres=None):
+        """ write the inputs of the cascade and drop the data and rounds of an earlier run.
+
+        Only the entries written by this module are removed, a non-empty folder that is not a
+        checkpoint raises IOError.
+
+        Args:
+        --------
+        args: the parameters, set in run.py
+        file_list: the sequence files that were loaded
+        raw_data, raw_index, counts, inverse, strata: as passed to cascade_rounds()
+        final_weight_list: the final weights list obtained from weigh()
+        offsets: row offsets of the sequence files, obtained from load_all_data()
+        known_repres: the representatives of a warm start, as passed to cascade_rounds()
+        """
+
+        if not is_clearable(self.path):
+            raise IOError('%s is not empty and holds no checkpoint, refusing to clear it' % self.path)
+        for name in os.listdir(self.path):
+            full_path = os.path.join(self.path, name)
+            if not _is_own_entry(name):
+                continue
+            if os.path.isdir(full_path):
+                shutil.rmtree(full_path)
+            else:
+                os.remove(full_path)
+        open(os.path.join(self.path, MARKER_NAME), 'w').close()
+        tmp_dir = os.path.join(self.path, DATA_DIR + '.tmp')
+        os.makedirs(tmp_dir)
+        if sparse.issparse(raw_data):
+            raw_data = sparse.csr_matrix(raw_data)
+            _save_array(tmp_dir, 'raw_data', raw_data.data)
+            _save_array(tmp_dir, 'raw_indices', raw_data.indices)
+            _save_array(tmp_dir, 'raw_indptr', raw_data.indptr)
+        else:
+            _save_array(tmp_dir, 'raw_data', raw_data)
+        _save_array(tmp_dir, 'raw_index', np.asarray(raw_index, dtype=np.int64))
+        _save_array(tmp_dir, 'final_weights', final_weight_list)
+        _save_array(tmp_dir, 'counts', counts)
+        _save_array(tmp_dir, 'inverse', inverse)
+        _save_array(tmp_dir, 'strata', strata)
+        _save_array(tmp_dir, 'offsets', offsets)
+        _save_array(tmp_dir, 'known_repres', known_repres)
+        meta = {'files': list(file_list), 'shape': list(raw_data.shape), 'sparse': bool(sparse.issparse(raw_data)),
+                'params': dict((name, getattr(args, name, None)) for name in ROUND_PARAMS)}
+        with open(os.path.join(tmp_dir, META_NAME), 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp_dir, os.path.join(self.path, DATA_DIR))
+
+    def load_data(self, args):
+        """ the inputs of the cascade written by save_data(), the raw data is memory-mapped.
+
+        Returns:
+        --------
+        file_list: the sequence files that were loaded
+        raw_data, raw_index, counts, inverse, strata: as passed to cascade_rounds()
+        final_weight_list: the final weights list
+        offsets: row offsets of the sequence files
+        known_repres: the representatives of a warm start, None without one
+        """
+
+        folder = os.path.join(self.path, DATA_DIR)
+        if not os.path.exists(os.path.join(folder, META_NAME)):
+            raise IOError('no checkpoint data in %s' % self.path)
+        with open(os.path.join(folder, META_NAME)) as f:
+            meta = json.load(f)
+        changed = [name for name in ROUND_PARAMS if meta['params'].get(name) != getattr(args, name, None)]
+        if changed:
+            raise ValueError('the checkpoint in %s was written with other %s' % (self.path, ', '.join(changed)))
+        raw_data = _load_array(folder, 'raw_data', mmap_mode='r')
+        if meta['sparse']:
+            raw_data = sparse.csr_matrix((raw_data, _load_array(folder, 'raw_indices', mmap_mode='r'),
+                                          _load_array(folder, 'raw_indptr', mmap_mode='r')),
+                                         shape=tuple(meta['shape']), copy=False)
+        return (meta['files'], raw_data, _load_array(folder, 'raw_index'), _load_array(folder, 'counts'),
+                _load_array(folder, 'inverse'), _load_array(folder, 'strata'), _load_array(folder, 'final_weights'),
+                _load_array(folder, 'offsets'), _load_array(folder, 'known_repres'))
+
+    def save_round(self, round, state):
+        """ write the state after round and mark the round as completed.
+
+        Args:
+        --------
+        round: the number of the completed round
+        state: dictionary with the arrays residual_pos (rows of the first round's weight_data still
+               mismatched), residual_index, labels, repres and round_sizes, and rng, a RandomState
+        """
+
+        round_dir = os.path.join(self.path, 'round_%d' % round)
+        if os.path.exists(round_dir):
+            shutil.rmtree(round_dir)
+        os.makedirs(round_dir)
+        for name in ('residual_pos', 'residual_index', 'labels', 'repres', 'round_sizes'):
+            _save_array(round_dir, name, state[name])
+        rng_name, rng_keys, rng_pos, rng_has_gauss, rng_gauss = state['rng'].get_state()
+        _save_array(round_dir, 'rng_keys', rng_keys)
+        with open(os.path.join(round_dir, 'rng.json'), 'w') as f:
+            json.dump({'name': rng_name, 'pos': int(rng_pos), 'has_gauss': int(rng_has_gauss),
+                       'gauss': float(rng_gauss)}, f)
+
+        # the round only counts once LATEST points to it, then the previous round is dropped
+        previous = self.latest_round()
+        tmp_path = os.path.join(self.path, LATEST_NAME + '.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write('%d\n' % round)
+        os.replace(tmp_path, os.path.join(self.path, LATEST_NAME))
+        if previous is not None and previous != round:
+            shutil.rmtree(os.path.join(self.path, 'round_%d' % previous), ignore_errors=True)
+
+    def load_round(self):
+        """ the state of the last completed round, see save_round().
+
+        Returns:
+        --------
+        round: the number of the last completed round, None if there is none
+        state: the dictionary given to save_round(), None if there is none
+        """
+
+        round = self.latest_round()
+        if round is None:
+            return None, None
+        round_dir = os.path.join(self.path, 'round_%d' % round)
+        state = dict((name, _load_array(round_dir, name))
+                     for name in ('residual_pos', 'residual_index', 'labels', 'repres', 'round_sizes'))
+        with open(os.path.join(round_dir, 'rng.json')) as f:
+            rng_state = json.load(f)
+        rng = np.random.RandomState()
+        rng.set_state((rng_state['name'], _load_array(round_dir, 'rng_keys'), rng_state['pos'],
+                       rng_state['has_gauss'], rng_state['gauss']))
+        state['rng'] = rng
+        return round, state
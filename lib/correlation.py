@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse, stats
+from .util import load_kpi
+
+# ***********************************CODE USAGE GUIDE***************************************
+# Not directly used, should be invoked by run.py when "--correlate" is set
+#
+# correlation.py is the last step of Log3C, the correlation analysis between the clusters and
+# the KPI. The per-file row offsets of load_all_data() give the time interval of every
+# sequence, so the final labels turn into a sparse (clusters, intervals) count matrix. Every
+# cluster's time series is correlated with the KPI list in one pass of sparse products:
+#   r = cov(x, kpi) / (std(x) * std(kpi)),  slope = cov(x, kpi) / var(x)
+# with a two-sided t-test of r and Benjamini-Hochberg q-values over all clusters. Clusters whose
+# occurrences rise with the KPI come first in rep_path/cluster_kpi_correlation.csv.
+# ******************************************************************************************
+
+RESULT_NAME = 'cluster_kpi_correlation.csv'
+
+
+def interval_counts(final_clustering_result, offsets, num_clusters=None):
+    """ number of sequences of every cluster in every time interval.
+
+    Args:
+    --------
+    final_clustering_result: the final clustering results, in the original row order, -1 for mismatched rows
+    offsets: rows offsets[i]:offsets[i + 1] belong to the i-th interval, obtained from load_all_data()
+    num_clusters: number of clusters, the largest label + 1 by default
+
+    Returns:
+    --------
+    count_matrix: CSR matrix of (num_clusters, num_intervals)
+    """
+
+    labels = np.asarray(final_clustering_result, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    num_intervals = len(offsets) - 1
+    if num_clusters is None:
+        num_clusters = int(labels.max()) + 1 if len(labels) else 0
+    intervals = np.repeat(np.arange(num_intervals), np.diff(offsets))
+    matched = labels >= 0
+    # a dense bincount over all (interval, cluster) pairs would need num_intervals * num_clusters
+    # counters, the distinct pairs are counted instead; keys are ordered by interval, then cluster
+    keys, counts = np.unique(intervals[matched] * num_clusters + labels[matched], return_counts=True)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(keys // max(num_clusters, 1), minlength=num_intervals))])
+    interval_major = sparse.csr_matrix((counts, keys % max(num_clusters, 1), indptr),
+                                       shape=(num_intervals, num_clusters))
+    return interval_major.T.tocsr()
+
+
+def correlate(count_matrix, kpi_list):
+    """ correlate the time series of every cluster with the KPI.
+
+    Args:
+    --------
+    count_matrix: (num_clusters, num_intervals) counts obtained from interval_counts()
+    kpi_list: the list of KPIs, one per interval, obtained from load_kpi()
+
+    Returns:
+    --------
+    result: DataFrame with one row per cluster: cluster, sequences, intervals, correlation, slope,
+            t_value, p_value and q_value, sorted by correlation, most positive first
+    """
+
+    kpi = np.asarray(kpi_list, dtype=np.float64).ravel()
+    num_clusters, num_intervals = count_matrix.shape
+    if len(kpi) != num_intervals:
+        raise ValueError('%d KPI values for %d intervals' % (len(kpi), num_intervals))
+    count_matrix = sparse.csr_matrix(count_matrix, dtype=np.float64)
+
+    # moments of every row from sparse products, the KPI is centered so cov needs no mean of x
+    kpi_centered = kpi - kpi.mean()
+    kpi_var = np.mean(kpi_centered ** 2)
+    total = np.asarray(count_matrix.sum(axis=1)).ravel()
+    mean = total / num_intervals
+    var = np.asarray(count_matrix.multiply(count_matrix).sum(axis=1)).ravel() / num_intervals - mean ** 2
+    var = np.maximum(var, 0)
+    cov = count_matrix.dot(kpi_centered) / num_intervals
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation = np.where((var > 0) & (kpi_var > 0), cov / np.sqrt(var * kpi_var), 0.0)
+        correlation = np.clip(correlation, -1, 1)
+        slope = np.where(var > 0, cov / var, 0.0)
+        dof = num_intervals - 2
+        t_value = correlation * np.sqrt(dof / np.maximum(1 - correlation ** 2, 1e-300)) if dof > 0 \
+            else np.zeros(num_clusters)
+    p_value = 2 * stats.t.sf(np.abs(t_value), dof) if dof > 0 else np.ones(num_clusters)
+
+    result = pd.DataFrame({'cluster': np.arange(num_clusters), 'sequences': total.astype(np.int64),
+                           'intervals': count_matrix.getnnz(axis=1), 'correlation': correlation,
+                           'slope': slope, 't_value': t_value, 'p_value': p_value,
+                           'q_value': benjamini_hochberg(p_value)})
+    return result.sort_values(['correlation', 'cluster'], ascending=[False, True], kind='mergesort')
+
+
+def benjamini_hochberg(p_value):
+    """ q-values of the Benjamini-Hochberg procedure, the false discovery rate of every threshold """
+    p_value = np.asarray(p_value, dtype=np.float64)
+    num_tests = len(p_value)
+    if num_tests == 0:
+        return p_value
+    order = np.argsort(p_value)
+    ranked = p_value[order] * num_tests / np.arange(1, num_tests + 1)
+    q_sorted = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+    q_value = np.empty(num_tests)
+    q_value[order] = q_sorted
+    return q_value
+
+
+def analyze(args, final_clustering_result, offsets, num_clusters=None, kpi_list=None, top=10):
+    """ the correlation analysis step: count, correlate and write the ranked clusters to rep_path.
+
+    Args:
+    --------
+    args: the parameters, set in run.py
+    final_clustering_result: the final clustering results, in the original row order
+    offsets: row offsets of the intervals, obtained from load_all_data()
+    num_clusters: number of representatives, the largest label + 1 by default
+    kpi_list: the list of KPIs, obtained from load_kpi(), read from args.kpi_path by default
+    top: number of clusters printed
+
+    Returns:
+    --------
+    result: the DataFrame of correlate()
+    """
+
+    if kpi_list is None:
+        kpi_list = load_kpi(args.kpi_path)
+    result = correlate(interval_counts(final_clustering_result, offsets, num_clusters), kpi_list)
+    result.to_csv(os.path.join(args.rep_path, RESULT_NAME), index=False)
+    print('clusters most correlated with the KPI:')
+    print(result.head(top).to_string(index=False))
+    return result
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+import time
+import numpy as np
+from . import cascading_clustering as cluster
+from .util import load_single_file, list_seq_files
+from .seq_cache import file_stamp
+from . import model
+
+# ***********************************CODE USAGE GUIDE***************************************
+# Invoked by "python run.py --incremental"
+#
+# incremental.py assigns new timeInter_*.csv files against the representatives of a previous
+# run instead of re-clustering the whole folder. A batch run of run.py leaves in rep_path:
+#   repre_seqs.csv           all representatives, cluster k is the k-th row
+#   event_weights.csv        the final event weights obtained from weigh()
+#   incremental_state.json   the sequence files that are already clustered
+#   model.pkl                the model artefact of model.py, updated when representatives are appended
+# Each new file is weighted with the stored weights and matched against the representatives,
+# only its mismatched residual goes through a mini cascade whose representatives are appended.
+# The labels of each file are written to output_path as labels_timeInter_<n>.csv
+# ******************************************************************************************
+
+STATE_NAME = 'incremental_state.json'
+REPRES_NAME = 'repre_seqs.csv'
+WEIGHTS_NAME = 'event_weights.csv'
+
+
+def load_state(rep_path):
+    """ load the stamps of all processed sequence files, keyed by file name """
+    path = os.path.join(rep_path, STATE_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(rep_path, state):
+    """ atomically save the stamps of all processed sequence files """
+    tmp_path = os.path.join(rep_path, STATE_NAME + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, os.path.join(rep_path, STATE_NAME))
+
+
+def save_batch_state(args, file_list, final_weight_list):
+    """ record the event weights and the sequence files clustered by a batch run, called from run.py.
+
+    Args:
+    --------
+    args: the parameters, set in run.py
+    file_list: the sequence files loaded by the batch run
+    final_weight_list: the final weights list obtained from weigh()
+    """
+
+    np.savetxt(os.path.join(args.rep_path, WEIGHTS_NAME), np.array(final_weight_list), fmt='%f', delimiter=',')
+    save_state(args.rep_path, dict((os.path.basename(f), file_stamp(f)) for f in file_list))
+
+
+def load_repres(rep_path):
+    """ load the persisted representatives and event weights.
+
+    Returns:
+    --------
+    repre_seqs: array of representatives of (K, M)
+    final_weight_list: the final weights list of length M
+    """
+
+    repre_seqs = np.loadtxt(os.path.join(rep_path, REPRES_NAME), delimiter=',', ndmin=2)
+    final_weight_list = np.loadtxt(os.path.join(rep_path, WEIGHTS_NAME), delimiter=',', ndmin=1)
+    return repre_seqs, final_weight_list
+
+
+def assign_file(args, filepath, repre_seqs, final_weight_list, repre_index=None):
+    """ assign the sequences of one new file to the known clusters, the mismatched residual is clustered
+    by a mini cascade.
+
+    Args:
+    --------
+    args: the parameters, set in run.py
+    filepath: path of the new log sequence matrix file
+    repre_seqs: the current representatives of (K, M)
+    final_weight_list: the persisted final weights list
+    repre_index: optional RepresIndex over repre_seqs, reused across files
+
+    Returns:
+    --------
+    labels: cluster index of every sequence in the file, indexes >= K refer to new_repres
+    new_repres: the representatives found in the residual, to be appended after repre_seqs
+    """
+
+    # the round files of the mini cascade are not written, the labels file replaces them
+    args = argparse.Namespace(**vars(args))
+    args.save_file = False
+
+    raw_data = load_single_file(filepath, is_sparse=args.sparse)
+    counts, inverse = None, None
+    if args.dedup:
+        raw_data, counts, inverse = cluster.deduplicate(raw_data)
+    if args.compact:
+        raw_data = raw_data.astype(np.uint8)
+    weight_data = cluster.apply_weights(raw_data, final_weight_list, args.compact)
+    num_inst = raw_data.shape[0]
+
+    known_repres = repre_index if repre_index is not None else repre_seqs
+    mismatch_index, mismatch_data, _, clu_result = cluster.matching(args, weight_data, known_repres,
+                                                                    range(0, num_inst))
+    labels = clu_result[:, 1].astype(np.int64)
+
+    new_repres = []
+    if len(mismatch_index) > 0:
+        mismatch_index = np.asarray(mismatch_index, dtype=np.int64)
+        residual_counts = counts[mismatch_index] if counts is not None else None
+        residual_labels, new_repres = cluster.cascade_rounds(args, raw_data[mismatch_index],
+                                                             range(0, len(mismatch_index)), mismatch_data,
+                                                             residual_counts)
+        residual_labels = residual_labels.astype(np.int64)
+        # rows left unclustered after the last round keep -1
+        residual_labels[residual_labels >= 0] += len(repre_seqs)
+        labels[mismatch_index] = residual_labels
+
+    if inverse is not None:
+        labels = labels[inverse]
+    print('%s: %d sequences, %d in residual, %d new clusters' % (
+        os.path.basename(filepath), len(labels), len(mismatch_index), len(new_repres)))
+    return labels, np.array(new_repres).reshape(-1, repre_seqs.shape[1])
+
+
+def scan_once(args):
+    """ assign every new or changed sequence file in args.seq_folder.
+
+    Returns:
+    --------
+    num_files: number of files processed in this scan
+    """
+
+    state = load_state(args.rep_path)
+    new_files = []
+    for filepath in list_seq_files(args.seq_folder):
+        stamp = file_stamp(filepath)
+        if state.get(stamp['name']) != stamp:
+            new_files.append((filepath, stamp))
+    if not new_files:
+        return 0
+
+    repre_seqs, final_weight_list = load_repres(args.rep_path)
+    stored_model = model.load_model(args.rep_path)
+    if not os.path.exists(args.output_path):
+        os.makedirs(args.output_path)
+    # the index over the representatives is only rebuilt when new representatives are appended
+    repre_index = cluster.RepresIndex(repre_seqs) if args.match_index else None
+    for filepath, stamp in new_files:
+        labels, new_repres = assign_file(args, filepath, repre_seqs, final_weight_list, repre_index)
+        if len(new_repres) > 0:
+            repre_seqs = np.vstack([repre_seqs, new_repres])
+            repre_index = cluster.RepresIndex(repre_seqs) if args.match_index else None
+            tmp_path = os.path.join(args.rep_path, REPRES_NAME + '.tmp')
+            np.savetxt(tmp_path, repre_seqs, fmt='%f', delimiter=',')
+            os.replace(tmp_path, os.path.join(args.rep_path, REPRES_NAME))
+            # keep the model artefact of warm starts in line with the appended representatives
+            if stored_model is not None:
+                model.save_model(args.rep_path, model.build_model(final_weight_list, repre_seqs,
+                                                                  stored_model['threshold'], stored_model['events']))
+        np.savetxt(os.path.join(args.output_path, 'labels_' + stamp['name']), labels, fmt='%d')
+        state[stamp['name']] = stamp
+        save_state(args.rep_path, state)
+    print('====================there are ## %d ## clusters==================' % len(repre_seqs))
+    return len(new_files)
+
+
+def run_incremental(args):
+    """ scan the sequence folder once, or keep watching it every args.watch_interval seconds.
+
+    Args:
+    --------
+    args: the parameters, set in run.py
+    """
+
+    if not os.path.exists(os.path.join(args.rep_path, WEIGHTS_NAME)):
+        raise IOError('no %s in %s, run a batch clustering first' % (WEIGHTS_NAME, args.rep_path))
+    while True:
+        scan_once(args)
+        if args.watch_interval <= 0:
+            break
+        time.sleep(args.watch_interval)
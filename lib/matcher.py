@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy import sparse
+
+# ***********************************CODE USAGE GUIDE***************************************
+# Not directly used, should be invoked by cascading_clustering.matching()
+#
+# matcher.py finds the nearest representative of every sequence vector block by block.
+# Instead of cdist(weight_data, repre_seqs), which allocates a full (N, K) matrix, each block
+# of rows computes |x|^2 + |r|^2 - 2xr with one matrix product, takes the argmin and tests the
+# threshold right away, so memory is bounded by block_size * K. Blocks run in a thread pool,
+# numpy releases the GIL inside the matrix product.
+# ******************************************************************************************
+
+
+def _block_nearest(block, repre_seqs, repre_sq):
+    """ nearest representative of each row of one block.
+
+    Args:
+    --------
+    block: block of rows, dense array or CSR matrix
+    repre_seqs: dense representatives of (K, M)
+    repre_sq: squared norm of each representative
+
+    Returns:
+    --------
+    min_index: index of the nearest representative per row
+    min_dist: euclidean distance to it
+    """
+
+    block, dist_sq = _block_dist_sq(block, repre_seqs, repre_sq)
+    min_index = np.argmin(dist_sq, axis=1)
+    return min_index, _exact_dist(block, repre_seqs[min_index])
+
+
+def _block_dist_sq(block, repre_seqs, repre_sq):
+    """ the block as a dense array and its squared distances to all representatives, by the expansion """
+    if sparse.issparse(block):
+        block_sq = np.asarray(block.multiply(block).sum(axis=1)).ravel()
+        cross = np.asarray(block @ repre_seqs.T)
+        block = block.toarray()
+    else:
+        block = np.asarray(block, dtype=repre_seqs.dtype)
+        block_sq = np.einsum('ij,ij->i', block, block)
+        cross = block @ repre_seqs.T
+    dist_sq = repre_sq[None, :] - 2 * cross
+    dist_sq += block_sq[:, None]
+    return block, dist_sq
+
+
+def _exact_dist(block, chosen):
+    # exact distance to the chosen representative, avoids the rounding error of the expansion
+    diff = block - chosen
+    return np.sqrt(np.einsum('ij,ij->i', diff, diff))
+
+
+def nearest_repres(data, repre_seqs, threshold=None, block_size=4096, n_threads=1):
+    """ find the nearest representative of every row of data, block by block.
+
+    Args:
+    --------
+    data: weighted sequence data of (N, M), dense array or CSR matrix
+    repre_seqs: representatives of (K, M)
+    threshold: if given, rows whose nearest distance is not below threshold get index -1
+    block_size: number of rows per block, peak memory is about block_size * (K + M) floats
+    n_threads: number of threads that process blocks concurrently
+
+    Returns:
+    --------
+    clu_array: index of the nearest representative per row, -1 for mismatched rows if threshold is given
+    min_dist: distance of each row to its nearest representative
+    """
+
+    num_inst = data.shape[0]
+    clu_array = np.empty(num_inst, dtype=np.int64)
+    min_dist = np.empty(num_inst, dtype=np.float64)
+    repre_seqs = np.asarray(repre_seqs, dtype=np.float64)
+    if num_inst == 0:
+        return clu_array, min_dist
+    if repre_seqs.shape[0] == 0:
+        clu_array.fill(-1)
+        min_dist.fill(np.inf)
+        return clu_array, min_dist
+    repre_sq = np.einsum('ij,ij->i', repre_seqs, repre_seqs)
+    block_size = max(1, int(block_size))
+
+    def run_block(start):
+        end = min(start + block_size, num_inst)
+        index, dist = _block_nearest(data[start:end], repre_seqs, repre_sq)
+        if threshold is not None:
+            index[dist >= threshold] = -1
+        clu_array[start:end] = index
+        min_dist[start:end] = dist
+
+    starts = range(0, num_inst, block_size)
+    if n_threads > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(run_block, starts))
+    else:
+        for start in starts:
+            run_block(start)
+    return clu_array, min_dist
+
+
+def nearest_repres_multi(data, repres_list, thresholds, block_size=4096, n_threads=1):
+    """ nearest_repres() of several sets of representatives in one pass over data.
+
+    All sets are stacked, so every block of rows needs one matrix product for all of them, the
+    nearest representative is then taken within each set and tested against its own threshold.
+
+    Args:
+    --------
+    data: weighted sequence data of (N, M), dense array or CSR matrix
+    repres_list: list of representative arrays of (K_i, M)
+    thresholds: threshold of each set of representatives
+    block_size: number of rows per block
+    n_threads: number of threads that process blocks concurrently
+
+    Returns:
+    --------
+    clu_list: for each set, the index of the nearest representative per row, -1 if not within its threshold
+    """
+
+    num_inst = data.shape[0]
+    repres_list = [np.asarray(r, dtype=np.float64).reshape(-1, data.shape[1]) for r in repres_list]
+    bounds = np.concatenate([[0], np.cumsum([len(r) for r in repres_list])])
+    clu_list = [np.full(num_inst, -1, dtype=np.int64) for _ in repres_list]
+    if num_inst == 0 or bounds[-1] == 0:
+        return clu_list
+    repre_seqs = np.vstack(repres_list)
+    repre_sq = np.einsum('ij,ij->i', repre_seqs, repre_seqs)
+    block_size = max(1, int(block_size))
+
+    def run_block(start):
+        end = min(start + block_size, num_inst)
+        block, dist_sq = _block_dist_sq(data[start:end], repre_seqs, repre_sq)
+        for i, threshold in enumerate(thresholds):
+            if bounds[i + 1] == bounds[i]:
+                continue
+            index = np.argmin(dist_sq[:, bounds[i]:bounds[i + 1]], axis=1)
+            dist = _exact_dist(block, repre_seqs[bounds[i] + index])
+            index[dist >= threshold] = -1
+            clu_list[i][start:end] = index
+
+    starts = range(0, num_inst, block_size)
+    if n_threads > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(run_block, starts))
+    else:
+        for start in starts:
+            run_block(start)
+    return clu_list
+
+
+class RepresIndex(object):
+    """ exact, threshold-aware nearest-representative index.
+
+    The events are split into groups, and every vector is summarized by the norm of each of its
+    groups. Since ||x - r||^2 = sum_g ||x_g - r_g||^2 >= sum_g (||x_g|| - ||r_g||)^2, the distance of
+    x to every representative is bounded from below by a matrix product over the group norms only,
+    which is far cheaper than over all events. Pairs whose bound is not below threshold are pruned,
+    exact distances are computed for the remaining candidates. The result is the same as a
+    brute-force search followed by the threshold test.
+    """
+
+    def __init__(self, repre_seqs, num_groups=64):
+        """ build the index.
+
+        Args:
+        --------
+        repre_seqs: representatives of (K, M)
+        num_groups: number of event groups used for the lower bound
+        """
+
+        self.repre_seqs = np.asarray(repre_seqs, dtype=np.float64)
+        num_repres, num_events = self.repre_seqs.shape
+        num_groups = max(1, min(num_groups, num_events))
+
+        # spread the heaviest events over different groups, a group holding several active events
+        # of the same vector gives a looser bound
+        mass = np.einsum('ij,ij->j', self.repre_seqs, self.repre_seqs)
+        group_of_event = np.empty(num_events, dtype=np.int64)
+        group_of_event[np.argsort(-mass, kind='stable')] = np.arange(num_events) % num_groups
+        self.group_matrix = sparse.csr_matrix((np.ones(num_events), (np.arange(num_events), group_of_event)),
+                                              shape=(num_events, num_groups))
+        self.repre_sq = np.einsum('ij,ij->i', self.repre_seqs, self.repre_seqs)
+        self.repre_group_norm = self._group_norm(self.repre_seqs)
+
+    def _group_norm(self, data):
+        return np.sqrt(np.asarray((self.group_matrix.T @ (data * data).T).T))
+
+    def _query_block(self, block, threshold):
+        num_rows = block.shape[0]
+        block_sq = np.einsum('ij,ij->i', block, block)
+        bound_sq = self._group_norm(block) @ self.repre_group_norm.T
+        bound_sq *= -2
+        bound_sq += block_sq[:, None]
+        bound_sq += self.repre_sq[None, :]
+        # the expansion may round, a small slack keeps the pruning exact
+        slack = 1e-9 * (block_sq.max() + self.repre_sq.max())
+        rows, cols = np.nonzero(bound_sq < threshold * threshold + slack)
+
+        best_index = np.full(num_rows, -1, dtype=np.int64)
+        min_dist = np.full(num_rows, np.inf)
+        if len(rows) == 0:
+            return best_index, min_dist
+
+        # exact distances of the candidate pairs, in chunks of at most num_rows pairs
+        pair_dist = np.empty(len(rows))
+        for start in range(0, len(rows), num_rows):
+            end = min(start + num_rows, len(rows))
+            diff = block[rows[start:end]] - self.repre_seqs[cols[start:end]]
+            pair_dist[start:end] = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+
+        # the nearest candidate per row, ties go to the smaller representative index as in argmin
+        order = np.lexsort((cols, pair_dist, rows))
+        first = order[np.unique(rows[order], return_index=True)[1]]
+        best_index[rows[first]] = cols[first]
+        min_dist[rows[first]] = pair_dist[first]
+        best_index[min_dist >= threshold] = -1
+        return best_index, min_dist
+
+    def query(self, data, threshold, block_size=4096, n_threads=1):
+        """ find the nearest representative within threshold of every row of data.
+
+        Args:
+        --------
+        data: weighted sequence data of (N, M), dense array or CSR matrix
+        threshold: distance threshold used when matching
+        block_size: number of rows per block
+        n_threads: number of threads that process blocks concurrently
+
+        Returns:
+        --------
+        clu_array: index of the nearest representative per row, -1 if none is within threshold
+        min_dist: distance to that representative, inf for rows whose candidates were all pruned
+        """
+
+        num_inst = data.shape[0]
+        clu_array = np.full(num_inst, -1, dtype=np.int64)
+        min_dist = np.full(num_inst, np.inf)
+        if num_inst == 0 or self.repre_seqs.shape[0] == 0:
+            return clu_array, min_dist
+        block_size = max(1, int(block_size))
+
+        def run_block(start):
+            end = min(start + block_size, num_inst)
+            block = data[start:end]
+            block = block.toarray() if sparse.issparse(block) else np.asarray(block, dtype=np.float64)
+            clu_array[start:end], min_dist[start:end] = self._query_block(block, threshold)
+
+        starts = range(0, num_inst, block_size)
+        if n_threads > 1 and len(starts) > 1:
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                list(executor.map(run_block, starts))
+        else:
+            for start in starts:
+                run_block(start)
+        return clu_array, min_dist
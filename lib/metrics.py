@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# ***********************************CODE USAGE GUIDE***************************************
+# Not directly used, should be invoked through util.timeit and cascading_clustering.cascade_rounds()
+#
+# metrics.py records every stage (each @timeit function) and every cascading round as one
+# JSON line: wall time, CPU time, max RSS, the tracemalloc peak of the stage if memory tracing
+# is on, the current round and any sizes the stage adds (input, sample, clusters, residual...).
+# Set "--metrics_path" in run.py to write the lines to a file, "--trace_memory" to trace
+# allocations, and "--profile_path" to also dump cProfile statistics of the whole run.
+# ******************************************************************************************
+
+_state = {'file': None, 'trace_memory': False, 'round': None, 'run_id': None}
+_lock = threading.Lock()
+_stack = threading.local()
+
+
+def configure(metrics_path=None, trace_memory=False):
+    """ set where metrics are written and whether allocations are traced.
+
+    Args:
+    --------
+    metrics_path: JSON lines file the metrics are appended to, None only prints the stage times
+    trace_memory: trace allocations with tracemalloc to report the memory peak of each stage
+    """
+
+    close()
+    if metrics_path:
+        _state['file'] = open(metrics_path, 'a')
+    _state['trace_memory'] = trace_memory
+    _state['run_id'] = '%d-%d' % (os.getpid(), int(time.time()))
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def close():
+    """ flush and close the metrics file """
+    if _state['file'] is not None:
+        _state['file'].close()
+        _state['file'] = None
+
+
+def set_round(round):
+    """ the cascading round added to every following record, None outside of cascading """
+    _state['round'] = round
+
+
+def emit(event, **fields):
+    """ write one metrics record.
+
+    Args:
+    --------
+    event: kind of record, e.g. "stage" or "round"
+    fields: values of the record, must be JSON serializable
+    """
+
+    if _state['file'] is None:
+        return
+    record = {'event': event, 'run_id': _state['run_id'], 'time': time.time()}
+    if _state['round'] is not None:
+        record.setdefault('round', _state['round'])
+    record.update(fields)
+    with _lock:
+        _state['file'].write(json.dumps(record, default=_to_builtin) + '\n')
+        _state['file'].flush()
+
+
+def _to_builtin(value):
+    # numpy scalars
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+def _max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+@contextmanager
+def stage(name, event='stage', **fields):
+    """ measure a block of code, the yielded dictionary can be filled with sizes by the block.
+
+    Nested stages are supported, the memory peak of an inner stage also counts for the outer one.
+    """
+
+    frames = getattr(_stack, 'frames', None)
+    if frames is None:
+        frames = _stack.frames = []
+    tracing = _state['trace_memory'] and tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak')
+    if tracing:
+        if frames:
+            frames[-1]['peak'] = max(frames[-1]['peak'], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    frame = {'peak': 0, 'start': tracemalloc.get_traced_memory()[0] if tracing else 0}
+    frames.append(frame)
+
+    record = dict(fields)
+    ts, cs = time.time(), time.process_time()
+    try:
+        yield record
+    finally:
+        record['wall_s'] = time.time() - ts
+        record['cpu_s'] = time.process_time() - cs
+        record['max_rss_kb'] = _max_rss_kb()
+        frames.pop()
+        if tracing:
+            peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            record['peak_traced_bytes'] = peak
+            record['peak_increase_bytes'] = peak - frame['start']
+            if frames:
+                frames[-1]['peak'] = max(frames[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+        emit(event, name=name, **record)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import pickle
+import time
+import numpy as np
+
+# ***********************************CODE USAGE GUIDE***************************************
+# Not directly used, should be invoked by run.py and cascading_clustering.cascade()
+#
+# model.py keeps the result of a run as one versioned artefact, rep_path/model.pkl, holding
+# the event vocabulary, the final event weights, the representatives with their cluster ids
+# and the threshold they were built with. With "--warm_start" in run.py the next run weighs the
+# data with the stored weights, matches it against the stored representatives first and only
+# samples and clusters the residual, so known clusters keep their ids and new ones get the
+# next free ids.
+# ******************************************************************************************
+
+MODEL_NAME = 'model.pkl'
+MODEL_VERSION = 1
+
+
+def build_model(final_weight_list, repre_seqs, threshold, events=None):
+    """ the model artefact of a run.
+
+    Args:
+    --------
+    final_weight_list: the final weights list obtained from weigh()
+    repre_seqs: array of all representatives of (K, M), cluster k is the k-th row
+    threshold: the distance threshold the representatives were built with
+    events: the event vocabulary, the column index of every event by default
+
+    Returns:
+    --------
+    model: dictionary of the model fields
+    """
+
+    repre_seqs = np.asarray(repre_seqs, dtype=np.float64)
+    final_weight_list = np.asarray(final_weight_list, dtype=np.float64)
+    if events is None:
+        events = np.arange(len(final_weight_list))
+    return {'version': MODEL_VERSION,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'events': np.asarray(events),
+            'final_weights': final_weight_list,
+            'repre_seqs': repre_seqs,
+            'cluster_ids': np.arange(len(repre_seqs), dtype=np.int64),
+            'threshold': float(threshold)}
+
+
+def save_model(rep_path, model):
+    """ atomically write the model artefact to rep_path """
+    tmp_path = os.path.join(rep_path, MODEL_NAME + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, os.path.join(rep_path, MODEL_NAME))
+
+
+def load_model(rep_path):
+    """ load the model artefact of rep_path, with the representatives ordered by cluster id.
+
+    Returns:
+    --------
+    model: dictionary of the model fields, None if rep_path holds no model
+    """
+
+    path = os.path.join(rep_path, MODEL_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        model = pickle.load(f)
+    if model.get('version') != MODEL_VERSION:
+        raise ValueError('%s has version %s, expected %d' % (path, model.get('version'), MODEL_VERSION))
+    order = np.argsort(model['cluster_ids'])
+    if not np.array_equal(model['cluster_ids'][order], np.arange(len(order))):
+        raise ValueError('%s: cluster ids are not 0..%d' % (path, len(order) - 1))
+    model['repre_seqs'] = model['repre_seqs'][order]
+    model['cluster_ids'] = model['cluster_ids'][order]
+    return model
+
+
+def check_model(model, num_events, threshold):
+    """ whether a loaded model can warm-start a run on data with num_events events.
+
+    Returns:
+    --------
+    reason: why the model cannot be used, None if it can
+    """
+
+    if model is None:
+        return 'no model found'
+    if len(model['events']) != num_events:
+        return 'the model has %d events, the data has %d' % (len(model['events']), num_events)
+    if not np.isclose(model['threshold'], threshold):
+        return 'the model was built with threshold %g, not %g' % (model['threshold'], threshold)
+    return None
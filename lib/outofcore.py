@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import math
+import os
+import shutil
+import tempfile
+import numpy as np
+from scipy import sparse
+from . import cascading_clustering as cluster
+from . import metrics
+
+# ***********************************CODE USAGE GUIDE***************************************
+# Not directly used, should be invoked by run.py when "--out_of_core" is set
+#
+# outofcore.py runs the cascade on data larger than the memory. The binarized rows stay on disk
+# in the sequence cache (--cache_dir) and every round streams its input in chunks:
+#   1. sampling: every sample_rate-th row, or with "--sample_policy budget" a reservoir of the
+#                rows with the smallest random keys, kept while the chunks pass by
+#   2. clustering of the sample in memory, as in cascade_rounds()
+#   3. matching chunk by chunk, the labels go to a memory-mapped final_labels.npy in output_path
+#      and the mismatched rows are spilled to a temporary file, the input of the next round
+# Chunks, the sample and its distance matrix are sized from "--memory_budget_mb", so the peak
+# memory does not grow with the number of sequences. With the same parameters the clusters are
+# the same as those of the in-memory cascade.
+# ******************************************************************************************
+
+
+class RowStore(object):
+    """ binarized rows on disk and the global row id of each of them. """
+
+    def __init__(self, data, ids=None):
+        """ a store over memory-mapped rows.
+
+        Args:
+        --------
+        data: the (n, M) uint8 rows, usually a np.memmap
+        ids: the global row id of each row, arange(n) by default
+        """
+
+        self.data = data
+        self.ids = ids
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def chunks(self, chunk_rows):
+        """ yield (start, ids, rows) for consecutive chunks, the rows are read into memory """
+        for start in range(0, len(self), chunk_rows):
+            end = min(start + chunk_rows, len(self))
+            ids = np.arange(start, end) if self.ids is None else np.asarray(self.ids[start:end])
+            yield start, ids, np.asarray(self.data[start:end])
+
+    def id_chunks(self, chunk_rows):
+        """ yield the global row ids chunk by chunk, without reading the rows """
+        for start in range(0, len(self), chunk_rows):
+            end = min(start + chunk_rows, len(self))
+            yield np.arange(start, end) if self.ids is None else np.asarray(self.ids[start:end])
+
+
+class SpillFile(object):
+    """ rows appended to a temporary file, read back as the RowStore of the next round. """
+
+    def __init__(self, folder, name, num_events):
+        self.data_path = os.path.join(folder, name + '.bin')
+        self.ids_path = os.path.join(folder, name + '_ids.bin')
+        self.num_events = num_events
+        self.num_rows = 0
+        self.data_file = open(self.data_path, 'wb')
+        self.ids_file = open(self.ids_path, 'wb')
+
+    def append(self, ids, rows):
+        self.data_file.write(np.ascontiguousarray(rows, dtype=np.uint8).tobytes())
+        self.ids_file.write(np.ascontiguousarray(ids, dtype=np.int64).tobytes())
+        self.num_rows += len(ids)
+
+    def close(self):
+        """ finish writing and memory-map the spilled rows """
+        self.data_file.close()
+        self.ids_file.close()
+        if self.num_rows == 0:
+            return RowStore(np.zeros((0, self.num_events), dtype=np.uint8), np.zeros(0, dtype=np.int64))
+        return RowStore(np.memmap(self.data_path, dtype=np.uint8, mode='r', shape=(self.num_rows, self.num_events)),
+                        np.memmap(self.ids_path, dtype=np.int64, mode='r', shape=(self.num_rows,)))
+
+
+def chunk_size(memory_budget_mb, num_events):
+    """ rows per chunk: a chunk, its weighted float64 copy and the matching temporaries take about
+    a quarter of the memory budget """
+    bytes_per_row = max(1, num_events) * (1 + 8 + 8)
+    return max(1, int(memory_budget_mb * 1024 * 1024 / 4 / bytes_per_row))
+
+
+def weigh_chunk(args, rows, final_weight_list):
+    """ the weighted rows of a chunk, in the same representation as the in-memory cascade """
+    if args.sparse:
+        rows = sparse.csr_matrix(rows)
+    weight_data = cluster.apply_weights(rows, final_weight_list, args.compact)
+    return weight_data[:] if args.compact else weight_data
+
+
+def stream_sample(args, store, chunk_rows, rng, strata_of=None):
+    """ sample the rows of a store in one pass.
+
+    Args:
+    --------
+    args: the parameters, set in run.py, with sample_budget_mb already capped by the memory budget
+    store: the RowStore of the round
+    chunk_rows: rows per chunk
+    rng: numpy RandomState used for the budget policy
+    strata_of: optional function mapping global row ids to their stratum, used by the budget policy
+
+    Returns:
+    --------
+    sample_rows: the unweighted sampled rows, in store order
+    sample_rate: the effective sampling rate
+    """
+
+    num_inst = len(store)
+    if args.sample_policy == 'budget':
+        sample_size = cluster.budget_sample_size(args, num_inst)
+        if sample_size >= num_inst:
+            return np.vstack([rows for _, _, rows in store.chunks(chunk_rows)]), 1.0
+        quota = None
+        if strata_of is not None:
+            sizes = sum(np.bincount(strata_of(ids), minlength=args.num_strata) for ids in store.id_chunks(chunk_rows))
+            quota = cluster.stratum_quota(sizes, sample_size, num_inst)
+        # reservoir of the smallest keys: the selection over the kept rows and a new chunk equals
+        # the selection over all rows seen so far
+        kept_keys, kept_strata = np.zeros(0), np.zeros(0, dtype=np.int64)
+        kept_rows = np.zeros((0, store.data.shape[1]), dtype=np.uint8)
+        for _, ids, rows in store.chunks(chunk_rows):
+            keys = np.concatenate([kept_keys, rng.exponential(size=len(ids))])
+            strata = np.concatenate([kept_strata, strata_of(ids)]) if quota is not None else None
+            selected = cluster.smallest_keys(keys, sample_size, strata, quota)
+            kept_rows = np.vstack([kept_rows, rows])[selected]
+            kept_keys = keys[selected]
+            kept_strata = strata[selected] if strata is not None else kept_strata
+        print('Step 3. Sampling within a budget of %g MB, the original data size is %d, after sampling, the data '
+              'size is %d' % (args.sample_budget_mb, num_inst, len(kept_rows)))
+        return kept_rows, num_inst / float(max(1, len(kept_rows)))
+
+    # fixed policy: every sample_rate-th row, small inputs are clustered as a whole
+    sample_rate = 1
+    if num_inst >= 1000:
+        sample_rate = args.sample_rate
+        max_size = cluster.budget_sample_size(args, num_inst)
+        if math.ceil(num_inst / float(sample_rate)) > max_size:
+            sample_rate = int(math.ceil(num_inst / float(max_size)))
+            print('sample_rate raised to %d to fit the memory budget' % sample_rate)
+        if math.ceil(num_inst / float(sample_rate)) <= 1:
+            sample_rate = 1
+    sample_rows = np.vstack([rows[(start + np.arange(len(rows))) % sample_rate == 0]
+                             for start, _, rows in store.chunks(chunk_rows)])
+    print('Step 3. Sampling with sample_rate %d, the original data size is %d, after sampling, the data size is %d' % (
+        sample_rate, num_inst, len(sample_rows)))
+    return sample_rows, sample_rate
+
+
+def cascade_out_of_core(args, store, final_weight_list, offsets=None):
+    """ the cascade of cascade_rounds() over rows that are streamed from disk.
+
+    Args:
+    --------
+    args: the parameters, set in run.py
+    store: RowStore of all binarized rows, e.g. over the sequence cache
+    final_weight_list: the final weights list obtained from final_weights()
+    offsets: row offsets of the sequence files, used by "--stratify"
+
+    Returns:
+    --------
+    final_clustering_result: the final labels, memory-mapped from output_path/final_labels.npy
+    all_repres: array of all representatives, label k of final_clustering_result is all_repres[k]
+    """
+
+    max_cascading_num = 100
+    num_inst, num_events = store.data.shape
+    chunk_rows = chunk_size(args.memory_budget_mb, num_events)
+    # the sample and its distance matrix get at most half of the memory budget
+    args = argparse.Namespace(**vars(args))
+    args.sample_budget_mb = min(args.sample_budget_mb, args.memory_budget_mb / 2.0)
+    args.match_block_size = min(args.match_block_size, chunk_rows)
+    strata_of = None
+    if args.stratify and offsets is not None:
+        offsets = np.asarray(offsets, dtype=np.int64)
+        args.num_strata = len(offsets) - 1
+        strata_of = lambda ids: np.searchsorted(offsets, ids, side='right') - 1
+    print('out-of-core cascade over %d sequences, chunks of %d rows' % (num_inst, chunk_rows))
+
+    final_clustering_result = np.lib.format.open_memmap(os.path.join(args.output_path, 'final_labels.npy'),
+                                                        mode='w+', dtype=np.int64, shape=(num_inst,))
+    final_clustering_result[:] = -1
+    round_repres = []
+    label = 0
+    rng = np.random.RandomState(args.sample_seed)
+    spill_dir = tempfile.mkdtemp(prefix='log3c_spill_', dir=args.spill_dir)
+    try:
+        for round in range(0, max_cascading_num):
+            if len(store) == 0:
+                break
+            print('==========round %d========' % round)
+            metrics.set_round(round)
+            with metrics.stage('cascade_round', event='round', input_size=len(store)) as round_record:
+                # Sampling and Clustering Step, the sample is the only part of the round kept in memory
+                sample_rows, sample_rate = stream_sample(args, store, chunk_rows, rng, strata_of)
+                sample_weight_data = weigh_chunk(args, sample_rows, final_weight_list)
+                cluster_labels = cluster.clustering(args, sample_weight_data)
+                repre_seqs = cluster.repres_extracting(sample_weight_data, cluster_labels)
+                round_repres.append(repre_seqs)
+                del sample_rows, sample_weight_data
+
+                # Matching Step, chunk by chunk, the mismatched rows are spilled for the next round
+                print("Step 6. Matching, start matching with original data", store.data.shape)
+                known_repres = cluster.RepresIndex(repre_seqs) if args.match_index else repre_seqs
+                spill = SpillFile(spill_dir, 'round_%d' % round, num_events)
+                for _, ids, rows in store.chunks(chunk_rows):
+                    clu_array = cluster.nearest_cluster(args, weigh_chunk(args, rows, final_weight_list),
+                                                        known_repres)
+                    matched = clu_array != -1
+                    final_clustering_result[ids[matched]] = clu_array[matched] + label
+                    spill.append(ids[~matched], rows[~matched])
+                previous, store = store, spill.close()
+                label = label + len(repre_seqs)
+                round_record.update(sample_rate=sample_rate, sample_size=len(cluster_labels),
+                                    clusters=len(repre_seqs), matched=len(previous) - len(store),
+                                    matched_fraction=(len(previous) - len(store)) / float(len(previous)),
+                                    residual_size=len(store))
+
+            # the spilled input of the finished round is not needed any more
+            del previous
+            for name in ('round_%d.bin' % (round - 1), 'round_%d_ids.bin' % (round - 1)):
+                if os.path.exists(os.path.join(spill_dir, name)):
+                    os.remove(os.path.join(spill_dir, name))
+            if len(store) == 0:
+                print('cascading stopped as no data left as mismatched.')
+                break
+        metrics.set_round(None)
+        print('In the end, %d are remian as not matched' % len(store))
+    finally:
+        store = None
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+    final_clustering_result.flush()
+    all_repres = np.vstack(round_repres) if round_repres else np.zeros((0, num_events))
+    print("the final cluster number is %d" % label)
+    return final_clustering_result, all_repres
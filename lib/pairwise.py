@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy import sparse
+from scipy.spatial.distance import cdist, pdist
+
+# ***********************************CODE USAGE GUIDE***************************************
+# Not directly used, should be invoked by cascading_clustering.dist_compute()
+#
+# pairwise.py computes the condensed distance vector that linkage() expects, in the layout of
+# pdist: the distances of row i to the rows j > i follow each other. The rows are split into
+# tiles of about the same number of pairs, tile [i0, i1) only needs the distances to the rows
+# i0..n and fills one contiguous slice of the output, so threads write into a single buffer
+# without copies. Set "--dist_threads" in run.py to use several threads, scipy and BLAS
+# release the GIL while computing a tile.
+# ******************************************************************************************
+
+
+def condensed_offset(i, num_inst):
+    """ position of the distance between row i and row i + 1 in the condensed vector """
+    return i * num_inst - i * (i + 1) // 2
+
+
+def split_tiles(num_inst, tile_pairs):
+    """ split the rows into tiles of about tile_pairs pairs each.
+
+    Returns:
+    --------
+    bounds: first row of every tile, followed by num_inst
+    """
+
+    starts = condensed_offset(np.arange(num_inst + 1, dtype=np.int64), num_inst)
+    num_tiles = max(1, int(-(-starts[-1] // max(1, tile_pairs))))
+    bounds = np.searchsorted(starts, np.linspace(0, starts[-1], num_tiles + 1)[1:-1])
+    return np.unique(np.concatenate([[0], bounds, [num_inst]]))
+
+
+def _fill_tile(data, data_sq, out, i0, i1):
+    num_inst, size = data.shape[0], i1 - i0
+    block = data[i0:i1]
+    if data_sq is not None:
+        # |x|^2 + |y|^2 - 2xy against rows i0..n, the work scales with the non-zeros of the CSR matrix
+        tile = (block @ data[i0:].T).toarray()
+        tile *= -2
+        tile += data_sq[i0:i1, None]
+        tile += data_sq[None, i0:]
+        np.maximum(tile, 0, out=tile)  # rounding may give tiny negative values
+        np.sqrt(tile, out=tile)
+        inner, outer = None, tile
+    else:
+        # pairs inside the tile, then the rectangle to the rows after it, nothing is computed twice
+        inner, outer = pdist(block, 'euclidean'), cdist(block, data[i1:], 'euclidean')
+
+    # row r of the tile fills its condensed slice: its pairs inside the tile, then the rows after it
+    start = condensed_offset(i0, num_inst)
+    for r in range(size):
+        if inner is None:
+            stop = start + num_inst - i0 - r - 1
+            out[start:stop] = outer[r, r + 1:]
+        else:
+            mid = start + size - r - 1
+            stop = mid + num_inst - i1
+            out[start:mid] = inner[condensed_offset(r, size):condensed_offset(r + 1, size)]
+            out[mid:stop] = outer[r]
+        start = stop
+
+
+def condensed_distances(data, n_threads=1, tile_pairs=1 << 22, dtype=np.float64):
+    """ euclidean distances between all pairs of rows, in the condensed form returned by pdist.
+
+    Args:
+    --------
+    data: data matrix of (n, M), dense array or CSR matrix
+    n_threads: number of threads computing tiles
+    tile_pairs: about the number of distances of one tile, bounds the temporary memory per thread
+    dtype: dtype of the output, float32 halves its size but linkage() converts it back to float64
+
+    Returns:
+    --------
+    dist_list: condensed distance vector of length n * (n - 1) / 2
+    """
+
+    num_inst = data.shape[0]
+    data_sq = None
+    if sparse.issparse(data):
+        data = sparse.csr_matrix(data, dtype=np.float64)
+        data_sq = np.asarray(data.multiply(data).sum(axis=1)).ravel()
+    else:
+        data = np.asarray(data, dtype=np.float64)
+    out = np.empty(condensed_offset(num_inst, num_inst), dtype=dtype)
+    bounds = split_tiles(num_inst, tile_pairs)
+    tiles = list(zip(bounds[:-1], bounds[1:]))
+    if data_sq is None and n_threads <= 1 and dtype == np.float64:
+        # a single thread gains nothing from tiles, pdist also writes in place
+        pdist(data, 'euclidean', out=out)
+    elif n_threads <= 1 or len(tiles) == 1:
+        for i0, i1 in tiles:
+            _fill_tile(data, data_sq, out, i0, i1)
+    else:
+        with ThreadPoolExecutor(n_threads) as executor:
+            # consume the results so that errors of the tiles are raised
+            list(executor.map(lambda tile: _fill_tile(data, data_sq, out, *tile), tiles))
+    return out
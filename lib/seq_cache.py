@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import multiprocessing
+import json
+import os
+import numpy as np
+from scipy import sparse
+from .util import load_single_file, list_seq_files
+
+# ***********************************CODE USAGE GUIDE***************************************
+# Not directly used, should be invoked by util.load_all_data() or "python run.py --ingest_only"
+#
+# seq_cache.py converts the timeInter_*.csv files of a sequence folder into one binarized
+# uint8 matrix on disk, so that later runs memory-map it instead of re-parsing every CSV.
+# The cache folder holds:
+#   raw_data.bin   the binarized (N, M) matrix, row-major, one file after another
+#   event_occu.npy the event occurrence matrix, one row per file
+#   manifest.json  file names, mtime/size, row offsets and the matrix shape
+# Files whose mtime and size are unchanged are never parsed again, new files are appended.
+# ******************************************************************************************
+
+MANIFEST_NAME = 'manifest.json'
+DATA_NAME = 'raw_data.bin'
+OCCU_NAME = 'event_occu.npy'
+CACHE_VERSION = 1
+
+
+def file_stamp(filepath):
+    """ the name, mtime and size of a file, used to detect new or changed sequence files """
+    stat = os.stat(filepath)
+    return {'name': os.path.basename(filepath), 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def _load_manifest(cache_dir):
+    path = os.path.join(cache_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != CACHE_VERSION:
+        return None
+    return manifest
+
+
+def _load_binarized(filepath):
+    return load_single_file(filepath).astype(np.uint8)
+
+
+def update_seq_cache(seq_folder, cache_dir, proc_num):
+    """ bring the on-disk cache in line with the sequence folder, only new or changed files are parsed.
+
+    The cached prefix of files that are unchanged is kept, everything from the first new, changed or
+    removed file onwards is converted again and appended.
+
+    Args:
+    --------
+    seq_folder: folder of log sequence matrix files
+    cache_dir: folder where the binary cache is kept
+    proc_num: number of processes used to parse new files
+
+    Returns:
+    --------
+    manifest: the updated manifest dictionary
+    """
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    file_list = list_seq_files(seq_folder)
+    stamps = [file_stamp(f) for f in file_list]
+
+    manifest = _load_manifest(cache_dir)
+    data_path = os.path.join(cache_dir, DATA_NAME)
+    if manifest is None or not os.path.exists(data_path):
+        manifest = {'version': CACHE_VERSION, 'num_events': None, 'files': [], 'offsets': [0]}
+
+    # number of leading files whose cached copy is still valid
+    keep = 0
+    for cached, stamp in zip(manifest['files'], stamps):
+        if cached != stamp:
+            break
+        keep += 1
+
+    new_files = file_list[keep:]
+    print('cache: %d files unchanged, %d files to convert' % (keep, len(new_files)))
+    if keep == len(manifest['files']) and not new_files:
+        return manifest
+
+    if keep == 0:
+        manifest['num_events'] = None
+    offsets = manifest['offsets'][:keep + 1]
+    event_occu = np.load(os.path.join(cache_dir, OCCU_NAME))[:keep] if keep > 0 else None
+
+    # the files are parsed in parallel and each one is written as soon as it arrives in order,
+    # instead of keeping all parsed files in memory until the last one is done
+    num_events = manifest['num_events']
+    new_occu = []
+    pool = multiprocessing.Pool(proc_num) if new_files else None
+    try:
+        # drop the stale tail of the binary file, then append the newly converted rows
+        with open(data_path, 'ab') as f:
+            f.truncate(offsets[-1] * (num_events or 0))
+            for filepath, inter_data in zip(new_files, pool.imap(_load_binarized, new_files) if pool else []):
+                if num_events is None:
+                    num_events = inter_data.shape[1]
+                if inter_data.shape[1] != num_events:
+                    raise ValueError('%s has %d events, expected %d' % (filepath, inter_data.shape[1], num_events))
+                f.write(np.ascontiguousarray(inter_data).tobytes())
+                offsets.append(offsets[-1] + inter_data.shape[0])
+                new_occu.append(inter_data.sum(axis=0))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    occu_list = ([event_occu] if event_occu is not None else []) + ([np.array(new_occu)] if new_occu else [])
+    event_occu = np.vstack(occu_list) if occu_list else np.zeros((0, num_events or 0), dtype=np.int64)
+    np.save(os.path.join(cache_dir, OCCU_NAME), event_occu.astype(np.int64))
+
+    manifest['num_events'] = num_events
+    manifest['files'] = stamps
+    manifest['offsets'] = offsets
+    tmp_path = os.path.join(cache_dir, MANIFEST_NAME + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(cache_dir, MANIFEST_NAME))
+    return manifest
+
+
+def load_seq_cache(cache_dir, is_sparse=False):
+    """ memory-map the cached binarized matrix.
+
+    Args:
+    --------
+    cache_dir: folder where the binary cache is kept
+    is_sparse: return a CSR matrix instead of the memory-mapped array
+
+    Returns:
+    --------
+    allrawData: the (N, M) uint8 memmap, or a CSR matrix if is_sparse is set
+    eveOccuMat: the event occurrence matrix, one row per file
+    offsets: row offset of each file in allrawData, of length file number + 1
+    """
+
+    manifest = _load_manifest(cache_dir)
+    if manifest is None:
+        raise IOError('no sequence cache found in %s, run with --ingest_only first' % cache_dir)
+    offsets = np.array(manifest['offsets'], dtype=np.int64)
+    shape = (int(offsets[-1]), manifest['num_events'] or 0)
+    if shape[0] == 0:
+        allrawData = np.zeros(shape, dtype=np.uint8)
+    else:
+        allrawData = np.memmap(os.path.join(cache_dir, DATA_NAME), dtype=np.uint8, mode='r', shape=shape)
+    if is_sparse:
+        allrawData = sparse.csr_matrix(allrawData)
+    eveOccuMat = np.load(os.path.join(cache_dir, OCCU_NAME))
+    return allrawData, eveOccuMat, offsets
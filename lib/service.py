@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import json
+import os
+import socket
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from . import cascading_clustering as cluster
+from .incremental import load_repres, REPRES_NAME, WEIGHTS_NAME
+
+# ***********************************CODE USAGE GUIDE***************************************
+# Invoked by "python run.py --serve"
+#
+# service.py keeps the representatives and event weights of rep_path in memory and assigns
+# sequence vectors sent over a local TCP socket to the known clusters. The protocol is one JSON
+# object per line, every request gets one reply line:
+#   {"op": "assign", "seqs": [[0, 1, 0, ...], ...]}    dense event vectors, or
+#   {"op": "assign", "events": [[1, 7], ...]}          indexes of the events of each sequence
+#       -> {"clusters": [3, -1, ...], "dist": [...], "mismatched": [false, true, ...]}
+#   {"op": "stats"}      -> throughput and latency counters
+#   {"op": "reload"}     -> reload the representatives and weights now
+# Requests are queued and micro-batched: a batch is closed after --batch_window_ms or once it
+# holds --max_batch sequences, then matched with one nearest_repres() call (RepresIndex with
+# "--match_index"). Sequences without a representative within threshold are "mismatched", i.e.
+# candidates for a new cluster. Every --reload_interval seconds the files in rep_path are checked
+# and reloaded when changed; batches in flight finish with the model they started with.
+# ServiceClient is a small blocking client of the protocol.
+# ******************************************************************************************
+
+# longest request line accepted, a dense request of 64 MB holds about 10^7 event flags
+MAX_LINE = 64 << 20
+
+
+class Snapshot(object):
+    """ immutable representatives and weights, swapped as a whole on reload. """
+
+    def __init__(self, rep_path, match_index=False):
+        """ load the model kept in rep_path.
+
+        Args:
+        --------
+        rep_path: folder holding repre_seqs.csv and event_weights.csv
+        match_index: build a RepresIndex over the representatives
+        """
+
+        self.stamp = self.file_stamp(rep_path)
+        self.repre_seqs, self.final_weight_list = load_repres(rep_path)
+        self.num_events = len(self.final_weight_list)
+        self.repre_seqs = self.repre_seqs.reshape(-1, self.num_events)
+        self.index = cluster.RepresIndex(self.repre_seqs) if match_index and len(self.repre_seqs) else None
+
+    @staticmethod
+    def file_stamp(rep_path):
+        stats = [os.stat(os.path.join(rep_path, name)) for name in (REPRES_NAME, WEIGHTS_NAME)]
+        return tuple((s.st_mtime_ns, s.st_size) for s in stats)
+
+    def assign(self, raw_data, threshold, block_size=4096, n_threads=1):
+        """ nearest representative of every binarized sequence vector, -1 if none is within threshold """
+        weight_data = raw_data * self.final_weight_list
+        if self.index is not None:
+            return self.index.query(weight_data, threshold, block_size, n_threads)
+        return cluster.nearest_repres(weight_data, self.repre_seqs, threshold, block_size, n_threads)
+
+
+class Counters(object):
+    """ throughput and latency counters of the service. """
+
+    def __init__(self, window=10000):
+        self.start = time.time()
+        self.requests = 0
+        self.sequences = 0
+        self.mismatched = 0
+        self.batches = 0
+        self.errors = 0
+        self.reloads = 0
+        self.latency_ms = collections.deque(maxlen=window)  # per request, queueing included
+        self.batch_ms = collections.deque(maxlen=window)  # per batch, matching only
+
+    def summary(self):
+        uptime = time.time() - self.start
+        latency = np.array(self.latency_ms) if self.latency_ms else np.zeros(1)
+        return {'uptime_s': uptime,
+                'requests': self.requests,
+                'sequences': self.sequences,
+                'mismatched': self.mismatched,
+                'batches': self.batches,
+                'errors': self.errors,
+                'reloads': self.reloads,
+                'mean_batch_size': self.sequences / float(self.batches) if self.batches else 0.0,
+                'sequences_per_s': self.sequences / uptime if uptime > 0 else 0.0,
+                'latency_ms_p50': float(np.percentile(latency, 50)),
+                'latency_ms_p99': float(np.percentile(latency, 99)),
+                'latency_ms_max': float(latency.max()),
+                'batch_ms_mean': float(np.mean(self.batch_ms)) if self.batch_ms else 0.0}
+
+
+class AssignService(object):
+    """ asyncio server assigning sequence vectors to the known clusters in micro-batches. """
+
+    def __init__(self, args):
+        """ load the model of args.rep_path.
+
+        Args:
+        --------
+        args: the parameters, set in run.py
+        """
+
+        self.args = args
+        self.snapshot = Snapshot(args.rep_path, args.match_index)
+        self.counters = Counters()
+        self.queue = None
+        # matching runs off the event loop, one batch at a time: requests arriving meanwhile
+        # are queued and form the next, larger batch
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        print('serving %d representatives of %d events' % (len(self.snapshot.repre_seqs), self.snapshot.num_events))
+
+    def parse(self, msg):
+        """ the binarized (n, M) sequence vectors of an assign request """
+        num_events = self.snapshot.num_events
+        if 'events' in msg:
+            raw_data = np.zeros((len(msg['events']), num_events))
+            for i, events in enumerate(msg['events']):
+                events = np.asarray(events, dtype=np.int64).ravel()
+                if len(events) and (events.min() < 0 or events.max() >= num_events):
+                    raise ValueError('sequence %d has event indexes outside [0, %d)' % (i, num_events))
+                raw_data[i, events] = 1
+            return raw_data
+        if not len(msg['seqs']):
+            return np.zeros((0, num_events))
+        raw_data = np.asarray(msg['seqs'], dtype=np.float64)
+        if raw_data.ndim != 2 or raw_data.shape[1] != num_events:
+            raise ValueError('expected sequence vectors of shape (n, %d), got %s' % (num_events, raw_data.shape))
+        return (raw_data != 0).astype(np.float64)
+
+    async def reload(self):
+        """ load the model again and swap it in, requests keep being served meanwhile """
+        loop = asyncio.get_running_loop()
+        snapshot = await loop.run_in_executor(None, Snapshot, self.args.rep_path, self.args.match_index)
+        self.snapshot = snapshot
+        self.counters.reloads += 1
+        print('reloaded %d representatives' % len(snapshot.repre_seqs))
+        return {'representatives': len(snapshot.repre_seqs)}
+
+    async def watch(self):
+        """ reload the model whenever its files in rep_path change """
+        while True:
+            await asyncio.sleep(self.args.reload_interval)
+            try:
+                if Snapshot.file_stamp(self.args.rep_path) != self.snapshot.stamp:
+                    await self.reload()
+            except (IOError, OSError, ValueError) as e:
+                # a model being rewritten is picked up at the next check
+                print('reload failed: %s' % e)
+
+    async def next_batch(self):
+        """ wait for a request, then collect more until the time window or the size limit is reached """
+        items = [await self.queue.get()]
+        size = items[0][0].shape[0]
+        deadline = time.monotonic() + self.args.batch_window_ms / 1000.0
+        while size < self.args.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            items.append(item)
+            size += item[0].shape[0]
+        return items
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = await self.next_batch()
+            snapshot = self.snapshot
+            # requests parsed before a reload may have another width, each width is matched on its own
+            # and only the requests of a failing width get the error
+            groups = collections.OrderedDict()
+            for item in items:
+                groups.setdefault(item[0].shape[1], []).append(item)
+            for group in groups.values():
+                ts = time.time()
+                try:
+                    raw_data = np.vstack([item[0] for item in group])
+                    clu_array, min_dist = await loop.run_in_executor(
+                        self.executor, snapshot.assign, raw_data, self.args.threshold,
+                        self.args.match_block_size, self.args.match_threads)
+                except Exception as e:
+                    for _, future in group:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                self.counters.batch_ms.append((time.time() - ts) * 1000)
+                self.counters.batches += 1
+                self.counters.sequences += len(raw_data)
+                self.counters.mismatched += int(np.sum(clu_array < 0))
+                start = 0
+                for data, future in group:
+                    end = start + data.shape[0]
+                    if not future.done():
+                        future.set_result((clu_array[start:end], min_dist[start:end]))
+                    start = end
+
+    async def assign(self, msg):
+        raw_data = self.parse(msg)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((raw_data, future))
+        clu_array, min_dist = await future
+        return {'clusters': clu_array.tolist(),
+                'dist': [float(x) if np.isfinite(x) else None for x in min_dist],
+                'mismatched': (clu_array < 0).tolist()}
+
+    async def handle(self, reader, writer):
+        """ serve one connection, one JSON request per line """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                ts = time.time()
+                msg = {}
+                try:
+                    msg = json.loads(line)
+                    op = msg.get('op', 'assign')
+                    if op == 'assign':
+                        reply = await self.assign(msg)
+                        self.counters.requests += 1
+                        self.counters.latency_ms.append((time.time() - ts) * 1000)
+                    elif op == 'stats':
+                        reply = self.counters.summary()
+                    elif op == 'reload':
+                        reply = await self.reload()
+                    else:
+                        raise ValueError('unknown op %r' % op)
+                except Exception as e:
+                    self.counters.errors += 1
+                    reply = {'error': '%s: %s' % (type(e).__name__, e)}
+                if isinstance(msg, dict) and 'id' in msg:
+                    reply['id'] = msg['id']
+                writer.write((json.dumps(reply) + '\n').encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, ready=None):
+        """ run the server until cancelled.
+
+        Args:
+        --------
+        ready: optional callback receiving the bound (host, port) once the server listens
+        """
+
+        self.queue = asyncio.Queue()
+        tasks = [asyncio.ensure_future(self.batch_loop())]
+        if self.args.reload_interval > 0:
+            tasks.append(asyncio.ensure_future(self.watch()))
+        server = await asyncio.start_server(self.handle, self.args.serve_host, self.args.serve_port,
+                                            limit=MAX_LINE)
+        address = server.sockets[0].getsockname()[:2]
+        print('listening on %s:%d' % address)
+        if ready is not None:
+            ready(address)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.executor.shutdown(wait=False)
+
+
+def run_service(args):
+    """ serve assignments until interrupted, called from run.py """
+    service = AssignService(args)
+    try:
+        asyncio.run(service.serve())
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(service.counters.summary()))
+
+
+class ServiceClient(object):
+    """ blocking client of the assignment service. """
+
+    def __init__(self, host='127.0.0.1', port=8765, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.file = self.sock.makefile('rwb')
+
+    def request(self, msg):
+        """ send one request and return its reply, raises RuntimeError for an error reply """
+        self.file.write((json.dumps(msg) + '\n').encode())
+        self.file.flush()
+        reply = json.loads(self.file.readline())
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return reply
+
+    def assign(self, seqs=None, events=None):
+        """ cluster index of every sequence, -1 for mismatched ones.
+
+        Args:
+        --------
+        seqs: dense event vectors of (n, M)
+        events: alternatively, the indexes of the events of each sequence
+
+        Returns:
+        --------
+        clusters: cluster index per sequence, -1 if no representative is within threshold
+        dist: distance to the nearest representative, None if unknown
+        """
+
+        if events is not None:
+            reply = self.request({'op': 'assign', 'events': [[int(e) for e in x] for x in events]})
+        else:
+            reply = self.request({'op': 'assign', 'seqs': np.asarray(seqs).tolist()})
+        return np.array(reply['clusters'], dtype=np.int64), reply['dist']
+
+    def stats(self):
+        return self.request({'op': 'stats'})
+
+    def reload(self):
+        return self.request({'op': 'reload'})
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import multiprocessing
+import os
+import traceback
+import numpy as np
+from multiprocessing.connection import Listener, Client
+from scipy import sparse
+from scipy.cluster.hierarchy import linkage, fcluster
+from scipy.spatial.distance import squareform
+from . import cascading_clustering as cluster
+from .util import load_single_file
+
+# ***********************************CODE USAGE GUIDE***************************************
+# Not directly used, should be invoked by run.py when "--shards" is set
+#
+# shards.py runs the cascade map-reduce style. The timeInter_*.csv files are split into
+# contiguous shards, and every shard is loaded and cascaded by its own worker process:
+#   1. load:    each worker parses its files and returns the event occurrences per file,
+#               the parent computes the global event weights from them
+#   2. cascade: each worker weighs its data with the global weights and runs cascade_rounds()
+#   3. merge:   the representatives of the shards are merged pairwise, level by level, by
+#               complete linkage under the same threshold that only joins representatives of
+#               different sides
+#   4. assign:  each worker assigns its rows to the nearest merged representative, rows with none
+#               within threshold are sent back and cascaded by the parent as a final residual round,
+#               so every row ends up within threshold of its representative, as in one process
+# Workers talk to the parent over a multiprocessing connection (local socket) with plain
+# dictionaries as messages.
+# ******************************************************************************************
+
+
+def _load(state, msg):
+    data_list = [load_single_file(f, is_sparse=msg['sparse']) for f in msg['files']]
+    occu = np.array([np.asarray(d.sum(axis=0)).ravel() for d in data_list])
+    raw_data = sparse.vstack(data_list, format='csr') if msg['sparse'] else np.vstack(data_list)
+    if msg['compact']:
+        raw_data = raw_data.astype(np.uint8)
+    counts, inverse = None, None
+    if msg['dedup']:
+        raw_data, counts, inverse = cluster.deduplicate(raw_data)
+    state.update(raw_data=raw_data, counts=counts, inverse=inverse)
+    return {'occu': occu, 'sizes': [d.shape[0] for d in data_list]}
+
+
+def _cascade(state, msg):
+    # the round files are not written by the shards, the parent saves the merged result
+    args = argparse.Namespace(**msg['args'])
+    args.save_file = False
+    raw_data = state['raw_data']
+    weight_data = cluster.apply_weights(raw_data, msg['final_weight_list'], args.compact)
+    state['weight_data'] = weight_data
+    labels, repres = cluster.cascade_rounds(args, raw_data, range(0, raw_data.shape[0]), weight_data,
+                                            state['counts'], state['inverse'])
+    return {'repres': repres, 'sizes': np.bincount(labels[labels >= 0], minlength=len(repres))}
+
+
+def _assign(state, msg):
+    # the (unique) rows of the shard against the merged representatives, the mismatched ones are returned
+    args = argparse.Namespace(**msg['args'])
+    labels = cluster.nearest_cluster(args, state['weight_data'], msg['repres'])
+    residual = np.where(labels == -1)[0]
+    counts = state['counts']
+    return {'labels': labels, 'inverse': state['inverse'], 'residual_data': state['raw_data'][residual],
+            'residual_counts': counts[residual] if counts is not None else None}
+
+
+HANDLERS = {'load': _load, 'cascade': _cascade, 'assign': _assign}
+
+
+def serve_shard(address, authkey):
+    """ worker loop: connect to the parent and answer its messages until it sends "stop".
+
+    Args:
+    --------
+    address: address of the parent's Listener
+    authkey: authentication key of the connection
+    """
+
+    conn = Client(address, authkey=authkey)
+    state = {}
+    try:
+        while True:
+            msg = conn.recv()
+            if msg['cmd'] == 'stop':
+                break
+            try:
+                reply = HANDLERS[msg['cmd']](state, msg)
+            except Exception:
+                reply = {'error': traceback.format_exc()}
+            conn.send(reply)
+    finally:
+        conn.close()
+
+
+def merge_repres(args, repres_list, sizes_list):
+    """ merge the representatives of all shards pairwise, level by level.
+
+    Two sets are merged by complete linkage of their representatives under args.threshold. The
+    representatives of one set are distinct clusters already, so they are never merged with each
+    other, a representative is only merged with its closest counterpart of the other set. A merged
+    representative is the mean of its members weighted by their cluster sizes.
+
+    Args:
+    --------
+    args: the parameters, set in run.py
+    repres_list: representatives of each shard
+    sizes_list: number of sequences in each cluster of each shard
+
+    Returns:
+    --------
+    all_repres: the global representatives
+    """
+
+    # a group is (representatives, sizes)
+    groups = [(np.asarray(r, dtype=np.float64), np.asarray(s, dtype=np.float64))
+              for r, s in zip(repres_list, sizes_list)]
+    while len(groups) > 1:
+        merged = []
+        for i in range(0, len(groups) - 1, 2):
+            (repres_a, sizes_a), (repres_b, sizes_b) = groups[i], groups[i + 1]
+            stacked = np.vstack([repres_a, repres_b])
+            sizes = np.concatenate([sizes_a, sizes_b])
+            labels = merge_labels(repres_a, repres_b, args.threshold)
+            merged.append((cluster.repres_extracting(stacked, labels, sizes),
+                           np.bincount(labels, weights=sizes, minlength=labels.max() + 1 if len(labels) else 0)))
+        if len(groups) % 2:
+            merged.append(groups[-1])
+        groups = merged
+    return groups[0][0]
+
+
+def merge_labels(repres_a, repres_b, threshold):
+    """ cluster labels of the stacked representatives of two sets, only pairs across the sets may merge.
+
+    Returns:
+    --------
+    cluster_labels: cluster index of each row of vstack([repres_a, repres_b]), from 0
+    """
+
+    num_a, num_inst = len(repres_a), len(repres_a) + len(repres_b)
+    if num_inst <= 1:
+        return np.zeros(num_inst, dtype=np.int64)
+    dist = squareform(cluster.dist_compute(np.vstack([repres_a, repres_b])))
+    # pairs within one set are pushed above threshold, complete linkage never joins them
+    block = 2 * (dist.max() + threshold) + 1
+    dist[:num_a, :num_a] = block
+    dist[num_a:, num_a:] = block
+    Z = linkage(squareform(dist, checks=False), 'complete')
+    return fcluster(Z, threshold, criterion='distance').astype(np.int64) - 1
+
+
+class ShardCluster(object):
+    """ worker processes that load and cascade the shards of a sequence folder. """
+
+    def __init__(self, args, file_list, num_shards):
+        """ split the files into shards and start one connected worker process per shard.
+
+        Args:
+        --------
+        args: the parameters, set in run.py
+        file_list: the sequence files, in interval order
+        num_shards: number of shards, at most the number of files
+        """
+
+        self.args = args
+        self.shard_files = [list(files) for files in np.array_split(np.array(file_list, dtype=object),
+                                                                   max(1, min(num_shards, len(file_list))))]
+        authkey = os.urandom(16)
+        self.listener = Listener(('localhost', 0), authkey=authkey)
+        self.workers = []
+        for _ in self.shard_files:
+            worker = multiprocessing.Process(target=serve_shard, args=(self.listener.address, authkey))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        self.conns = [self.listener.accept() for _ in self.workers]
+        self.num_inst = 0
+        self.offsets = None
+
+    def _call_all(self, messages):
+        # all shards work at the same time, the replies are collected in shard order
+        for conn, msg in zip(self.conns, messages):
+            conn.send(msg)
+        replies = [conn.recv() for conn in self.conns]
+        for i, reply in enumerate(replies):
+            if 'error' in reply:
+                raise RuntimeError('shard %d failed:\n%s' % (i, reply['error']))
+        return replies
+
+    def load(self):
+        """ load every shard in its worker.
+
+        Returns:
+        --------
+        eveOccuMat: the event occurrence matrix of all files, one row per file
+        """
+
+        print('loading %d files in %d shards' % (sum(len(f) for f in self.shard_files), len(self.shard_files)))
+        replies = self._call_all([{'cmd': 'load', 'files': files, 'sparse': self.args.sparse,
+                                   'compact': self.args.compact, 'dedup': self.args.dedup}
+                                  for files in self.shard_files])
+        # row offsets of the files, in the order of the final labels
+        self.offsets = np.concatenate([[0], np.cumsum([size for reply in replies for size in reply['sizes']])])
+        self.num_inst = int(self.offsets[-1])
+        return np.vstack([reply['occu'] for reply in replies])
+
+    def cascade(self, final_weight_list):
+        """ cascade every shard with the global weights and merge their representatives.
+
+        Returns:
+        --------
+        final_clustering_result: the final clustering results, in the original row order
+        all_repres: array of all representatives, label k of final_clustering_result is all_repres[k]
+        """
+
+        replies = self._call_all([{'cmd': 'cascade', 'args': vars(self.args),
+                                   'final_weight_list': np.asarray(final_weight_list)}
+                                  for _ in self.shard_files])
+        print('merging %s representatives of %d shards' % ([len(r['repres']) for r in replies], len(replies)))
+        all_repres = merge_repres(self.args, [r['repres'] for r in replies], [r['sizes'] for r in replies])
+
+        # a merged representative moved away from the rows of its shard clusters, so every row is
+        # assigned again, the rows without a representative within threshold are cascaded once more
+        replies = self._call_all([{'cmd': 'assign', 'args': vars(self.args), 'repres': all_repres}
+                                  for _ in self.shard_files])
+        residual_data = [r['residual_data'] for r in replies]
+        residual_data = sparse.vstack(residual_data, format='csr') if self.args.sparse else np.vstack(residual_data)
+        num_residual = residual_data.shape[0]
+        residual_labels = np.zeros(0, dtype=np.int64)
+        if num_residual > 0:
+            print('%d sequences are not within threshold of a merged representative, cascading them' % num_residual)
+            args = argparse.Namespace(**vars(self.args))
+            args.save_file = False
+            residual_counts = np.concatenate([r['residual_counts'] for r in replies]) if self.args.dedup else None
+            weight_data = cluster.apply_weights(residual_data, final_weight_list, args.compact)
+            residual_labels, residual_repres = cluster.cascade_rounds(args, residual_data, range(0, num_residual),
+                                                                      weight_data, residual_counts)
+            # rows left unclustered after the last round keep -1
+            residual_labels[residual_labels >= 0] += len(all_repres)
+            all_repres = np.vstack([all_repres, residual_repres])
+
+        label_list = []
+        start = 0
+        for reply in replies:
+            labels = reply['labels']
+            residual = np.where(labels == -1)[0]
+            labels[residual] = residual_labels[start:start + len(residual)]
+            start += len(residual)
+            label_list.append(labels[reply['inverse']] if reply['inverse'] is not None else labels)
+        final_clustering_result = np.concatenate(label_list)
+        print('the final cluster number is %d' % len(np.unique(final_clustering_result)))
+        return final_clustering_result, all_repres
+
+    def close(self):
+        """ stop the workers """
+        for conn in self.conns:
+            try:
+                conn.send({'cmd': 'stop'})
+            except (OSError, EOFError):
+                pass
+            conn.close()
+        for worker in self.workers:
+            worker.join()
+        self.listener.close()
+
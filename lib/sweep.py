@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import time
+import numpy as np
+import pandas as pd
+from scipy.cluster.hierarchy import linkage, fcluster
+from . import cascading_clustering as cluster
+from .canopy import canopy_labels
+from .compact import take_rows
+from .matcher import nearest_repres_multi
+
+# ***********************************CODE USAGE GUIDE***************************************
+# Not directly used, should be invoked by run.py when "--thresholds" is set
+#
+# sweep.py runs the cascade for several thresholds at once, on data loaded and weighted once.
+# Only the fcluster cut and the matching test depend on the threshold, so the cascades of all
+# thresholds advance round by round together, and thresholds whose residual (and random state)
+# is still the same share the work of the round:
+#   - one sample, one distance matrix and one linkage tree, cut at every threshold
+#   - one matching pass against the stacked representatives of all thresholds
+# In round 0 all thresholds share, later they split as their residuals differ. The result is a
+# table with the cluster count, rounds, residual and time of every threshold, written to
+# rep_path/threshold_sweep.csv. With the canopy backend the clustering is not shared, as the
+# canopies depend on the threshold.
+# ******************************************************************************************
+
+SWEEP_NAME = 'threshold_sweep.csv'
+
+
+def cut_tree(args, data, thresholds):
+    """ the clustering step for several thresholds, one linkage tree cut at each of them.
+
+    Args:
+    --------
+    args: the parameters, set in run.py
+    data: the sampled data
+    thresholds: list of distance thresholds
+
+    Returns:
+    --------
+    labels_list: cluster labels of each row of data per threshold, from 0
+    """
+
+    if data.shape[0] == 1:
+        return [np.zeros(1, dtype=np.int64) for _ in thresholds]
+    if args.cluster_backend == 'canopy':
+        return [np.asarray(canopy_labels(data, t, args.canopy_size), dtype=np.int64) - 1 for t in thresholds]
+    # the bits kernel stops summing above its threshold, the largest one keeps every cut exact
+    data_dist = cluster.dist_compute(data, args.dist_threads, args.distance_kernel, max(thresholds),
+                                     args.dist_dtype)
+    Z = linkage(data_dist, 'complete')
+    return [np.asarray(fcluster(Z, t, criterion='distance'), dtype=np.int64) - 1 for t in thresholds]
+
+
+def _group_key(state):
+    # thresholds with the same residual and random state take the same sample
+    digest = hashlib.sha1(np.ascontiguousarray(state['pos']).tobytes())
+    digest.update(np.ascontiguousarray(state['rng'].get_state()[1]).tobytes())
+    digest.update(str(state['rng'].get_state()[2]).encode())
+    return digest.hexdigest()
+
+
+def sweep(args, thresholds, raw_index, weight_data, counts=None, strata=None, inverse=None):
+    """ the cascade for every threshold, sharing sampling, linkage and matching between them.
+
+    Args:
+    --------
+    args: the parameters, set in run.py
+    thresholds: list of distance thresholds
+    raw_index, weight_data, counts, strata, inverse: as passed to cascade_rounds()
+
+    Returns:
+    --------
+    result: DataFrame with one row per threshold: threshold, clusters, rounds, residual,
+            matched_round0 (fraction of rows matched in round 0), shared_rounds (rounds whose work
+            was shared with other thresholds) and time_s (the time of its rounds, shared work split evenly)
+    """
+
+    max_cascading_num = 100
+    raw_index = np.asarray(raw_index, dtype=np.int64)
+    # every threshold starts from the same random state, also without a seed
+    rng_state = np.random.RandomState(args.sample_seed).get_state()
+    states = [{'threshold': t, 'pos': np.arange(weight_data.shape[0]), 'rng': np.random.RandomState(),
+               'clusters': 0, 'rounds': 0, 'matched_round0': 0.0, 'shared_rounds': 0, 'time_s': 0.0}
+              for t in thresholds]
+    for state in states:
+        state['rng'].set_state(rng_state)
+    num_linkages = 0
+    for round in range(max_cascading_num):
+        active = [state for state in states if len(state['pos']) > 0]
+        if not active:
+            break
+        groups = {}
+        for state in active:
+            groups.setdefault(_group_key(state), []).append(state)
+        print('==========round %d: %d thresholds in %d groups========' % (round, len(active), len(groups)))
+        for group in groups.values():
+            ts = time.time()
+            leader = group[0]
+            round_data = take_rows(weight_data, leader['pos'])
+            round_index = raw_index[leader['pos']]
+            sample_weight_data, sample_index, _ = cluster.sample_round(args, round_data, round_index, leader['rng'],
+                                                                      counts, strata, inverse)
+            for state in group[1:]:
+                state['rng'].set_state(leader['rng'].get_state())
+
+            group_thresholds = [state['threshold'] for state in group]
+            labels_list = cut_tree(args, sample_weight_data, group_thresholds)
+            num_linkages += 1
+            sample_counts = counts[round_index[sample_index]] if counts is not None else None
+            repres_list = [cluster.repres_extracting(sample_weight_data, labels, sample_counts)
+                           for labels in labels_list]
+
+            clu_list = nearest_repres_multi(round_data, repres_list, group_thresholds, args.match_block_size,
+                                            args.match_threads)
+            elapsed = (time.time() - ts) / len(group)
+            for state, repre_seqs, clu_array in zip(group, repres_list, clu_list):
+                matched = clu_array != -1
+                if round == 0:
+                    state['matched_round0'] = float(matched.mean()) if len(matched) else 0.0
+                state['pos'] = state['pos'][~matched]
+                state['clusters'] += len(repre_seqs)
+                state['rounds'] += 1
+                state['shared_rounds'] += len(group) > 1
+                state['time_s'] += elapsed
+
+    print('%d linkage trees for %d (threshold, round) pairs' % (num_linkages, sum(s['rounds'] for s in states)))
+    return pd.DataFrame({'threshold': [s['threshold'] for s in states],
+                         'clusters': [s['clusters'] for s in states],
+                         'rounds': [s['rounds'] for s in states],
+                         'residual': [len(s['pos']) for s in states],
+                         'matched_round0': [s['matched_round0'] for s in states],
+                         'shared_rounds': [s['shared_rounds'] for s in states],
+                         'time_s': [s['time_s'] for s in states]})
+
+
+def run_sweep(args, raw_index, weight_data, counts=None, strata=None, inverse=None):
+    """ sweep the thresholds of args.thresholds, print the table and write it to rep_path """
+    thresholds = [float(x) for x in args.thresholds.split(',')]
+    ts = time.time()
+    result = sweep(args, thresholds, raw_index, weight_data, counts, strata, inverse)
+    result.to_csv(os.path.join(args.rep_path, SWEEP_NAME), index=False)
+    print(result.to_string(index=False))
+    print('swept %d thresholds in %.2f s' % (len(thresholds), time.time() - ts))
+    return result
@@ -4,111 +4,48 @@ import multiprocessing
 import pandas as pd
 import os
 import glob
-import time
+import functools
+import itertools
+import weakref
 import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+from scipy import sparse
+from . import metrics
 
 # ***********************************CODE USAGE GUIDE***************************************
 #                             		Work for FSE 2018
 # Not directly used, should be invoked by cascading_clustering.py                                  
 #
-# save_results.py is a script that save the results into individual files for manual checking. 
-# It mainly save the clustering results of each iteration into files.
-# Note that the saving process may be blocked by I/O and increases the time usage.
-# Therefore, we use a flag "saveFile" to control whether to save files.
+# util.py loads the log sequence matrix files and the KPI list, and prepares the output folder.
+# Dense matrices are parsed by worker processes straight into one shared memory block, the
+# workers also return the event occurrences of their file so no second pass is needed.
+# The clustering results of each iteration are saved by writer.py in a background thread,
+# controlled by the flag "save_file".
 # ******************************************************************************************
 
-
 def timeit(method):
+    """ time a stage, print its duration and record it through metrics.stage() """
+    @functools.wraps(method)
     def timed(*args, **kw):
-        ts = time.time()
-        result = method(*args, **kw)
-        te = time.time()
-        if 'log_time' in kw:
-            name = kw.get('log_name', method.__name__.upper())
-            kw['log_time'][name] = int((te - ts) * 1000)
+        log_time = kw.pop('log_time', None)
+        name = kw.pop('log_name', method.__name__.upper())
+        with metrics.stage(method.__name__) as record:
+            # the size of the first matrix argument, e.g. the data of this stage
+            for arg in args:
+                if hasattr(arg, 'shape'):
+                    record['input_shape'] = list(arg.shape)
+                    break
+            result = method(*args, **kw)
+        if log_time is not None:
+            log_time[name] = int(record['wall_s'] * 1000)
         else:
-            print
-            '%r  %2.2f ms' % \
-            (method.__name__, (te - ts) * 1000)
+            print('%r  %2.2f ms' % (method.__name__, record['wall_s'] * 1000))
         return result
 
     return timed
 
 
 
-@timeit
-def save_matching(args, raw_data, clu_array, curfileIndex, raw_index):
-    """ save the matched clusters. work only if saveFile is true
-
-    Args:
-    --------
-    para: the dictionary of parameters, set in run.py
-    raw_data: unweighted raw data. it is used for saving into files, raw data are saved without weighting.
-    clu_array: the cluster index list for current data
-    curfileIndex:  curfileIndex, flag used for saving
-    raw_index: store the sequence index in the raw data, used when saving cluster into files, obtained in loading_all_data()
-
-    Returns:
-    --------
-    curfileIndex: updated curfileIndex
-    """
-
-    cluResult = list(set(clu_array))
-    matcluNum = len(cluResult) - 1
-    if -1 not in cluResult:
-        matcluNum = matcluNum + 1
-    print('------%d clusters are matched (0 to cluster %d) and one more cluster is for the mismatched data' % (
-    matcluNum, matcluNum - 1))
-    matCluIndeList = [[] for _ in range(matcluNum)]
-    # save all the matched sequences, except the mismatched file
-    for i, ind in enumerate(clu_array):
-        ind = int(ind);
-        i = int(i)
-        if ind != -1:
-            matCluIndeList[ind].append(raw_index[i])
-
-    # save with multiprocessing, invoke saveSingleFile as one process
-    fileIndList = range(curfileIndex, curfileIndex + matcluNum)
-    pool = multiprocessing.Pool(para['proc_num'], initializer=init_save_matching, initargs=(raw_data, para,))
-    pool.starmap_async(saveSingleFile, zip(matCluIndeList, fileIndList))  # _async  , chunksize = 4
-    pool.close()
-    pool.join()
-    curfileIndex = curfileIndex + matcluNum
-    return curfileIndex
-
-
-def saveSingleFile(clu, fileindex):
-    """ save a clusters of sequence data, used in multiprocess part of saveMatching
-
-    Args:
-    --------
-    clu: index list of sequence vectors that belong this cluster
-    fileindex: used to output the filename as the cluster index
-    """
-
-    datamat = []
-    for j in clu:
-        row = []
-        row.append(j)
-        row.extend(raw_data[j, :])
-        datamat.append(row)
-    pd.DataFrame(np.array(datamat)).to_csv(para['output_path'] + '/' + str(fileindex) + '.csv', header=None,
-                                           index=False)
-
-
-def init_save_matching(rawData, paras):
-    """ initialize some global variables for sharing in multiprocess, used in multiprocess part of saveMatching
-
-    Args:
-    --------
-    rawData: all raw sequence data, not weighted.
-    paras: the dictionary of parameters, set in run.py
-    """
-    global raw_data, para
-    raw_data = rawData
-    para = paras
-
-
 def deleteAllFiles(dirPath):
     """ delete all files under this dirPath
 
@@ -131,54 +68,170 @@ def cleanup_output_dir(args):
 
 
 @timeit
-def load_all_data(args):
+def load_all_data(args, return_offsets=False):
 	""" load all log sequence matrixs, remove duplicates, and count the number of
 	log sequences that contain an event (used for correlation weighting in section 3.2)
 
 	Args:
 	--------
 	para: the dictionary of parameters, set in run.py
+	return_offsets: also return the row offset of each file
 
 	Returns:
 	--------
 	allrawData: loaded all log sequence matrix, these matrix are merged into one big matrix of (N, M).
-				N is the number of all log sequences, M is event number.
+				N is the number of all log sequences, M is event number. It is a CSR matrix if args.sparse is set.
 	rawIndex:   index list that used to mark which log sequences are clustered.
 	eveOccuMat: count the number of log sequences that contain each event, it will be used for weighting
+	offsets:    only if return_offsets is set, rows offsets[i]:offsets[i + 1] of allrawData come from the i-th file
 	"""
 
+	# use the memory-mapped binary cache if configured, only new or changed files are parsed.
+	if args.cache_dir:
+		from .seq_cache import update_seq_cache, load_seq_cache
+		update_seq_cache(args.seq_folder, args.cache_dir, args.proc_num)
+		allrawData, eveOccuMat, offsets = load_seq_cache(args.cache_dir, is_sparse=args.sparse)
+		rawIndex = range(0, allrawData.shape[0])
+		if return_offsets:
+			return allrawData, rawIndex, eveOccuMat, offsets
+		return allrawData, rawIndex, eveOccuMat
+
 	# find the all log sequence matrix files.
-	path = args.seq_folder
-	fileList = glob.glob(path + 'timeInter_*.csv')
-	fileNumList = []
-	for file in fileList:
-		fileNum = file.replace(path + 'timeInter_', '').replace('.csv', '')
-		fileNumList.append(int(fileNum))
-	print("there are %d log sequence files files found"%(len(fileNumList)))
-	newfileList = []
-	for x in sorted(fileNumList):
-		newfileList.append(path+ 'timeInter_'+str(x)+'.csv')
+	newfileList = list_seq_files(args.seq_folder)
+	print("there are %d log sequence files files found"%(len(newfileList)))
 
-	# load all the files using multiprocessing.
+	# load all the files using multiprocessing, each worker also counts the number of log sequences
+	# that contain each event in its file, it will be used for weighting
 	print('start loading data')
+	# workers must share the resource tracker of this process, else each of them would try to
+	# remove the shared matrix on exit
+	resource_tracker.ensure_running()
 	pool = multiprocessing.Pool(args.proc_num)
-	rawdataList = pool.map(load_single_file, newfileList)
-	pool.close()
-	pool.join()
-	allrawData = np.vstack(rawdataList)
+	try:
+		if args.sparse:
+			resultList = pool.map(functools.partial(load_single_file_occu, is_compact=args.compact), newfileList)
+			allrawData = sparse.vstack([inter_data for inter_data, _ in resultList], format='csr')
+			eveOccuMat = np.array([occu for _, occu in resultList])
+			offsets = np.concatenate([[0], np.cumsum([inter_data.shape[0] for inter_data, _ in resultList])])
+		else:
+			# size the output first, then every worker parses its file into its own rows of the shared matrix
+			shapeList = pool.map(count_file_shape, newfileList)
+			offsets = np.concatenate([[0], np.cumsum([rows for rows, _ in shapeList])])
+			numEvents = max([cols for _, cols in shapeList] or [0])
+			# the data is binarized, so compact mode stores it as uint8
+			allrawData, shm = alloc_shared_matrix((int(offsets[-1]), numEvents), np.uint8 if args.compact else np.int64)
+			try:
+				taskList = [(filepath, shm.name, allrawData.shape, allrawData.dtype.str, offsets[i], offsets[i + 1])
+							for i, filepath in enumerate(newfileList)]
+				eveOccuMat = np.array(pool.map(load_file_into_shared, taskList)).reshape(len(newfileList), numEvents)
+			finally:
+				# the name is only needed by the workers, also when one of them failed
+				shm.unlink()
+	finally:
+		pool.close()
+		pool.join()
 
 	# index used to mark which log sequences are already processed
 	rawIndex = range(0, allrawData.shape[0])
 
-	# count the number of log sequences that contain each event, it will be used for weighting
-	eveOccuMat = []
-	for inter_data in rawdataList:
-		eveOccuMat.append(np.sum(inter_data, axis = 0))
-	eveOccuMat = np.array(eveOccuMat)
-
+	if return_offsets:
+		return allrawData, rawIndex, eveOccuMat, offsets.astype(np.int64)
 	return allrawData, rawIndex, eveOccuMat
 
 
+def alloc_shared_matrix(shape, dtype=np.int64):
+	""" allocate a zeroed matrix in shared memory, worker processes attach to it by name.
+
+	The caller unlinks the block once the workers are done, it stays mapped until the returned matrix,
+	and every view of it, is garbage collected.
+
+	Returns:
+	--------
+	matrix: numpy array backed by the shared memory block
+	shm:    the SharedMemory object, its name is passed to the workers
+	"""
+
+	size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+	shm = shared_memory.SharedMemory(create=True, size=size)
+	matrix = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+	weakref.finalize(matrix, shm.close)
+	matrix[:] = 0
+	return matrix, shm
+
+
+def count_file_shape(filepath):
+	""" count the rows and columns of a log sequence matrix file without parsing the values.
+
+	Returns:
+	--------
+	rows: number of non-empty lines
+	cols: number of values in the first line
+	"""
+
+	rows, cols = 0, 0
+	with open(filepath, 'rb') as f:
+		for line in f:
+			if line.strip():
+				if rows == 0:
+					cols = line.count(b',') + 1
+				rows += 1
+	return rows, cols
+
+
+def load_file_into_shared(task):
+	""" parse one log sequence matrix file into its rows of the shared matrix, run in a worker process.
+
+	Args:
+	--------
+	task: tuple of (filepath, name of the shared memory block, shape and dtype of the shared matrix, first row, end row)
+
+	Returns:
+	--------
+	eveOccu: number of log sequences in this file that contain each event
+	"""
+
+	filepath, shmName, shape, dtype, start, stop = task
+	shm = shared_memory.SharedMemory(name=shmName)
+	try:
+		allrawData = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+		rawData = load_single_file(filepath)
+		if rawData.shape != (stop - start, shape[1]):
+			raise ValueError('%s has shape %s, expected %s' % (filepath, rawData.shape, (stop - start, shape[1])))
+		allrawData[start:stop] = rawData
+		del allrawData
+	finally:
+		shm.close()
+	return rawData.sum(axis=0)
+
+
+def load_single_file_occu(filepath, is_compact=False):
+	""" load one log sequence matrix as a CSR matrix, together with its event occurrences """
+	rawData = load_single_file(filepath, is_sparse=True)
+	eveOccu = np.asarray(rawData.sum(axis=0)).ravel()
+	if is_compact:
+		rawData = rawData.astype(np.uint8)
+	return rawData, eveOccu
+
+
+def list_seq_files(seq_folder):
+	""" find all log sequence matrix files in a folder, sorted by their interval number.
+
+	Args:
+	--------
+	seq_folder: folder of log sequence matrix files
+
+	Returns:
+	--------
+	fileList: sorted list of file paths
+	"""
+
+	fileNumList = []
+	for file in glob.glob(os.path.join(seq_folder, 'timeInter_*.csv')):
+		fileNum = os.path.basename(file).replace('timeInter_', '').replace('.csv', '')
+		fileNumList.append(int(fileNum))
+	return [os.path.join(seq_folder, 'timeInter_%d.csv' % x) for x in sorted(fileNumList)]
+
+
 def load_kpi(kpipath):
 	""" load the KPI data
 
@@ -192,23 +245,67 @@ def load_kpi(kpipath):
 	"""
 
 	df = pd.read_csv(kpipath, dtype= int, header=None)
-	kpiList = df.as_matrix()
+	kpiList = df.values
 	return kpiList
 
 
-def load_single_file(filepath):
+def load_single_file(filepath, is_sparse=False):
 	""" load one log sequence matrix from the file path, and duplicate events are removed.
 
 	Args:
 	--------
 	filepath:  file path of a log sequences matrix
+	is_sparse: return a CSR matrix instead of a dense array
 
 	Returns:
 	--------
 	rawData:  log sequences matrix (duplicates removed)
 	"""
 
+	if is_sparse:
+		return load_sparse_file(filepath)
 	df = pd.read_csv(filepath, header=None)
-	rawData = df.as_matrix()
+	rawData = df.values
 	rawData[rawData > 1] = 1
 	return rawData
+
+
+def load_sparse_file(filepath, chunk_rows=1024):
+	""" load one log sequence matrix as a binarized CSR matrix, without a dense copy of the whole file.
+
+	The lines are parsed chunk_rows at a time and only the non-zero columns of each chunk are kept.
+
+	Args:
+	--------
+	filepath:   file path of a log sequences matrix
+	chunk_rows: number of lines parsed at once
+
+	Returns:
+	--------
+	rawData:  log sequences matrix as a CSR matrix
+	"""
+
+	indptrList, indicesList, dataList = [np.zeros(1, dtype=np.int64)], [], []
+	numEvents = None
+	with open(filepath) as f:
+		while True:
+			lines = list(itertools.islice(f, chunk_rows))
+			if not lines:
+				break
+			lines = [line for line in lines if line.strip()]
+			if not lines:
+				continue
+			block = np.loadtxt(lines, delimiter=',', dtype=np.int64, ndmin=2)
+			if numEvents is None:
+				numEvents = block.shape[1]
+			elif block.shape[1] != numEvents:
+				raise ValueError('%s has rows of %d and %d values' % (filepath, numEvents, block.shape[1]))
+			rows, cols = np.nonzero(block)
+			indicesList.append(cols)
+			dataList.append(np.minimum(block[rows, cols], 1))
+			indptrList.append(indptrList[-1][-1] + np.cumsum(np.bincount(rows, minlength=block.shape[0])))
+	numRows = sum(len(indptr) for indptr in indptrList) - 1
+	if not indicesList:
+		return sparse.csr_matrix((numRows, numEvents or 0), dtype=np.int64)
+	return sparse.csr_matrix((np.concatenate(dataList), np.concatenate(indicesList), np.concatenate(indptrList)),
+							 shape=(numRows, numEvents))
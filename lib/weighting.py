@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve
+
+# ***********************************CODE USAGE GUIDE***************************************
+# Not directly used, should be invoked by cascading_clustering.get_correlation_weight() and run.py
+#
+# weighting.py fits the correlation weights of section 3.2, a ridge regression of the KPI of
+# each time interval on its event occurrences, in closed form. RidgeStats keeps the rows and the
+# sums of the intervals, so an interval can be added or removed without refitting, and solves the
+# regularized system with a Cholesky factorization. With more events than intervals the
+# (intervals, intervals) kernel system is solved from the rows; otherwise the (events, events)
+# statistics X^T X and X^T y are built on the first solve and then kept up to date on every add
+# or remove. The solution is the one of sklearn Ridge(alpha=0.01) with an intercept.
+# Set "--weight_stats" in run.py to keep the statistics in rep_path between runs, and
+# "--weight_window" to only regress on the most recent intervals.
+# ******************************************************************************************
+
+STATS_NAME = 'correlation_stats.npz'
+STATS_VERSION = 1
+
+
+class RidgeStats(object):
+    """ sufficient statistics of a ridge regression with intercept, one sample per time interval. """
+
+    def __init__(self, num_events, alpha=0.01):
+        """ empty statistics.
+
+        Args:
+        --------
+        num_events: number of events, the regression features
+        alpha: L2 regularization strength, as in sklearn Ridge
+        """
+
+        self.num_events = num_events
+        self.alpha = alpha
+        self.keys = []  # interval keys in the order they were added
+        self.rows = {}  # key -> (event occurrences, KPI), kept to remove the interval again
+        # sums are taken relative to the first interval, which avoids cancellation when centering
+        self.ref_x = None
+        self.ref_y = 0.0
+        self.sum_x = np.zeros(num_events)
+        self.sum_y = 0.0
+        # X^T X and X^T y, None until a solve needs them
+        self.xtx = None
+        self.xty = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _update(self, occu, kpi, sign):
+        d = occu - self.ref_x
+        e = kpi - self.ref_y
+        self.sum_x += sign * d
+        self.sum_y += sign * e
+        if self.xtx is not None:
+            self.xtx += sign * np.outer(d, d)
+            self.xty += sign * d * e
+
+    def add(self, key, occu, kpi):
+        """ add one interval, an interval already present under key is replaced """
+        occu = np.asarray(occu, dtype=np.float64).ravel()
+        kpi = float(np.ravel(kpi)[0])
+        if key in self.rows:
+            self.remove(key)
+        if self.ref_x is None:
+            self.ref_x, self.ref_y = occu.copy(), kpi
+        self._update(occu, kpi, 1)
+        self.keys.append(key)
+        self.rows[key] = (occu, kpi)
+
+    def remove(self, key):
+        """ remove one interval """
+        occu, kpi = self.rows.pop(key)
+        self._update(occu, kpi, -1)
+        self.keys.remove(key)
+
+    def keep_last(self, window):
+        """ sliding window: remove the oldest intervals until at most window are left """
+        while window > 0 and len(self.keys) > window:
+            self.remove(self.keys[0])
+
+    def build_products(self):
+        """ build X^T X and X^T y from the rows, from then on they are updated on every add or remove """
+        if not self.keys:
+            self.xtx, self.xty = np.zeros((self.num_events, self.num_events)), np.zeros(self.num_events)
+            return
+        d = np.array([self.rows[key][0] for key in self.keys]) - self.ref_x
+        e = np.array([self.rows[key][1] for key in self.keys]) - self.ref_y
+        self.xtx, self.xty = d.T.dot(d), d.T.dot(e)
+
+    def solve(self):
+        """ the ridge coefficients of all intervals.
+
+        Returns:
+        --------
+        coefficient_list: one coefficient per event
+        """
+
+        num_inst = len(self.keys)
+        if num_inst == 0:
+            return np.zeros(self.num_events)
+        if self.num_events > num_inst:
+            # fewer intervals than events: solve the (num_inst, num_inst) kernel system, as sklearn does
+            x = np.array([self.rows[key][0] for key in self.keys])
+            y = np.array([self.rows[key][1] for key in self.keys])
+            x -= x.mean(axis=0)
+            y -= y.mean()
+            kernel = x.dot(x.T)
+            kernel.flat[::num_inst + 1] += self.alpha
+            return x.T.dot(cho_solve(cho_factor(kernel), y))
+        if self.xtx is None:
+            self.build_products()
+        mean_x = self.sum_x / num_inst
+        cov_xx = self.xtx - num_inst * np.outer(mean_x, mean_x)
+        cov_xy = self.xty - mean_x * self.sum_y
+        cov_xx.flat[::self.num_events + 1] += self.alpha
+        return cho_solve(cho_factor(cov_xx), cov_xy)
+
+    def save(self, path):
+        """ atomically write the statistics to an .npz file, X^T X and X^T y only if they were built """
+        tmp_path = path + '.tmp.npz'
+        keys = np.array(self.keys, dtype=str)
+        empty = np.zeros(0)
+        np.savez(tmp_path, version=STATS_VERSION, alpha=self.alpha, keys=keys,
+                 occu=np.array([self.rows[key][0] for key in self.keys]).reshape(-1, self.num_events),
+                 kpis=np.array([self.rows[key][1] for key in self.keys]),
+                 ref_x=self.ref_x if self.ref_x is not None else np.zeros(0), ref_y=self.ref_y,
+                 sum_x=self.sum_x, sum_y=self.sum_y, xtx=self.xtx if self.xtx is not None else empty,
+                 xty=self.xty if self.xty is not None else empty)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """ read statistics written by save() """
+        with np.load(path) as f:
+            if int(f['version']) != STATS_VERSION:
+                raise ValueError('%s has version %d, expected %d' % (path, int(f['version']), STATS_VERSION))
+            stats = cls(f['sum_x'].shape[0], float(f['alpha']))
+            stats.keys = [str(key) for key in f['keys']]
+            stats.rows = dict((key, (occu, float(kpi))) for key, occu, kpi in zip(stats.keys, f['occu'], f['kpis']))
+            stats.ref_x = f['ref_x'] if len(f['ref_x']) else None
+            stats.ref_y = float(f['ref_y'])
+            stats.sum_x, stats.sum_y = f['sum_x'], float(f['sum_y'])
+            # X^T X is not needed while there are more events than intervals
+            if f['xtx'].size and stats.num_events <= len(stats.keys):
+                stats.xtx, stats.xty = f['xtx'], f['xty']
+        return stats
+
+
+def correlation_weights(coefficient_list):
+    """ the correlation weight of each event, negative coefficients get a tiny weight """
+    return [x if x > 0 else 0.00001 for x in coefficient_list]
+
+
+def sync_stats(rep_path, keys, event_occu_matrix, kpi_list, window=0, alpha=0.01):
+    """ bring the statistics kept in rep_path in line with the current intervals and save them.
+
+    Intervals no longer present are removed, new or changed ones are added, only the
+    statistics of those intervals are updated.
+
+    Args:
+    --------
+    rep_path: folder the statistics are kept in
+    keys: key of each interval, e.g. the name of its sequence file
+    event_occu_matrix: event occurrences of each interval, one row per key
+    kpi_list: the KPI of each interval
+    window: if > 0, only the last window intervals are kept
+    alpha: L2 regularization strength of new statistics
+
+    Returns:
+    --------
+    stats: the updated RidgeStats
+    """
+
+    path = os.path.join(rep_path, STATS_NAME)
+    event_occu_matrix = np.asarray(event_occu_matrix, dtype=np.float64)
+    stats = RidgeStats.load(path) if os.path.exists(path) else None
+    if stats is None or stats.num_events != event_occu_matrix.shape[1]:
+        stats = RidgeStats(event_occu_matrix.shape[1], alpha)
+    current = set(keys)
+    for key in list(stats.keys):
+        if key not in current:
+            stats.remove(key)
+    for key, occu, kpi in zip(keys, event_occu_matrix, np.ravel(kpi_list)):
+        old = stats.rows.get(key)
+        if old is None or old[1] != kpi or not np.array_equal(old[0], occu):
+            stats.add(key, occu, kpi)
+    # the window drops the earliest intervals of the folder, not the earliest added
+    stats.keys = [key for key in keys if key in stats.rows]
+    stats.keep_last(window)
+    # kept X^T X lets the next run update it instead of rebuilding it, unless the kernel path is used
+    if stats.xtx is None and stats.num_events <= len(stats):
+        stats.build_products()
+    stats.save(path)
+    return stats
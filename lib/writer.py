@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import queue
+import threading
+import numpy as np
+from scipy import sparse
+
+# ***********************************CODE USAGE GUIDE***************************************
+# Not directly used, should be invoked by cascading_clustering.cascade_rounds() when
+# "--save_file" is set in run.py
+#
+# writer.py persists the clustering results of each round in a background thread, so the
+# cascade keeps running while the previous round is written. Each round produces in output_path:
+#   round_<r>_labels.npy    array of (sequence index, cluster index), -1 for mismatched sequences
+#   round_<r>_members.npz   one array of sequence indexes per matched cluster, key "cluster_<k>"
+# and at the end mismatch.csv holds the sequences that are still not matched.
+# Sequence indexes always refer to the original rows, also for deduplicated data.
+# ******************************************************************************************
+
+
+class OutputWriter(object):
+    """ queue of round results written by one background thread. """
+
+    def __init__(self, output_path, raw_data, inverse=None, max_pending=4):
+        """ start the writer thread.
+
+        Args:
+        --------
+        output_path: folder for saving output clusters of data
+        raw_data: unweighted raw data, rows are written to mismatch.csv
+        inverse: inverse index from deduplicate(), used to expand unique rows to original sequences
+        max_pending: number of rounds that may wait in the queue before submit() blocks
+        """
+
+        self.output_path = output_path
+        self.raw_data = raw_data
+        self.inverse = inverse
+        self.error = None
+        self.tasks = queue.Queue(max_pending)
+        self.thread = threading.Thread(target=self._run, name='log3c-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                task[0](*task[1:])
+            except Exception as e:
+                self.error = e
+
+    def _expand(self, raw_index, labels):
+        """ map rows of raw_data to original sequence indexes and their labels """
+        if self.inverse is None:
+            return raw_index, labels
+        row_labels = np.full(self.raw_data.shape[0], -2, dtype=np.int64)
+        row_labels[raw_index] = labels
+        seq_labels = row_labels[self.inverse]
+        seq_index = np.flatnonzero(seq_labels != -2)
+        return seq_index, seq_labels[seq_index]
+
+    def _write_round(self, round, raw_index, labels):
+        seq_index, seq_labels = self._expand(raw_index, labels)
+        np.save(os.path.join(self.output_path, 'round_%d_labels.npy' % round),
+                np.column_stack([seq_index, seq_labels]))
+
+        # group the matched sequences by cluster with one stable sort
+        matched = seq_labels != -1
+        seq_index, seq_labels = seq_index[matched], seq_labels[matched]
+        order = np.argsort(seq_labels, kind='stable')
+        clusters, starts = np.unique(seq_labels[order], return_index=True)
+        members = np.split(seq_index[order], starts[1:])
+        np.savez(os.path.join(self.output_path, 'round_%d_members.npz' % round),
+                 **dict(('cluster_%d' % c, m) for c, m in zip(clusters, members)))
+
+    def _write_mismatch(self, raw_index):
+        seq_index, _ = self._expand(raw_index, np.full(len(raw_index), -1, dtype=np.int64))
+        rows = seq_index if self.inverse is None else self.inverse[seq_index]
+        num_events = self.raw_data.shape[1]
+        fmt = '%d\t' + ' '.join(['%d'] * num_events)
+        with open(os.path.join(self.output_path, 'mismatch.csv'), 'w') as f:
+            for start in range(0, len(rows), 4096):
+                chunk = self.raw_data[rows[start:start + 4096]]
+                chunk = chunk.toarray() if sparse.issparse(chunk) else np.asarray(chunk)
+                np.savetxt(f, np.column_stack([seq_index[start:start + 4096], chunk]), fmt=fmt)
+
+    def submit(self, round, raw_index, labels, label_offset):
+        """ queue the matching result of one round.
+
+        Args:
+        --------
+        round: the cascading round
+        raw_index: rows of raw_data matched in this round
+        labels: cluster index of each row within this round, -1 if mismatched
+        label_offset: number of representatives of the previous rounds
+        """
+
+        labels = np.where(labels != -1, labels + label_offset, -1)
+        self.tasks.put((self._write_round, round, np.asarray(raw_index, dtype=np.int64), labels))
+
+    def submit_mismatch(self, raw_index):
+        """ queue the sequences that remain mismatched after the last round """
+        self.tasks.put((self._write_mismatch, np.asarray(raw_index, dtype=np.int64)))
+
+    def flush(self):
+        """ wait until everything queued so far is written, errors of the writer thread are raised here """
+        done = threading.Event()
+        self.tasks.put((done.set,))
+        # after an error the queued tasks are skipped, done is never set
+        while not done.wait(0.1):
+            if self.error is not None:
+                break
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """ wait until everything queued is written, errors of the writer thread are raised here """
+        self.tasks.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
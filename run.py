@@ -3,7 +3,14 @@
 
 from lib import cascading_clustering as cluster
 from lib.util import *
+from lib import metrics
+from lib.model import load_model, check_model
+from lib.weighting import sync_stats, correlation_weights
+from lib.shards import ShardCluster
+from lib.checkpoint import Checkpoint, is_clearable
+from lib.correlation import analyze
 import argparse
+import cProfile
 
 
 # ***********************************CODE USAGE GUIDE***************************************
@@ -16,26 +23,182 @@ import argparse
 # 2. How to set the parameters?
 #    Replace the parameters in the following "para" according to your data
 # 
-# Notes: multiprocessing is only used to read input files and save output files.
+# Notes: multiprocessing is only used to read input files, output files are saved by a background thread.
 # ******************************************************************************************
 
 
 @timeit
 def main(args):
-    raw_data, raw_index, event_occu_matrix = load_all_data(args)
+    if args.ingest_only:
+        from lib.seq_cache import update_seq_cache
+        update_seq_cache(args.seq_folder, args.cache_dir, args.proc_num)
+        return
 
+    if args.incremental:
+        from lib.incremental import run_incremental
+        run_incremental(args)
+        return
+
+    if args.serve:
+        from lib.service import run_service
+        run_service(args)
+        return
+
+    if args.resume:
+        resume_cascade(args)
+        return
+
+    file_list = list_seq_files(args.seq_folder)
+    if args.shards > 1:
+        run_sharded(args, file_list)
+        return
+    if args.out_of_core:
+        run_out_of_core(args, file_list)
+        return
+
+    raw_data, raw_index, event_occu_matrix, offsets = load_all_data(args, return_offsets=True)
+
+    # the KPI interval of each sequence, used for stratified sampling
+    strata = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets)) if args.stratify else None
+
+    counts, inverse = None, None
+    if args.dedup:
+        raw_data, counts, inverse = cluster.deduplicate(raw_data)
+        raw_index = range(0, raw_data.shape[0])
+        if strata is not None:
+            # a unique row is assigned to the interval of its first occurrence
+            unique_strata = np.empty(raw_data.shape[0], dtype=np.int64)
+            unique_strata[inverse[::-1]] = strata[::-1]
+            strata = unique_strata
+
+    # warm start: reuse the weights and representatives of the stored model if it fits the data
+    model, known_repres = None, None
+    if args.warm_start:
+        model = load_model(args.rep_path)
+        reason = check_model(model, raw_data.shape[1], args.threshold)
+        if reason is not None:
+            print('warm start not possible, %s, clustering from scratch' % reason)
+            model = None
+
+    if model is not None:
+        weight_list = model['final_weights']
+        weight_data = cluster.apply_weights(raw_data, weight_list, args.compact)
+        known_repres = model['repre_seqs']
+        print('warm start from %d known representatives' % len(known_repres))
+    else:
+        correlation_weight_list = get_correlation_weight_list(args, file_list, event_occu_matrix)
+
+        # the event occurrences counted while loading are the document frequencies of the IDF weights
+        weight_data, weight_list = cluster.weigh(raw_data, correlation_weight_list, counts,
+                                                 np.sum(event_occu_matrix, axis=0), args.compact)
+
+    if args.thresholds:
+        # threshold sweep: only the table of the thresholds is written
+        from lib.sweep import run_sweep
+        run_sweep(args, raw_index, weight_data, counts, strata, inverse)
+        return
+
+    checkpoint = None
+    if args.checkpoint_dir:
+        # everything --resume needs to skip loading and weighting
+        checkpoint = Checkpoint(args.checkpoint_dir)
+        checkpoint.save_data(args, file_list, raw_data, raw_index, weight_list, counts, inverse, strata, offsets,
+                             known_repres)
+
+    cleanup_output_dir(args)
+
+    final_clustering_result = cluster.cascade(args, raw_data, raw_index, weight_data, counts, inverse, strata,
+                                              weight_list, known_repres, checkpoint)
+    if args.correlate:
+        analyze(args, final_clustering_result, offsets)
+
+    # keep the event weights and the clustered files, used by the incremental mode
+    from lib.incremental import save_batch_state
+    save_batch_state(args, file_list, weight_list)
+
+
+def resume_cascade(args):
+    """ continue the cascade kept in --checkpoint_dir after its last completed round """
+    checkpoint = Checkpoint(args.checkpoint_dir)
+    file_list, raw_data, raw_index, counts, inverse, strata, weight_list, offsets, known_repres = \
+        checkpoint.load_data(args)
+    weight_data = cluster.apply_weights(raw_data, weight_list, args.compact)
+    # the round files already written are kept
+    if not os.path.exists(args.output_path):
+        os.makedirs(args.output_path)
+    final_clustering_result = cluster.cascade(args, raw_data, raw_index, weight_data, counts, inverse, strata,
+                                              weight_list, known_repres, checkpoint)
+    if args.correlate:
+        analyze(args, final_clustering_result, offsets)
+
+    from lib.incremental import save_batch_state
+    save_batch_state(args, file_list, weight_list)
+
+
+def get_correlation_weight_list(args, file_list, event_occu_matrix):
+    """ the correlation weights, from the kept regression statistics if "--weight_stats" is set """
     kpi_list = cluster.load_kpi(args.kpi_path)
 
-    correlation_weight_list = cluster.get_correlation_weight(event_occu_matrix, kpi_list)
+    if args.weight_stats:
+        # only the statistics of new, changed or removed intervals are updated
+        stats = sync_stats(args.rep_path, [os.path.basename(f) for f in file_list], event_occu_matrix,
+                           kpi_list, args.weight_window)
+        return correlation_weights(stats.solve())
+    return cluster.get_correlation_weight(event_occu_matrix, kpi_list)
+
+
+def run_sharded(args, file_list):
+    """ map-reduce mode: every shard of files is loaded and cascaded by its own worker process """
+    if args.warm_start:
+        print('warm start is not supported with shards, clustering from scratch')
+    if args.checkpoint_dir:
+        print('--checkpoint_dir is not supported with shards, ignored')
+    shard_cluster = ShardCluster(args, file_list, args.shards)
+    try:
+        event_occu_matrix = shard_cluster.load()
+        correlation_weight_list = get_correlation_weight_list(args, file_list, event_occu_matrix)
+        weight_list = cluster.final_weights(shard_cluster.num_inst, np.sum(event_occu_matrix, axis=0),
+                                            correlation_weight_list)
+        cleanup_output_dir(args)
+        final_clustering_result, all_repres = shard_cluster.cascade(weight_list)
+    finally:
+        shard_cluster.close()
+    cluster.save_repres(args, all_repres, weight_list)
+    if args.correlate:
+        analyze(args, final_clustering_result, shard_cluster.offsets)
 
-    weight_data, weight_list = cluster.weigh(raw_data, correlation_weight_list)
+    from lib.incremental import save_batch_state
+    save_batch_state(args, file_list, weight_list)
+    return final_clustering_result
 
+
+def run_out_of_core(args, file_list):
+    """ out-of-core mode: the cascade streams the sequence cache from disk within --memory_budget_mb """
+    for flag in ('dedup', 'warm_start', 'checkpoint_dir', 'save_file'):
+        if getattr(args, flag):
+            print('--%s is not supported out of core, ignored' % flag)
+    from lib.seq_cache import update_seq_cache, load_seq_cache
+    from lib.outofcore import RowStore, cascade_out_of_core
+    update_seq_cache(args.seq_folder, args.cache_dir, args.proc_num)
+    raw_data, event_occu_matrix, offsets = load_seq_cache(args.cache_dir)
+
+    # the weights only need the event occurrences counted when the cache was built
+    correlation_weight_list = get_correlation_weight_list(args, file_list, event_occu_matrix)
+    weight_list = cluster.final_weights(raw_data.shape[0], np.sum(event_occu_matrix, axis=0),
+                                        correlation_weight_list)
     cleanup_output_dir(args)
+    final_clustering_result, all_repres = cascade_out_of_core(args, RowStore(raw_data), weight_list, offsets)
+    cluster.save_repres(args, all_repres, weight_list)
+    if args.correlate:
+        analyze(args, final_clustering_result, offsets)
 
-    final_clustering_result = cluster.cascade(args, raw_data, raw_index, weight_data)
+    from lib.incremental import save_batch_state
+    save_batch_state(args, file_list, weight_list)
+    return final_clustering_result
 
 
-if __name__ == '__main__':
+def get_parser():
+    """ the command line parameters of run.py, also used by the benchmarks to build default parameters """
     parser = argparse.ArgumentParser()
     parser.add_argument("--seq_folder", default="/seq_folder/", required=False,
                         help="folder of log sequence matrix files")
@@ -49,18 +212,180 @@ if __name__ == '__main__':
     parser.add_argument("--sample_rate", type=int, default=100, required=False,
                         help="same rate for sampling, 100 represents 1% sample rate")
 
+    parser.add_argument("--sample_policy", default="fixed", choices=["fixed", "budget"], required=False,
+                        help="fixed: every sample_rate-th sequence, budget: a random sample sized per round to fit "
+                             "--sample_budget_mb")
+
+    parser.add_argument("--sample_budget_mb", type=float, default=512, required=False,
+                        help="memory budget of the clustering step, used by the budget sampling policy")
+
+    parser.add_argument("--sample_seed", type=int, default=None, required=False,
+                        help="random seed of the budget sampling policy")
+
+    parser.add_argument("--stratify", action="store_true", default=False, required=False,
+                        help="budget sampling draws from every KPI interval in proportion to its size")
+
     parser.add_argument("--threshold", type=float, default=0.3, required=False,
                         help="threshold for clustering, and also used when matching the nearest sequence")
 
+    parser.add_argument("--thresholds", default=None, required=False,
+                        help="comma separated thresholds to sweep, e.g. \"0.2,0.3,0.4\". The data is loaded and weighted "
+                             "once and a table of the clusters, rounds and residual per threshold is written to "
+                             "rep_path/threshold_sweep.csv")
+
     parser.add_argument("--save_file", type=bool, default=False, required=False,
-                        help="FLAG to decide whether saving output clusters, it costs a lot if turned on")
+                        help="FLAG to decide whether saving output clusters, written in the background as per-round "
+                             "label arrays and member npz files")
 
     parser.add_argument("--output_path", default="/output/", required=False,
                         help="folder for saving output clusters of data")
 
+    parser.add_argument("--sparse", action="store_true", default=False, required=False,
+                        help="keep log sequence matrices as scipy.sparse CSR from loading through matching")
+
     parser.add_argument("--rep_path", default="/reps/", required=False,
                         help="path used for saving all representatives (patterns)")
 
+    parser.add_argument("--compact", action="store_true", default=False, required=False,
+                        help="keep the binarized data as uint8 and compute float32 weighted rows on demand")
+
+    parser.add_argument("--dedup", action="store_true", default=False, required=False,
+                        help="collapse identical sequence vectors into weighted unique rows before cascading, "
+                             "rows are sampled by the number of sequences they stand for")
+
+    parser.add_argument("--match_block_size", type=int, default=4096, required=False,
+                        help="number of sequences matched per block, bounds the memory of the matching step")
+
+    parser.add_argument("--match_threads", type=int, default=1, required=False,
+                        help="number of threads used to match blocks of sequences")
+
+    parser.add_argument("--match_index", action="store_true", default=False, required=False,
+                        help="match through an exact pruning index over the representatives instead of brute force")
+
+    parser.add_argument("--match_bits", action="store_true", default=False, required=False,
+                        help="match with the lookup tables of the bits kernel on the bit-packed binary vectors "
+                             "instead of float distances to the representatives")
+
+    parser.add_argument("--dist_threads", type=int, default=1, required=False,
+                        help="number of threads computing the pairwise distances of the clustering step")
+
+    parser.add_argument("--distance_kernel", default="float", choices=["float", "bits"], required=False,
+                        help="distances of the clustering step, float: euclidean distances on the weighted vectors, "
+                             "bits: XOR/popcount lookup tables on the bit-packed binary vectors, stops summing a "
+                             "pair once it exceeds threshold")
+
+    parser.add_argument("--dist_dtype", default="float64", choices=["float64", "float32"], required=False,
+                        help="dtype of the distance matrix of the float kernel, float32 halves it, linkage still "
+                             "works on a float64 copy")
+
+    parser.add_argument("--cluster_backend", default="linkage", choices=["linkage", "canopy"], required=False,
+                        help="linkage: complete linkage over the full distance matrix of the sample, "
+                             "canopy: leader canopies followed by complete linkage inside each canopy")
+
+    parser.add_argument("--canopy_size", type=int, default=5000, required=False,
+                        help="largest canopy clustered with complete linkage in the canopy backend")
+
+    parser.add_argument("--weight_stats", action="store_true", default=False, required=False,
+                        help="keep the regression statistics of the correlation weights in --rep_path and only "
+                             "update them for new, changed or removed intervals")
+
+    parser.add_argument("--weight_window", type=int, default=0, required=False,
+                        help="with --weight_stats, regress on the last weight_window intervals only, 0 keeps all")
+
+    parser.add_argument("--warm_start", action="store_true", default=False, required=False,
+                        help="weigh and match the data with the model kept in --rep_path by a previous run, "
+                             "only the residual is clustered")
+
+    parser.add_argument("--shards", type=int, default=0, required=False,
+                        help="split the sequence files into this many shards, cascaded by one worker process each "
+                             "and merged afterwards, 0 or 1 runs in a single process. Every sequence stays within "
+                             "threshold of its representative, but the clusters differ from the single-process ones "
+                             "(benchmarks/bench_shards.py reports the adjusted Rand index)")
+
+    parser.add_argument("--checkpoint_dir", default=None, required=False,
+                        help="folder for the loaded data, the weights and the state after every cascading round")
+
+    parser.add_argument("--resume", action="store_true", default=False, required=False,
+                        help="continue the cascade of --checkpoint_dir after its last completed round, without "
+                             "loading and weighting again")
+
+    parser.add_argument("--correlate", action="store_true", default=False, required=False,
+                        help="correlate the clusters with the KPI per time interval and write the ranked clusters to "
+                             "rep_path/cluster_kpi_correlation.csv")
+
+    parser.add_argument("--out_of_core", action="store_true", default=False, required=False,
+                        help="stream the rows of the sequence cache (--cache_dir) from disk in every round instead of "
+                             "loading them, mismatched rows are spilled to disk")
+
+    parser.add_argument("--memory_budget_mb", type=float, default=1024, required=False,
+                        help="out of core, the chunks, the sample and its distance matrix are sized to fit this many MB")
+
+    parser.add_argument("--spill_dir", default=None, required=False,
+                        help="out of core, folder of the temporary files of mismatched rows, the system default if "
+                             "not set")
+
+    parser.add_argument("--cache_dir", default=None, required=False,
+                        help="folder of the binary sequence cache, loading memory-maps it and only parses new files")
+
+    parser.add_argument("--ingest_only", action="store_true", default=False, required=False,
+                        help="only convert new sequence files into --cache_dir, then exit")
+
+    parser.add_argument("--incremental", action="store_true", default=False, required=False,
+                        help="assign new sequence files against the representatives and weights kept in --rep_path")
+
+    parser.add_argument("--watch_interval", type=float, default=0, required=False,
+                        help="in incremental mode, rescan seq_folder every this many seconds, 0 scans once")
+
+    parser.add_argument("--serve", action="store_true", default=False, required=False,
+                        help="serve assignments of sequence vectors to the representatives kept in --rep_path")
+
+    parser.add_argument("--serve_host", default="127.0.0.1", required=False,
+                        help="address the assignment service listens on")
+
+    parser.add_argument("--serve_port", type=int, default=8765, required=False,
+                        help="port of the assignment service, 0 picks a free port")
+
+    parser.add_argument("--batch_window_ms", type=float, default=2.0, required=False,
+                        help="the assignment service matches the requests received within this window together")
+
+    parser.add_argument("--max_batch", type=int, default=1024, required=False,
+                        help="a batch of the assignment service is matched as soon as it holds this many sequences")
+
+    parser.add_argument("--reload_interval", type=float, default=5.0, required=False,
+                        help="the assignment service reloads the representatives when they changed, checked every "
+                             "this many seconds, 0 disables it")
+
+    parser.add_argument("--metrics_path", default=None, required=False,
+                        help="JSON lines file for the time, memory and sizes of every stage and cascading round")
+
+    parser.add_argument("--trace_memory", action="store_true", default=False, required=False,
+                        help="trace allocations to report the memory peak of every stage, slows the run down")
+
+    parser.add_argument("--profile_path", default=None, required=False,
+                        help="dump cProfile statistics of the whole run to this file, readable with pstats or "
+                             "snakeviz. For sampling profilers such as py-spy, stages are the functions of "
+                             "cascading_clustering.py")
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = get_parser()
     args = parser.parse_args()
+    if args.ingest_only and not args.cache_dir:
+        parser.error("--ingest_only requires --cache_dir")
+    if args.out_of_core and not args.cache_dir:
+        parser.error("--out_of_core requires --cache_dir")
+    if args.resume and not args.checkpoint_dir:
+        parser.error("--resume requires --checkpoint_dir")
+    if args.resume and (args.shards > 1 or args.out_of_core):
+        parser.error("--resume is not supported with --shards or --out_of_core")
+    if args.checkpoint_dir and not args.resume and not is_clearable(args.checkpoint_dir):
+        parser.error("--checkpoint_dir %s is not empty and holds no checkpoint" % args.checkpoint_dir)
 
-    main(args)
+    metrics.configure(args.metrics_path, args.trace_memory)
+    if args.profile_path:
+        cProfile.run('main(args)', args.profile_path)
+    else:
+        main(args)
+    metrics.close()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from scipy import sparse
+from scipy.cluster.hierarchy import linkage, fcluster
+from scipy.spatial.distance import cdist, pdist
+from lib.bitkernel import bits_condensed, bits_nearest
+
+
+def weighted_rows(num_inst, num_events, seed=0):
+    """ binary rows times one weight per event, as produced by weigh() """
+    rng = np.random.RandomState(seed)
+    bits = rng.rand(num_inst, num_events) < 0.2
+    quarter = num_inst // 4
+    bits[:quarter] = bits[quarter:2 * quarter]  # duplicates give zero distances
+    return bits * (0.05 + rng.rand(num_events))
+
+
+def first_occurrence(labels):
+    """ labels renumbered by the first row of each cluster """
+    _, first_index, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    return np.argsort(np.argsort(first_index))[inverse.ravel()]
+
+
+@pytest.mark.parametrize('num_events', [37, 64])
+@pytest.mark.parametrize('is_sparse', [False, True])
+def test_condensed_matches_pdist(num_events, is_sparse):
+    data = weighted_rows(120, num_events)
+    expected = pdist(data, 'euclidean')
+    data = sparse.csr_matrix(data) if is_sparse else data
+    # squared distances are compared, the square root turns rounding at 0 into about 1e-8
+    np.testing.assert_allclose(bits_condensed(data, tile_pairs=500, n_threads=2) ** 2, expected ** 2, atol=1e-12)
+
+
+@pytest.mark.parametrize('num_events', [37, 64])
+def test_condensed_pruning_keeps_pairs_above_threshold(num_events):
+    data = weighted_rows(150, num_events, seed=1)
+    expected = pdist(data, 'euclidean')
+    threshold = np.median(expected)
+    dist_list = bits_condensed(data, threshold, byte_chunk=1)
+    below = expected < threshold
+    assert below.any() and (~below).any()
+    np.testing.assert_allclose(dist_list[below] ** 2, expected[below] ** 2, atol=1e-12)
+    # pruned pairs keep a partial distance, above threshold and not above the exact one
+    assert np.all(dist_list[~below] >= threshold)
+    assert np.all(dist_list[~below] <= expected[~below] + 1e-12)
+    # the same partition, fcluster may number the clusters differently
+    labels = fcluster(linkage(dist_list, 'complete'), threshold, criterion='distance')
+    expected_labels = fcluster(linkage(expected, 'complete'), threshold, criterion='distance')
+    np.testing.assert_array_equal(first_occurrence(labels), first_occurrence(expected_labels))
+
+
+@pytest.mark.parametrize('num_events', [37, 64])
+@pytest.mark.parametrize('threshold', [None, 'median'])
+def test_nearest_matches_cdist(num_events, threshold):
+    data = weighted_rows(300, num_events, seed=2)
+    repre_seqs = np.vstack([data[i:i + 30].mean(axis=0) for i in range(0, 300, 30)] + [data[:5]])
+    expected = cdist(data, repre_seqs)
+    if threshold == 'median':
+        threshold = np.median(expected.min(axis=1))
+    clu_array, min_dist = bits_nearest(sparse.csr_matrix(data), repre_seqs, threshold, block_size=64, n_threads=2,
+                                       byte_chunk=1)
+    expected_index = expected.argmin(axis=1)
+    expected_dist = expected.min(axis=1)
+    matched = expected_dist < threshold if threshold is not None else np.ones(len(data), dtype=bool)
+    np.testing.assert_array_equal(clu_array[matched], expected_index[matched])
+    np.testing.assert_allclose(min_dist[matched] ** 2, expected_dist[matched] ** 2, atol=1e-12)
+    assert np.all(clu_array[~matched] == -1)
+    assert np.all(min_dist[~matched] >= threshold)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from lib import cascading_clustering as cluster
+from lib.checkpoint import Checkpoint
+from run import get_parser
+
+
+class Interrupted(Exception):
+    pass
+
+
+def pattern_rows(num_inst=3000, num_events=20, seed=0):
+    rng = np.random.RandomState(seed)
+    patterns = rng.binomial(1, 0.3, size=(60, num_events))
+    data = patterns[rng.randint(0, len(patterns), size=num_inst)]
+    noise = rng.rand(num_inst, num_events) < 0.02
+    return np.logical_xor(data, noise).astype(np.float64), rng.rand(num_events) * 0.2 + 0.05
+
+
+def interrupt_after(monkeypatch, last_round):
+    save_round = Checkpoint.save_round
+
+    def interrupted_save_round(self, round, state):
+        save_round(self, round, state)
+        if round == last_round:
+            raise Interrupted()
+    monkeypatch.setattr(Checkpoint, 'save_round', interrupted_save_round)
+
+
+@pytest.mark.parametrize('warm_start', [False, True])
+def test_resume_matches_uninterrupted_run(tmp_path, monkeypatch, warm_start):
+    args = get_parser().parse_args(['--threshold', '0.2', '--sample_rate', '20', '--sample_seed', '1'])
+    raw_data, weights = pattern_rows()
+    weight_data = cluster.apply_weights(raw_data, weights)
+    raw_index = range(0, raw_data.shape[0])
+    known_repres = weight_data[:5] if warm_start else None
+    expected_labels, expected_repres = cluster.cascade_rounds(args, raw_data, raw_index, weight_data,
+                                                              known_repres=known_repres)
+    assert len(expected_repres) > 5
+
+    checkpoint = Checkpoint(str(tmp_path))
+    checkpoint.save_data(args, [], raw_data, raw_index, weights, known_repres=known_repres)
+    with monkeypatch.context() as patch:
+        interrupt_after(patch, 1)
+        with pytest.raises(Interrupted):
+            cluster.cascade_rounds(args, raw_data, raw_index, weight_data, known_repres=known_repres,
+                                   checkpoint=checkpoint)
+
+    checkpoint = Checkpoint(str(tmp_path))
+    _, raw_data, raw_index, counts, inverse, strata, weights, _, known_repres = checkpoint.load_data(args)
+    weight_data = cluster.apply_weights(raw_data, weights)
+    labels, repres = cluster.cascade_rounds(args, raw_data, raw_index, weight_data, counts, inverse, strata,
+                                            known_repres, checkpoint)
+    np.testing.assert_array_equal(labels, expected_labels)
+    np.testing.assert_array_equal(repres, expected_repres)
+
+
+def test_known_repres_survive_an_interrupted_round_0(tmp_path):
+    args = get_parser().parse_args([])
+    raw_data, weights = pattern_rows(50)
+    known_repres = raw_data[:3] * weights
+    Checkpoint(str(tmp_path)).save_data(args, [], raw_data, range(0, 50), weights, known_repres=known_repres)
+    np.testing.assert_array_equal(Checkpoint(str(tmp_path)).load_data(args)[-1], known_repres)
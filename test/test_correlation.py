@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+from scipy import sparse, stats
+from lib.correlation import benjamini_hochberg, correlate, interval_counts
+
+
+def random_counts(num_clusters=30, num_intervals=40, seed=0):
+    rng = np.random.RandomState(seed)
+    kpi = rng.rand(num_intervals)
+    counts = rng.poisson(2, size=(num_clusters, num_intervals)) * (rng.rand(num_clusters, num_intervals) < 0.5)
+    counts[:5] += np.round(10 * kpi).astype(np.int64)  # clusters following the KPI
+    counts[5] = 0  # a cluster without variance
+    return counts, kpi
+
+
+def test_correlate_matches_pearsonr():
+    counts, kpi = random_counts()
+    result = correlate(sparse.csr_matrix(counts), kpi).sort_values('cluster')
+    for k, row in enumerate(result.itertuples()):
+        if counts[k].std() == 0:
+            assert row.correlation == 0 and row.p_value == 1
+            continue
+        r, p = stats.pearsonr(counts[k], kpi)
+        np.testing.assert_allclose(row.correlation, r, atol=1e-10)
+        np.testing.assert_allclose(row.p_value, p, rtol=1e-6, atol=1e-12)
+        # the slope of the KPI regressed on the cluster's counts
+        np.testing.assert_allclose(row.slope, stats.linregress(counts[k], kpi).slope, rtol=1e-8)
+    assert result['sequences'].tolist() == counts.sum(axis=1).tolist()
+
+
+def reference_bh(p_value):
+    # q_(i) = min over j >= i of p_(j) * n / j, capped at 1
+    num_tests = len(p_value)
+    order = np.argsort(p_value)
+    q_value = np.empty(num_tests)
+    for i in range(num_tests):
+        q_value[order[i]] = min(1.0, min(p_value[order[j]] * num_tests / (j + 1) for j in range(i, num_tests)))
+    return q_value
+
+
+def test_benjamini_hochberg_matches_reference():
+    rng = np.random.RandomState(0)
+    p_value = np.concatenate([rng.rand(50), rng.rand(10) * 1e-3, [0.5, 0.5, 1.0]])
+    np.testing.assert_allclose(benjamini_hochberg(p_value), reference_bh(p_value))
+    assert len(benjamini_hochberg([])) == 0
+
+
+def test_interval_counts():
+    labels = np.array([0, 1, -1, 1, 2, 2, 0])
+    counts = interval_counts(labels, [0, 3, 7]).toarray()
+    np.testing.assert_array_equal(counts, [[1, 1], [1, 1], [0, 2]])
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from scipy import sparse
+from scipy.spatial.distance import cdist
+from lib.matcher import nearest_repres, RepresIndex
+
+
+def weighted_rows(num_inst, num_events, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.binomial(1, 0.2, size=(num_inst, num_events)) * rng.rand(num_events)
+
+
+def cdist_reference(data, repre_seqs, threshold):
+    dist = cdist(data, repre_seqs)
+    clu_array = dist.argmin(axis=1)
+    min_dist = dist.min(axis=1)
+    clu_array[min_dist >= threshold] = -1
+    return clu_array, min_dist
+
+
+@pytest.mark.parametrize('to_sparse, block_size, n_threads', [(False, 4096, 1), (False, 37, 4), (True, 50, 2)])
+def test_nearest_repres_matches_cdist(to_sparse, block_size, n_threads):
+    data = weighted_rows(600, 40)
+    repre_seqs = weighted_rows(25, 40, seed=1)
+    threshold = np.median(cdist(data, repre_seqs).min(axis=1))
+    expected_clu, expected_dist = cdist_reference(data, repre_seqs, threshold)
+    clu_array, min_dist = nearest_repres(sparse.csr_matrix(data) if to_sparse else data, repre_seqs, threshold,
+                                         block_size, n_threads)
+    np.testing.assert_array_equal(clu_array, expected_clu)
+    np.testing.assert_allclose(min_dist, expected_dist, atol=1e-9)
+
+
+def test_nearest_repres_without_representatives():
+    clu_array, min_dist = nearest_repres(weighted_rows(5, 4), np.zeros((0, 4)), 0.5)
+    np.testing.assert_array_equal(clu_array, -1)
+    assert np.all(np.isinf(min_dist))
+
+
+@pytest.mark.parametrize('num_groups, to_sparse', [(64, False), (4, False), (1, True)])
+def test_repres_index_matches_nearest_repres(num_groups, to_sparse):
+    data = weighted_rows(600, 40)
+    # duplicated representatives check that ties go to the smaller index as in argmin
+    repre_seqs = np.vstack([weighted_rows(25, 40, seed=1), data[:5], data[:5]])
+    index = RepresIndex(repre_seqs, num_groups)
+    for threshold in [0.3, np.median(cdist(data, repre_seqs).min(axis=1)), 10.0]:
+        expected_clu, expected_dist = nearest_repres(data, repre_seqs, threshold)
+        clu_array, min_dist = index.query(sparse.csr_matrix(data) if to_sparse else data, threshold, 64, 2)
+        np.testing.assert_array_equal(clu_array, expected_clu)
+        matched = clu_array != -1
+        np.testing.assert_allclose(min_dist[matched], expected_dist[matched], atol=1e-9)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from scipy import sparse
+from lib import cascading_clustering as cluster
+from lib.outofcore import RowStore, cascade_out_of_core
+from run import get_parser
+
+
+def pattern_rows(num_inst=4000, num_events=20, seed=0):
+    rng = np.random.RandomState(seed)
+    patterns = rng.binomial(1, 0.3, size=(60, num_events))
+    data = patterns[rng.randint(0, len(patterns), size=num_inst)]
+    noise = rng.rand(num_inst, num_events) < 0.02
+    return np.logical_xor(data, noise).astype(np.uint8), rng.rand(num_events) * 0.2 + 0.05
+
+
+@pytest.mark.parametrize('run_args', [[], ['--sparse', '--compact'],
+                                      ['--sample_policy', 'budget', '--sample_seed', '3', '--stratify']])
+def test_out_of_core_matches_in_memory_cascade(tmp_path, run_args):
+    # a 1 MB budget streams chunks of a few hundred rows
+    args = get_parser().parse_args(['--threshold', '0.2', '--sample_rate', '20', '--memory_budget_mb', '1',
+                                    '--sample_budget_mb', '0.5', '--output_path', str(tmp_path) + '/',
+                                    '--spill_dir', str(tmp_path)] + run_args)
+    raw_data, weights = pattern_rows()
+    offsets = np.arange(0, raw_data.shape[0] + 1, 500)
+    labels, repres = cascade_out_of_core(args, RowStore(raw_data), weights, offsets)
+
+    if args.sparse:
+        raw_data = sparse.csr_matrix(raw_data)
+    strata = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets)) if args.stratify else None
+    weight_data = cluster.apply_weights(raw_data, weights, args.compact)
+    expected_labels, expected_repres = cluster.cascade_rounds(args, raw_data, range(0, raw_data.shape[0]),
+                                                              weight_data, strata=strata)
+    assert len(expected_repres) > 1
+    np.testing.assert_array_equal(labels, expected_labels)
+    np.testing.assert_allclose(repres, expected_repres, rtol=1e-6)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from scipy import sparse
+from scipy.spatial.distance import pdist
+from lib.pairwise import condensed_distances
+
+
+def weighted_rows(num_inst, num_events, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.binomial(1, 0.2, size=(num_inst, num_events)) * rng.rand(num_events)
+
+
+@pytest.mark.parametrize('to_sparse', [False, True])
+@pytest.mark.parametrize('n_threads, tile_pairs', [(1, 1 << 22), (3, 500), (2, 1)])
+def test_condensed_distances_matches_pdist(to_sparse, n_threads, tile_pairs):
+    data = weighted_rows(150, 30)
+    expected = pdist(data, 'euclidean')
+    dist = condensed_distances(sparse.csr_matrix(data) if to_sparse else data, n_threads, tile_pairs)
+    assert dist.shape == expected.shape
+    np.testing.assert_allclose(dist, expected, atol=1e-7)
+
+
+def test_condensed_distances_float32():
+    data = weighted_rows(80, 30)
+    dist = condensed_distances(data, 2, 300, dtype=np.float32)
+    assert dist.dtype == np.float32
+    np.testing.assert_allclose(dist, pdist(data, 'euclidean'), rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('num_inst', [1, 2])
+def test_condensed_distances_small(num_inst):
+    data = weighted_rows(num_inst, 5)
+    np.testing.assert_allclose(condensed_distances(data), pdist(data, 'euclidean'))
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from scipy import sparse
+from lib import cascading_clustering as cluster
+
+
+def duplicated_rows(num_inst=500, num_events=12, seed=0):
+    rng = np.random.RandomState(seed)
+    patterns = rng.binomial(1, 0.3, size=(40, num_events)).astype(np.int64)
+    return patterns[rng.randint(0, len(patterns), size=num_inst)]
+
+
+@pytest.mark.parametrize('to_sparse', [False, True])
+def test_deduplicate_inverse_restores_input(to_sparse):
+    data = duplicated_rows()
+    raw_data = sparse.csr_matrix(data) if to_sparse else data
+    unique_data, counts, inverse = cluster.deduplicate(raw_data)
+    if to_sparse:
+        unique_data = unique_data.toarray()
+    np.testing.assert_array_equal(unique_data[inverse], data)
+    np.testing.assert_array_equal(counts, np.bincount(inverse, minlength=len(counts)))
+
+
+def test_stride_index_samples_the_original_sequences():
+    data = duplicated_rows()
+    unique_data, counts, inverse = cluster.deduplicate(data)
+    raw_index = np.arange(unique_data.shape[0])
+    sample_index = cluster.stride_index(raw_index, 7, counts, inverse)
+    # the same patterns as every 7th sequence of the input
+    expected = np.unique(inverse[::7])
+    np.testing.assert_array_equal(sample_index, expected)
+    # a round over part of the rows samples the rank of its rows
+    raw_index = raw_index[::3]
+    sample_index = cluster.stride_index(raw_index, 7, counts, inverse)
+    in_round = np.isin(inverse, raw_index)
+    np.testing.assert_array_equal(raw_index[sample_index], np.unique(inverse[in_round][::7]))
+
+
+@pytest.mark.parametrize('to_sparse', [False, True])
+def test_sampling_compact_rows_by_index(to_sparse):
+    data = duplicated_rows()
+    raw_data = (sparse.csr_matrix(data) if to_sparse else data).astype(np.uint8)
+    weights = np.linspace(0.5, 1.5, data.shape[1])
+    weight_data = cluster.apply_weights(raw_data, weights, compact=True)
+    sample_index = np.array([0, 3, 10, 200])
+    sample_data = cluster.sampling(weight_data, 7, sample_index)
+    if to_sparse:
+        sample_data = sample_data.toarray()
+    np.testing.assert_allclose(sample_data, data[sample_index] * weights, rtol=1e-6)
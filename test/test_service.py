@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from lib.incremental import REPRES_NAME, WEIGHTS_NAME
+from lib.service import AssignService
+from run import get_parser
+
+
+@pytest.fixture
+def service(tmp_path):
+    np.savetxt(str(tmp_path / REPRES_NAME), np.eye(3, 5), delimiter=',')
+    np.savetxt(str(tmp_path / WEIGHTS_NAME), np.ones(5), delimiter=',')
+    return AssignService(get_parser().parse_args(['--rep_path', str(tmp_path)]))
+
+
+def test_parse_requests(service):
+    np.testing.assert_array_equal(service.parse({'seqs': [[0, 2, 0, 0, 1]]}), [[0, 1, 0, 0, 1]])
+    np.testing.assert_array_equal(service.parse({'events': [[1, 4], []]}), [[0, 1, 0, 0, 1], [0, 0, 0, 0, 0]])
+    assert service.parse({'seqs': []}).shape == (0, 5)
+
+
+@pytest.mark.parametrize('msg', [{'seqs': [0, 1, 0, 0, 1]}, {'seqs': [[0, 1, 0, 0, 1, 0]]},
+                                 {'seqs': [[0, 1, 0, 0, 1, 0, 0, 0, 0, 0]]}, {'events': [[1, 5]]},
+                                 {'events': [[-1]]}])
+def test_parse_rejects_malformed_requests(service, msg):
+    with pytest.raises(ValueError):
+        service.parse(msg)
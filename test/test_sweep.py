@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from lib import cascading_clustering as cluster
+from lib.sweep import sweep
+from run import get_parser
+
+
+def pattern_rows(num_inst=3000, num_events=20, seed=0):
+    rng = np.random.RandomState(seed)
+    patterns = rng.binomial(1, 0.3, size=(60, num_events))
+    data = patterns[rng.randint(0, len(patterns), size=num_inst)]
+    noise = rng.rand(num_inst, num_events) < 0.02
+    return np.logical_xor(data, noise).astype(np.float64), rng.rand(num_events) * 0.2 + 0.05
+
+
+@pytest.mark.parametrize('run_args, dedup', [([], False), ([], True),
+                                             (['--sample_policy', 'budget', '--sample_budget_mb', '0.2',
+                                               '--sample_seed', '5'], False)])
+def test_sweep_matches_single_threshold_runs(run_args, dedup):
+    args = get_parser().parse_args(['--sample_rate', '20'] + run_args)
+    thresholds = [0.1, 0.2, 0.3, 0.3]
+    raw_data, weights = pattern_rows()
+    counts, inverse = None, None
+    if dedup:
+        raw_data, counts, inverse = cluster.deduplicate(raw_data)
+    weight_data = cluster.apply_weights(raw_data, weights)
+    raw_index = range(0, raw_data.shape[0])
+    result = sweep(args, thresholds, raw_index, weight_data, counts, None, inverse)
+
+    for threshold, row in zip(thresholds, result.itertuples()):
+        args.threshold = threshold
+        labels, repres = cluster.cascade_rounds(args, raw_data, raw_index, weight_data, counts, inverse)
+        assert row.threshold == threshold
+        assert row.clusters == len(repres)
+        # the sweep counts the residual in rows of weight_data, the labels are of the original rows
+        unmatched = labels == -1
+        assert row.residual == (len(np.unique(inverse[unmatched])) if dedup else np.sum(unmatched))
+    assert result['clusters'].iloc[0] > result['clusters'].iloc[2]
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from sklearn.linear_model import Ridge
+from lib.weighting import RidgeStats, STATS_NAME, sync_stats
+
+
+def random_intervals(num_inst, num_events, seed=0):
+    rng = np.random.RandomState(seed)
+    occu = rng.poisson(3, size=(num_inst, num_events)).astype(np.float64)
+    kpi = occu[:, :5].dot(rng.rand(5)) + rng.rand(num_inst)
+    return occu, kpi
+
+
+def fit_stats(occu, kpi):
+    stats = RidgeStats(occu.shape[1], alpha=0.01)
+    for i in range(len(occu)):
+        stats.add(i, occu[i], kpi[i])
+    return stats
+
+
+@pytest.mark.parametrize('num_inst, num_events', [(200, 30), (30, 200)])
+def test_solve_matches_sklearn_ridge(num_inst, num_events):
+    occu, kpi = random_intervals(num_inst, num_events)
+    expected = Ridge(alpha=0.01).fit(occu, kpi).coef_
+    np.testing.assert_allclose(fit_stats(occu, kpi).solve(), expected, rtol=1e-6, atol=1e-8)
+
+
+def test_kernel_path_builds_no_event_statistics():
+    occu, kpi = random_intervals(20, 500)
+    stats = fit_stats(occu, kpi)
+    stats.solve()
+    assert stats.xtx is None
+
+
+@pytest.mark.parametrize('num_inst, num_events', [(200, 30), (30, 200)])
+def test_sliding_window_matches_refit(num_inst, num_events):
+    occu, kpi = random_intervals(num_inst, num_events, seed=1)
+    stats = fit_stats(occu, kpi)
+    stats.solve()
+    window = num_inst // 2
+    stats.keep_last(window)
+    expected = Ridge(alpha=0.01).fit(occu[-window:], kpi[-window:]).coef_
+    np.testing.assert_allclose(stats.solve(), expected, rtol=1e-6, atol=1e-8)
+
+
+def test_sync_stats_round_trip(tmp_path):
+    occu, kpi = random_intervals(100, 20, seed=2)
+    keys = ['timeInter_%d.csv' % i for i in range(len(occu))]
+    sync_stats(str(tmp_path), keys[:80], occu[:80], kpi[:80])
+    stats = sync_stats(str(tmp_path), keys[10:], occu[10:], kpi[10:])
+    assert stats.xtx is not None
+    expected = Ridge(alpha=0.01).fit(occu[10:], kpi[10:]).coef_
+    np.testing.assert_allclose(stats.solve(), expected, rtol=1e-6, atol=1e-8)
+
+
+def test_sync_stats_keeps_no_event_statistics_for_wide_data(tmp_path):
+    occu, kpi = random_intervals(30, 200, seed=3)
+    keys = ['timeInter_%d.csv' % i for i in range(len(occu))]
+    sync_stats(str(tmp_path), keys, occu, kpi)
+    stats = RidgeStats.load(str(tmp_path / STATS_NAME))
+    assert stats.xtx is None
+    np.testing.assert_allclose(stats.solve(), Ridge(alpha=0.01).fit(occu, kpi).coef_, rtol=1e-6, atol=1e-8)